@@ -1,16 +1,36 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, Response, Request, Query
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 from pathlib import Path
+from typing import List
+import os
+import asyncio
 import shutil
 import logging
 import uuid
-import pyzipper
-from document_to_md import convert_document_to_md
-from md_to_html import convert_markdown_to_html
-from html_to_pdf import generate_pdf
-from pdf_to_png import render_pdf_to_png
-from png_to_embeddings import process_images_for_embeddings
-from utils.file_processing import process_directory_png
+import hashlib
+import time
+import zipfile
+import io
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+from main import main as run_pipeline, main_batch as run_batch_pipeline, pipeline_options, warmup_converters, \
+    PIPELINE_STAGES, BATCH_STAGES, RENDER_MODE, RENDER_MODES, IMAGE_MODE, HTML_MODE, HTML_MODES
+from document_to_md import IMAGE_MODES
+from utils.jobs import JobManager, SqliteJobStore, STATUS_SUCCESS, STATUS_FAILED
+from utils.result_cache import ResultCache, make_cache_key
+from utils.converter_registry import registry as converter_registry
+from utils.zip_stream import iter_zip, COMPRESSION_METHODS as ZIP_COMPRESSION
+from utils.embedding_store import EmbeddingStore, page_number_from_name, page_sort_key, STORE_EMBEDDINGS, \
+    STORE_POOLED, STORE_MANIFEST
+from utils.http_cache import file_response, bytes_response
+from utils.vector_index import VectorIndex, INDEX_MODES
+from utils.session_store import SessionStore, SqliteSessionStore
+from utils.metrics import registry as metrics_registry, current_rss_bytes
+from utils.admission import AdmissionController, Overloaded, physical_memory_bytes
+from utils import image_writer
+from png_to_embeddings import get_pooled_image_embedding, load_model, model_loaded, get_page_cache
+from html_to_pdf import shutdown_renderer
 
 # Настройка логгера
 _log = logging.getLogger(__name__)
@@ -19,8 +39,69 @@ logging.basicConfig(level=logging.INFO)
 # Создание FastAPI приложения
 app = FastAPI()
 
-# Словарь для хранения сессий
-sessions = {}
+# Каталог временных файлов сессий. При нескольких воркерах или репликах - общее хранилище
+TEMP_ROOT = Path(os.environ.get("TEMP_ROOT", "temp"))
+
+# Хранилище состояния сессий и задач: memory - в памяти процесса (один воркер),
+# sqlite - файл STATE_DB_PATH, общий для uvicorn --workers N и реплик с общим TEMP_ROOT
+STATE_BACKENDS = ("memory", "sqlite")
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", str(TEMP_ROOT / "state.db"))
+if STATE_BACKEND not in STATE_BACKENDS:
+    raise ValueError(f"STATE_BACKEND must be one of {STATE_BACKENDS}, got {STATE_BACKEND}")
+
+# Как часто поиск подхватывает сессии, обработанные другими процессами (STATE_BACKEND=sqlite)
+INDEX_SYNC_SECONDS = float(os.environ.get("INDEX_SYNC_SECONDS", "5"))
+
+# Время жизни сессий и лимит занимаемого ими диска
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", "3600"))
+SESSION_MAX_BYTES = int(os.environ.get("SESSION_MAX_BYTES", str(10 * 1024 ** 3)))
+REAPER_INTERVAL_SECONDS = int(os.environ.get("REAPER_INTERVAL_SECONDS", "60"))
+
+# Очередь фоновой обработки документов
+PIPELINE_WORKERS = int(os.environ.get("PIPELINE_WORKERS", "2"))
+job_manager = JobManager(
+    max_workers=PIPELINE_WORKERS,
+    store=SqliteJobStore(STATE_DB_PATH, root=TEMP_ROOT) if STATE_BACKEND == "sqlite" else None
+)
+
+# Допуск документов в обработку: сколько обрабатывается одновременно, сколько ждет в очереди
+# и бюджет памяти (RSS процесса с дочерними, по умолчанию 75% физической памяти, 0 - без ограничения).
+# Сверх лимитов загрузка сразу получает 429 с Retry-After.
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", str(PIPELINE_WORKERS)))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "16"))
+ADMISSION_MAX_RSS_BYTES = int(os.environ.get("ADMISSION_MAX_RSS_BYTES",
+                                             str(int((physical_memory_bytes() or 0) * 0.75))))
+admission = AdmissionController(ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_QUEUE, ADMISSION_MAX_RSS_BYTES or None)
+
+# Кэш результатов по хэшу входного файла и параметрам
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "cache/results")
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(5 * 1024 ** 3)))
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+
+# Индекс векторов страниц для /search
+vector_index = VectorIndex(mode=os.environ.get("SEARCH_INDEX_MODE", "auto"))
+
+# Максимум документов в одной пакетной загрузке (с учетом содержимого ZIP)
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", "5000"))
+# Максимальный суммарный размер распакованных документов из ZIP-архивов пакета
+BATCH_MAX_UNCOMPRESSED_BYTES = int(os.environ.get("BATCH_MAX_UNCOMPRESSED_BYTES", str(5 * 1024 ** 3)))
+
+# Режим картинок Markdown для API по умолчанию. embedded отдает самодостаточный файл, как раньше;
+# при image_mode=referenced картинки отдаются рядом с ним через /get-md/{имя файла}
+API_IMAGE_MODE = os.environ.get("API_IMAGE_MODE", "embedded")
+if API_IMAGE_MODE not in IMAGE_MODES:
+    raise ValueError(f"API_IMAGE_MODE must be one of {IMAGE_MODES}, got {API_IMAGE_MODE}")
+
+# Прогрев конвертеров docling при старте
+WARMUP_CONVERTERS = os.environ.get("WARMUP_CONVERTERS", "0") == "1"
+
+# Загрузка модели эмбеддингов при старте. Выполняется в фоне после запуска сервера,
+# до ее окончания /ready отвечает 503. При 0 модель загрузится первым запросом.
+PRELOAD_MODELS = os.environ.get("PRELOAD_MODELS", "1") == "1"
+
+# Состояние фоновой загрузки для /ready
+startup_state = {"status": "pending", "error": None, "seconds": None}
 
 def cleanup_temp_files(temp_dir: Path):
     """
@@ -33,134 +114,483 @@ def cleanup_temp_files(temp_dir: Path):
     except Exception as e:
         _log.error(f"Error deleting temporary files: {e}")
 
-@app.post("/upload-document/")
-async def upload_document(
-    file: UploadFile = File(...),
-    response: Response = None,
-    include_images: bool = Query(default=True, description="Include images in Markdown")
-):
+def _evict_session(session_id: str, session: dict):
+    """
+    Удаляет данные вытесненной сессии: индекс поиска, задачу и временные файлы.
+    """
+    vector_index.remove(session_id)
+    job_manager.remove(session_id)
+    cleanup_temp_files(session["temp_dir"])
+
+# Хранилище сессий
+if STATE_BACKEND == "sqlite":
+    sessions = SqliteSessionStore(STATE_DB_PATH, SESSION_TTL_SECONDS, SESSION_MAX_BYTES,
+                                  on_evict=_evict_session, root=TEMP_ROOT)
+else:
+    sessions = SessionStore(SESSION_TTL_SECONDS, SESSION_MAX_BYTES, on_evict=_evict_session)
+
+# Время последней сверки индекса поиска с общим хранилищем сессий
+_index_synced_at = 0.0
+
+def _reap():
+    """
+    Удаляет истекшие сессии и старые задачи, не ставшие сессиями (например, с ошибкой).
+    """
+    sessions.reap()
+    for job_id in job_manager.prune(SESSION_TTL_SECONDS):
+        if job_id not in sessions:
+            cleanup_temp_files(TEMP_ROOT / job_id)
+
+def _register_gauges():
+    """
+    Gauge-метрики состояния сервиса для /metrics.
+    """
+    metrics_registry.gauge("sessions_live", "Live sessions.",
+                           lambda: [({}, sessions.stats()["live_sessions"])])
+    metrics_registry.gauge("sessions_bytes_held", "Bytes of temp files held by live sessions.",
+                           lambda: [({}, sessions.stats()["bytes_held"])])
+    metrics_registry.gauge("jobs", "Pipeline jobs by status.",
+                           lambda: [({"status": status}, count) for status, count in job_manager.counts().items()])
+    metrics_registry.gauge("result_cache", "Result cache counters and size.",
+                           lambda: [({"field": field}, value) for field, value in result_cache.stats().items()])
+    metrics_registry.gauge("converter_init_seconds", "Docling converter build and warm-up time.",
+                           lambda: [({"name": item["name"]}, item["init_seconds"]) for item in converter_registry.stats()])
+    metrics_registry.gauge("search_index_vectors", "Page vectors in the search index.",
+                           lambda: [({}, vector_index.stats()["vectors"])])
+    metrics_registry.gauge("admission", "Admission controller state and rejection counters.",
+                           lambda: [({"field": field}, value) for field, value in admission.stats().items()])
+    metrics_registry.gauge("process_rss_bytes", "Current resident set size of the process.",
+                           lambda: [({}, current_rss_bytes())])
+
+_register_gauges()
+
+async def _reaper_loop():
+    while True:
+        await asyncio.sleep(REAPER_INTERVAL_SECONDS)
+        try:
+            await run_in_threadpool(_reap)
+        except Exception as e:
+            _log.error(f"Error reaping sessions: {e}")
+
+def _run_pipeline(session_id: str, input_doc_path: Path, temp_dir: Path, include_images: bool,
+                  render_mode: str = RENDER_MODE, image_mode: str = IMAGE_MODE, html_mode: str = HTML_MODE,
+                  cache_key: str = None, progress_callback=None):
+    """
+    Выполняет конвейер в рабочем потоке, регистрирует результаты в сессии
+    и сохраняет их в кэш.
+    """
+    result = run_pipeline(input_doc_path, temp_dir, include_images=include_images,
+                          progress_callback=progress_callback, render_mode=render_mode, image_mode=image_mode,
+                          html_mode=html_mode)
+    result["search_id"] = _register_session(session_id, result["artifacts"], include_images, temp_dir)
+    if cache_key:
+        result_cache.put(cache_key, temp_dir, result["artifacts"], exclude=[input_doc_path])
+    return result
+
+def _register_session(session_id: str, artifacts: dict, include_images: bool, temp_dir: Path):
+    """
+    Регистрирует сессию и добавляет ее страницы в индекс поиска. Возвращает search_id -
+    случайный идентификатор документа в результатах /search. В отличие от session_id,
+    по нему нельзя получить файлы сессии.
+    """
+    search_id = uuid.uuid4().hex
+    sessions.put(session_id, dict(artifacts, include_images=include_images, temp_dir=temp_dir, search_id=search_id),
+                 temp_dir)
+    _index_session(session_id, artifacts["embeddings_dir"], search_id)
+    return search_id
+
+def _index_session(session_id: str, embeddings_dir: Path, search_id: str = None):
+    """
+    Добавляет усредненные векторы страниц сессии в индекс поиска.
     """
-    Загружает документ и выполняет все этапы преобразования.
+    try:
+        if not EmbeddingStore.exists(embeddings_dir):
+            return
+        store = EmbeddingStore(embeddings_dir)
+        if store.pooled is not None and len(store):
+            vector_index.add(session_id, store.pages, store.pooled, label=search_id or uuid.uuid4().hex)
+    except Exception as e:
+        _log.error(f"Error indexing session {session_id}: {e}")
+
+def _sync_index():
+    """
+    Сверяет индекс поиска процесса с общим хранилищем сессий: добавляет сессии,
+    обработанные другими воркерами, и убирает вытесненные ими. Не чаще раза в INDEX_SYNC_SECONDS.
+    """
+    global _index_synced_at
+    if STATE_BACKEND != "sqlite" or time.monotonic() - _index_synced_at < INDEX_SYNC_SECONDS:
+        return
+    _index_synced_at = time.monotonic()
+    live = set(sessions.session_ids())
+    indexed = set(vector_index.doc_ids())
+    for session_id in indexed - live:
+        vector_index.remove(session_id)
+    for session_id in live - indexed:
+        session = sessions.get(session_id, touch=False)
+        if session and session.get("embeddings_dir"):
+            _index_session(session_id, session["embeddings_dir"], session.get("search_id"))
+
+def _get_session(request: Request):
+    """
+    Возвращает сессию по session_id из куки.
+    Если задача сессии еще выполняется или завершилась ошибкой, возвращает 409.
+    """
+    # Извлекаем session_id из куки
+    session_id = request.cookies.get("session_id")
+    _log.info(f"Session ID from cookies: {session_id}")
+    if not session_id:
+        raise HTTPException(status_code=400, detail="Session ID not found in cookies.")
+
+    session = sessions.get(session_id)
+    if session:
+        return session
+
+    job = job_manager.get(session_id)
+    if job and job["status"] != STATUS_SUCCESS:
+        detail = job["error"] if job["status"] == STATUS_FAILED else f"Job is {job['status']}."
+        raise HTTPException(status_code=409, detail=detail)
+    raise HTTPException(status_code=404, detail="Session not found.")
+
+def _check_modes(render_mode: str, image_mode: str, html_mode: str):
+    if render_mode not in RENDER_MODES:
+        raise HTTPException(status_code=400, detail=f"render_mode must be one of {', '.join(RENDER_MODES)}.")
+    if image_mode not in IMAGE_MODES:
+        raise HTTPException(status_code=400, detail=f"image_mode must be one of {', '.join(IMAGE_MODES)}.")
+    if html_mode not in HTML_MODES:
+        raise HTTPException(status_code=400, detail=f"html_mode must be one of {', '.join(HTML_MODES)}.")
+
+def _admit(kind: str):
+    """
+    Допуск задачи в очередь обработки. При перегрузке сразу отвечает 429 с Retry-After.
     """
     try:
-        # Генерируем уникальный идентификатор сессии
-        session_id = str(uuid.uuid4())
+        return admission.admit(kind)
+    except Overloaded as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+def _save_upload(source, filename: str):
+    """
+    Сохраняет документ в новую временную директорию сессии, попутно считая его хэш.
+    Возвращает (session_id, путь документа, временная директория, sha256).
+    """
+    # Генерируем уникальный идентификатор сессии (он же идентификатор задачи)
+    session_id = str(uuid.uuid4())
 
-        # Создаем временную директорию для сессии
-        temp_dir = Path("temp") / session_id
-        temp_dir.mkdir(parents=True, exist_ok=True)
+    # Создаем временную директорию для сессии
+    temp_dir = TEMP_ROOT / session_id
+    temp_dir.mkdir(parents=True, exist_ok=True)
 
-        # Сохраняем загруженный файл
-        input_doc_path = temp_dir / file.filename
+    input_doc_path = temp_dir / Path(filename).name
+    digest = hashlib.sha256()
+    try:
         with open(input_doc_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+            for chunk in iter(lambda: source.read(1024 * 1024), b""):
+                digest.update(chunk)
+                buffer.write(chunk)
+    except BaseException:
+        cleanup_temp_files(temp_dir)
+        raise
+    return session_id, input_doc_path, temp_dir, digest.hexdigest()
+
+def _restore_cached(session_id: str, cache_key: str, temp_dir: Path, include_images: bool):
+    """
+    Восстанавливает результат из кэша в сессию. Возвращает True при попадании.
+    """
+    artifacts = result_cache.get(cache_key, temp_dir)
+    if not artifacts:
+        return False
+    search_id = _register_session(session_id, artifacts, include_images, temp_dir)
+    result = {"status": "success", "message": "Document processed (cached).", "cached": True,
+              "artifacts": artifacts, "search_id": search_id}
+    job_manager.complete(session_id, result, stages=PIPELINE_STAGES, stage_status="cached")
+    return True
+
+@app.post("/upload-document/", status_code=202)
+async def upload_document(
+    file: UploadFile = File(...),
+    response: Response = None,
+    include_images: bool = Query(default=True, description="Include images in Markdown"),
+    render_mode: str = Query(default=RENDER_MODE, description="auto: reuse docling page images for PDF/image inputs; normalized: always re-render via HTML and PDF"),
+    image_mode: str = Query(default=API_IMAGE_MODE, description="embedded: base64 images in Markdown; referenced: Markdown links the extracted pictures, served by /get-md/{filename}"),
+    html_mode: str = Query(default=HTML_MODE, description="docling: export HTML straight from the docling document; pandoc: convert Markdown with pandoc")
+):
+    """
+    Загружает документ и ставит его обработку в очередь.
+    Возвращает идентификатор задачи, статус доступен через /jobs/{job_id}.
+    При перегрузке отвечает 429 с заголовком Retry-After.
+    """
+    _check_modes(render_mode, image_mode, html_mode)
+    ticket = _admit("document")
 
-        # 1. Конвертация документа в Markdown
-        _log.info("Starting document to Markdown conversion...")
-        md_file = convert_document_to_md(input_doc_path, temp_dir, image_resolution_scale=2.0, include_images=include_images)
-        if not md_file:
-            raise Exception("Failed to convert document to Markdown.")
-        _log.info(f"Markdown file created: {md_file}")
-
-        # 2. Конвертация Markdown в HTML
-        _log.info("Starting Markdown to HTML conversion...")
-        html_file = temp_dir / f"{input_doc_path.stem}-with-image-refs.html"
-        if not convert_markdown_to_html(md_file, html_file):
-            raise Exception("Failed to convert Markdown to HTML.")
-        _log.info(f"HTML file created: {html_file}")
-
-        # 3. Конвертация HTML в PDF
-        _log.info("Starting HTML to PDF conversion...")
-        pdf_file = temp_dir / "output.pdf"
-        if not generate_pdf(html_file, pdf_file, wkhtmltopdf_path="D:\\wkhtmltox-0.12.6-1.mxe-cross-win64\\wkhtmltox\\bin\\wkhtmltopdf.exe"):
-            raise Exception("Failed to convert HTML to PDF.")
-        _log.info(f"PDF file created: {pdf_file}")
-
-        # 4. Рендеринг PDF в PNG
-        _log.info("Starting PDF to PNG rendering...")
-        output_images_dir = temp_dir / "images"
-        output_images_dir.mkdir(parents=True, exist_ok=True)
-        if not render_pdf_to_png(pdf_file, output_images_dir):
-            raise Exception("Failed to render PDF to PNG.")
-        _log.info(f"PNG images saved to: {output_images_dir}")
-
-        # 5. Получение эмбеддингов из PNG
-        _log.info("Starting PNG to embeddings conversion...")
-        output_embeddings_dir = temp_dir / "embeddings"
-        output_embeddings_dir.mkdir(parents=True, exist_ok=True)
-        process_images_for_embeddings(output_images_dir, output_embeddings_dir)
-        _log.info(f"Embeddings saved to: {output_embeddings_dir}")
-
-        # 6. Перемещение .npy файлов
-        _log.info("Moving .npy files...")
-        process_directory_png(output_images_dir, output_embeddings_dir)
-        _log.info(f".npy files moved to: {output_embeddings_dir}")
-
-        # Сохраняем результаты в сессии
-        sessions[session_id] = {
-            "md_file": md_file,
-            "html_file": html_file,
-            "pdf_file": pdf_file,
-            "images_dir": output_images_dir,
-            "embeddings_dir": output_embeddings_dir,
-            "include_images": include_images
-        }
+    try:
+        # Сохраняем загруженный файл, попутно считая его хэш
+        # Копирование и хэширование крупных файлов не должно блокировать цикл событий
+        session_id, input_doc_path, temp_dir, digest = await run_in_threadpool(_save_upload, file.file, file.filename)
 
         # Устанавливаем session_id в куки
         response.set_cookie(key="session_id", value=session_id)
         _log.info(f"Session ID set in cookies: {session_id}")
 
-        return {"status": "success", "message": "Document processed.", "session_id": session_id}
+        # Проверяем кэш результатов
+        cache_key = make_cache_key(digest, pipeline_options(include_images, render_mode, image_mode, html_mode))
+        if await run_in_threadpool(_restore_cached, session_id, cache_key, temp_dir, include_images):
+            ticket.cancel()
+            response.status_code = 200
+            return {
+                "status": "success",
+                "message": "Document processed (cached).",
+                "cached": True,
+                "job_id": session_id,
+                "session_id": session_id,
+                "status_url": f"/jobs/{session_id}"
+            }
+
+        # Ставим обработку в очередь
+        job_manager.submit(_run_pipeline, session_id, input_doc_path, temp_dir, include_images, render_mode, image_mode,
+                           html_mode, cache_key, job_id=session_id, stages=PIPELINE_STAGES, ticket=ticket)
+
+        return {
+            "status": "queued",
+            "message": "Document accepted for processing.",
+            "cached": False,
+            "job_id": session_id,
+            "session_id": session_id,
+            "status_url": f"/jobs/{session_id}"
+        }
     except Exception as e:
-        _log.error(f"Error processing document: {e}")
+        ticket.cancel()
+        _log.error(f"Error queueing document: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _save_batch_uploads(uploads: List[UploadFile]):
+    """
+    Сохраняет файлы пакета, распаковывая ZIP-архивы: каждый документ получает свою сессию.
+    Возвращает список (session_id, путь документа, временная директория, sha256).
+    При ошибке уже сохраненные документы удаляются.
+    """
+    saved = []
+    try:
+        _save_batch_files(uploads, saved)
+    except BaseException:
+        _cleanup_saved(saved)
+        raise
+    return saved
+
+def _save_batch_files(uploads: List[UploadFile], saved: list):
+    uncompressed_bytes = 0
+
+    def check_limit():
+        if len(saved) >= BATCH_MAX_FILES:
+            raise HTTPException(status_code=400, detail=f"Batch is limited to {BATCH_MAX_FILES} documents.")
+
+    for upload in uploads:
+        if Path(upload.filename).suffix.lower() != ".zip":
+            check_limit()
+            saved.append(_save_upload(upload.file, upload.filename))
+            continue
+        try:
+            archive = zipfile.ZipFile(upload.file)
+        except zipfile.BadZipFile:
+            raise HTTPException(status_code=400, detail=f"{upload.filename} is not a valid ZIP archive.")
+        with archive:
+            members = []
+            for member in archive.infolist():
+                name = Path(member.filename).name
+                # Пропускаем каталоги, служебные файлы и вложенные архивы
+                if member.is_dir() or not name or name.startswith(".") or "__MACOSX" in member.filename \
+                        or Path(name).suffix.lower() == ".zip":
+                    continue
+                members.append((member, name))
+            # Размер проверяется до распаковки: ZipExtFile не читает больше заявленного file_size
+            uncompressed_bytes += sum(member.file_size for member, _ in members)
+            if uncompressed_bytes > BATCH_MAX_UNCOMPRESSED_BYTES:
+                raise HTTPException(status_code=413, detail=f"Uncompressed ZIP contents exceed "
+                                                            f"{BATCH_MAX_UNCOMPRESSED_BYTES} bytes.")
+            for member, name in members:
+                check_limit()
+                with archive.open(member) as source:
+                    saved.append(_save_upload(source, name))
+
+def _cleanup_saved(saved: list):
+    """
+    Удаляет временные директории сохраненных документов, еще не ставших сессиями.
+    """
+    for session_id, _path, temp_dir, *_rest in saved:
+        if session_id not in sessions:
+            cleanup_temp_files(temp_dir)
+
+def _fail_pending(documents: list, error: str):
+    """
+    Завершает ошибкой задачи документов пакета, так и не ставших сессиями.
+    """
+    for session_id, *_rest in documents:
+        if session_id not in sessions:
+            job_manager.fail(session_id, error)
+
+def _run_batch(documents: list, cached: list, include_images: bool, render_mode: str, image_mode: str,
+               html_mode: str, progress_callback=None):
+    """
+    Выполняет пакетный конвейер и регистрирует каждый обработанный документ как отдельную сессию.
+    documents - список (session_id, путь документа, временная директория, ключ кэша).
+    Задачи документов (см. upload_batch) завершаются успехом или ошибкой по итогам пакета.
+    """
+    try:
+        result = run_batch_pipeline([(session_id, path, temp_dir) for session_id, path, temp_dir, _ in documents],
+                                    include_images=include_images, progress_callback=progress_callback,
+                                    render_mode=render_mode, image_mode=image_mode, html_mode=html_mode)
+        by_id = {session_id: (path, temp_dir, cache_key) for session_id, path, temp_dir, cache_key in documents}
+        for entry in result["documents"]:
+            input_doc_path, temp_dir, cache_key = by_id[entry["doc_id"]]
+            if entry["status"] != STATUS_SUCCESS:
+                cleanup_temp_files(temp_dir)
+                job_manager.fail(entry["doc_id"], entry.get("error") or "Document processing failed.")
+                continue
+            artifacts = entry["artifacts"]
+            search_id = _register_session(entry["doc_id"], artifacts, include_images, temp_dir)
+            result_cache.put(cache_key, temp_dir, artifacts, exclude=[input_doc_path])
+            job_manager.complete(entry["doc_id"], {"status": "success", "message": "Document processed in a batch.",
+                                                   "cached": False, "artifacts": artifacts, "search_id": search_id},
+                                 stages=PIPELINE_STAGES)
+            entry["session_id"] = entry["doc_id"]
+            entry["search_id"] = search_id
+    except BaseException:
+        # Сбой общего этапа (например, эмбеддингов): директории документов не принадлежат
+        # ни задаче, ни сессии, и сборщик их не удалит
+        _cleanup_saved(documents)
+        _fail_pending(documents, "Batch processing failed.")
+        raise
+    result["documents"] = cached + result["documents"]
+    return result
+
+@app.post("/upload-batch/", status_code=202)
+async def upload_batch(
+    files: List[UploadFile] = File(...),
+    include_images: bool = Query(default=True, description="Include images in Markdown"),
+    render_mode: str = Query(default=RENDER_MODE, description="auto: reuse docling page images for PDF/image inputs; normalized: always re-render via HTML and PDF"),
+    image_mode: str = Query(default=API_IMAGE_MODE, description="embedded: base64 images in Markdown; referenced: Markdown links the extracted pictures, served by /get-md/{filename}"),
+    html_mode: str = Query(default=HTML_MODE, description="docling: export HTML straight from the docling document; pandoc: convert Markdown with pandoc")
+):
+    """
+    Пакетная загрузка: несколько файлов и/или ZIP-архивов.
+    Документы конвертируются параллельно, страницы всех документов считаются общими батчами.
+    Манифест (документ -> сессия и артефакты) доступен в результате задачи /jobs/{batch_id}.
+    Документы из кэша сразу попадают в манифест со статусом cached.
+    Пакет допускается как одна задача; при перегрузке - 429 с Retry-After.
+    """
+    _check_modes(render_mode, image_mode, html_mode)
+    ticket = _admit("batch")
+
+    saved, documents = [], []
+    try:
+        saved = await run_in_threadpool(_save_batch_uploads, files)
+        if not saved:
+            raise HTTPException(status_code=400, detail="No documents found in the upload.")
+
+        options = pipeline_options(include_images, render_mode, image_mode, html_mode)
+        cached = []
+        for session_id, input_doc_path, temp_dir, digest in saved:
+            cache_key = make_cache_key(digest, options)
+            if await run_in_threadpool(_restore_cached, session_id, cache_key, temp_dir, include_images):
+                cached.append({"doc_id": session_id, "session_id": session_id, "filename": input_doc_path.name,
+                               "status": "cached", "error": None, "artifacts": sessions.get(session_id)})
+            else:
+                documents.append((session_id, input_doc_path, temp_dir, cache_key))
+
+        # Пока пакет выполняется, документы отвечают 409 (не готов), а не 404
+        for session_id, *_rest in documents:
+            job_manager.track(session_id, stages=PIPELINE_STAGES)
+        batch_id = str(uuid.uuid4())
+        job_manager.submit(_run_batch, documents, cached, include_images, render_mode, image_mode, html_mode,
+                           job_id=batch_id, stages=BATCH_STAGES, ticket=ticket)
+        return {
+            "status": "queued",
+            "message": f"{len(saved)} documents accepted for processing, {len(cached)} cached.",
+            "batch_id": batch_id,
+            "job_id": batch_id,
+            "status_url": f"/jobs/{batch_id}",
+            "documents": [{"doc_id": session_id, "session_id": session_id, "filename": input_doc_path.name}
+                          for session_id, input_doc_path, _, _ in saved],
+        }
+    except HTTPException:
+        ticket.cancel()
+        await run_in_threadpool(_cleanup_saved, saved)
+        raise
+    except Exception as e:
+        ticket.cancel()
+        await run_in_threadpool(_cleanup_saved, saved)
+        await run_in_threadpool(_fail_pending, documents, str(e))
+        _log.error(f"Error queueing batch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Возвращает статус задачи, состояние этапов и прогресс.
+    """
+    job = job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
 @app.get("/get-md/")
 async def get_md(request: Request):
     """
-    Возвращает Markdown-файл.
+    Возвращает Markdown-файл. Поддерживает ETag/If-None-Match и Range.
     """
     try:
-        # Извлекаем session_id из куки
-        session_id = request.cookies.get("session_id")
-        _log.info(f"Session ID from cookies: {session_id}")
-        if not session_id:
-            raise HTTPException(status_code=400, detail="Session ID not found in cookies.")
-
-        session = sessions.get(session_id)
-        if not session:
-            raise HTTPException(status_code=404, detail="Session not found.")
+        session = _get_session(request)
 
         md_file = session.get("md_file")
         if not md_file:
             raise HTTPException(status_code=404, detail="Markdown file not found.")
 
-        return FileResponse(md_file, media_type="text/markdown", filename=md_file.name)
+        return file_response(request, md_file, "text/markdown", filename=md_file.name)
+    except HTTPException:
+        raise
     except Exception as e:
         _log.error(f"Error retrieving Markdown: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Картинки и таблицы, на которые ссылается Markdown в режиме referenced
+MARKDOWN_IMAGE_TYPES = {".png": "image/png", ".webp": "image/webp"}
+
+@app.get("/get-md/{filename}")
+async def get_md_image(request: Request, filename: str):
+    """
+    Возвращает картинку, на которую ссылается Markdown (image_mode=referenced).
+    Относительные ссылки в Markdown, полученном с /get-md/, указывают сюда.
+    """
+    try:
+        session = _get_session(request)
+
+        md_file = session.get("md_file")
+        media_type = MARKDOWN_IMAGE_TYPES.get(Path(filename).suffix.lower())
+        image_file = md_file.parent / filename if md_file and media_type and Path(filename).name == filename else None
+        if not image_file or not image_file.is_file():
+            raise HTTPException(status_code=404, detail="Image not found.")
+
+        return file_response(request, image_file, media_type)
+    except HTTPException:
+        raise
+    except Exception as e:
+        _log.error(f"Error retrieving Markdown image: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/get-html/")
 async def get_html(request: Request):
     """
-    Возвращает HTML-файл.
+    Возвращает HTML-файл. Поддерживает ETag/If-None-Match и Range.
     """
     try:
-        # Извлекаем session_id из куки
-        session_id = request.cookies.get("session_id")
-        _log.info(f"Session ID from cookies: {session_id}")
-        if not session_id:
-            raise HTTPException(status_code=400, detail="Session ID not found in cookies.")
-
-        session = sessions.get(session_id)
-        if not session:
-            raise HTTPException(status_code=404, detail="Session not found.")
+        session = _get_session(request)
 
         html_file = session.get("html_file")
         if not html_file:
             raise HTTPException(status_code=404, detail="HTML file not found.")
 
-        return FileResponse(html_file, media_type="text/html", filename=html_file.name)
+        return file_response(request, html_file, "text/html", filename=html_file.name)
+    except HTTPException:
+        raise
     except Exception as e:
         _log.error(f"Error retrieving HTML: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -168,90 +598,348 @@ async def get_html(request: Request):
 @app.get("/get-pdf/")
 async def get_pdf(request: Request):
     """
-    Возвращает PDF-файл.
+    Возвращает PDF-файл. Поддерживает ETag/If-None-Match и Range.
     """
     try:
-        # Извлекаем session_id из куки
-        session_id = request.cookies.get("session_id")
-        _log.info(f"Session ID from cookies: {session_id}")
-        if not session_id:
-            raise HTTPException(status_code=400, detail="Session ID not found in cookies.")
-
-        session = sessions.get(session_id)
-        if not session:
-            raise HTTPException(status_code=404, detail="Session not found.")
+        session = _get_session(request)
 
         pdf_file = session.get("pdf_file")
         if not pdf_file:
             raise HTTPException(status_code=404, detail="PDF file not found.")
 
-        return FileResponse(pdf_file, media_type="application/pdf", filename=pdf_file.name)
+        return file_response(request, pdf_file, "application/pdf", filename=pdf_file.name)
+    except HTTPException:
+        raise
     except Exception as e:
         _log.error(f"Error retrieving PDF: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _zip_response(files, filename, compression):
+    """
+    Потоковый ZIP-ответ: архив собирается по частям во время отправки.
+    """
+    return StreamingResponse(
+        iter_zip(files, compression),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 @app.get("/get-png/")
 async def get_png(request: Request):
     """
     Возвращает ZIP-архив с PNG-изображениями.
     """
     try:
-        # Извлекаем session_id из куки
-        session_id = request.cookies.get("session_id")
-        _log.info(f"Session ID from cookies: {session_id}")
-        if not session_id:
-            raise HTTPException(status_code=400, detail="Session ID not found in cookies.")
-
-        session = sessions.get(session_id)
-        if not session:
-            raise HTTPException(status_code=404, detail="Session not found.")
+        session = _get_session(request)
 
         images_dir = session.get("images_dir")
         if not images_dir:
             raise HTTPException(status_code=404, detail="PNG images not found.")
 
-        # Создаем ZIP-архив с PNG-изображениями
-        zip_path = images_dir.parent / "images.zip"
-        with pyzipper.AESZipFile(zip_path, 'w', compression=pyzipper.ZIP_DEFLATED, allowZip64=True) as zipf:
-            for file in images_dir.glob("*.png"):
-                zipf.write(file, file.name)
-
-        return FileResponse(zip_path, media_type="application/zip", filename=zip_path.name)
+        # PNG уже сжаты, поэтому архив передается потоком без повторного сжатия
+        files = sorted(images_dir.glob("*.png"))
+        return _zip_response(files, "images.zip", ZIP_COMPRESSION["stored"])
+    except HTTPException:
+        raise
     except Exception as e:
         _log.error(f"Error retrieving PNG: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Содержимое архива эмбеддингов: pages - постраничные .npy float32 (прежний формат),
+# store - хранилище store_*.npy и store_manifest.json (EMBEDDING_FORMAT store или both)
+EMBEDDING_LAYOUTS = ("pages", "store")
+
 @app.get("/get-embeddings/")
-async def get_embeddings(request: Request):
+async def get_embeddings(
+    request: Request,
+    compression: str = Query(default="deflated", description="ZIP compression for .npy files: stored or deflated"),
+    layout: str = Query(default="pages", description="pages: one float32 .npy per page (legacy); store: memory-mappable store files and manifest")
+):
     """
     Возвращает ZIP-архив с эмбеддингами.
     """
     try:
-        # Извлекаем session_id из куки
-        session_id = request.cookies.get("session_id")
-        _log.info(f"Session ID from cookies: {session_id}")
-        if not session_id:
-            raise HTTPException(status_code=400, detail="Session ID not found in cookies.")
+        session = _get_session(request)
+
+        embeddings_dir = session.get("embeddings_dir")
+        if not embeddings_dir:
+            raise HTTPException(status_code=404, detail="Embeddings not found.")
+
+        if compression not in ZIP_COMPRESSION:
+            raise HTTPException(status_code=400, detail=f"compression must be one of {', '.join(ZIP_COMPRESSION)}.")
+        if layout not in EMBEDDING_LAYOUTS:
+            raise HTTPException(status_code=400, detail=f"layout must be one of {', '.join(EMBEDDING_LAYOUTS)}.")
+
+        store_files = [embeddings_dir / name for name in (STORE_EMBEDDINGS, STORE_POOLED, STORE_MANIFEST)]
+        if layout == "store":
+            files = [path for path in store_files if path.exists()]
+        else:
+            files = sorted((path for path in embeddings_dir.glob("*.npy") if path not in store_files),
+                           key=page_sort_key)
+        if not files:
+            raise HTTPException(status_code=404, detail=f"Embeddings with layout={layout} not found.")
+        return _zip_response(files, "embeddings.zip", ZIP_COMPRESSION[compression])
+    except HTTPException:
+        raise
+    except Exception as e:
+        _log.error(f"Error retrieving embeddings: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def _page_file(directory: Path, page_no: int, pattern: str):
+    """
+    Файл страницы page_no (<документ>-<номер>.<расширение>) в директории или None.
+    """
+    for path in directory.glob(pattern):
+        if page_number_from_name(path) == page_no:
+            return path
+    return None
+
+def _load_page_embedding(embeddings_dir: Path, page_no: int, pooled: bool):
+    """
+    Эмбеддинг страницы из хранилища или из отдельного .npy (EMBEDDING_FORMAT = "npy") либо None.
+    """
+    if EmbeddingStore.exists(embeddings_dir):
+        embedding = EmbeddingStore(embeddings_dir).get(page_no, pooled=pooled)
+        if embedding is not None:
+            return np.ascontiguousarray(embedding)
+    path = _page_file(embeddings_dir, page_no, "*.npy")
+    if path is None:
+        return None
+    embedding = np.load(path)
+    if embedding.ndim == 3:
+        embedding = embedding[0]
+    return np.ascontiguousarray(embedding.mean(axis=0) if pooled else embedding)
+
+@app.get("/get-png/{page_no}")
+async def get_page_png(request: Request, page_no: int):
+    """
+    Возвращает PNG одной страницы с ETag/If-None-Match и Range.
+    """
+    try:
+        session = _get_session(request)
+
+        images_dir = session.get("images_dir")
+        page_file = _page_file(images_dir, page_no, "*.png") if images_dir else None
+        if not page_file:
+            raise HTTPException(status_code=404, detail="Page image not found.")
+
+        return file_response(request, page_file, "image/png")
+    except HTTPException:
+        raise
+    except Exception as e:
+        _log.error(f"Error retrieving page PNG: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-        session = sessions.get(session_id)
-        if not session:
-            raise HTTPException(status_code=404, detail="Session not found.")
+# Форматы эмбеддинга страницы: npy - файл NumPy, raw - байты массива (C-порядок),
+# форма и тип в заголовках X-Embedding-Shape и X-Embedding-Dtype
+PAGE_EMBEDDING_FORMATS = ("npy", "raw")
+
+@app.get("/get-embeddings/{page_no}")
+async def get_page_embedding(
+    request: Request,
+    page_no: int,
+    pooled: bool = Query(default=False, description="Return the mean-pooled page vector instead of token embeddings"),
+    array_format: str = Query(default="npy", alias="format", description="npy: NumPy .npy file; raw: array bytes, shape and dtype in X-Embedding-* headers")
+):
+    """
+    Возвращает эмбеддинг одной страницы (или ее усредненный вектор) с ETag/If-None-Match и Range.
+    """
+    if array_format not in PAGE_EMBEDDING_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(PAGE_EMBEDDING_FORMATS)}.")
+
+    try:
+        session = _get_session(request)
 
         embeddings_dir = session.get("embeddings_dir")
         if not embeddings_dir:
             raise HTTPException(status_code=404, detail="Embeddings not found.")
 
-        # Создаем ZIP-архив с эмбеддингами
-        zip_path = embeddings_dir.parent / "embeddings.zip"
-        with pyzipper.AESZipFile(zip_path, 'w', compression=pyzipper.ZIP_DEFLATED, allowZip64=True) as zipf:
-            for file in embeddings_dir.glob("*.npy"):
-                zipf.write(file, file.name)
+        embedding = await run_in_threadpool(_load_page_embedding, embeddings_dir, page_no, pooled)
+        if embedding is None:
+            raise HTTPException(status_code=404, detail="Page embedding not found.")
+
+        if array_format == "npy":
+            buffer = io.BytesIO()
+            np.save(buffer, embedding)
+            data = buffer.getvalue()
+        else:
+            data = embedding.tobytes()
+        headers = {"X-Embedding-Shape": ",".join(str(dim) for dim in embedding.shape),
+                   "X-Embedding-Dtype": str(embedding.dtype)}
+        return bytes_response(request, data, "application/octet-stream", headers=headers)
+    except HTTPException:
+        raise
+    except Exception as e:
+        _log.error(f"Error retrieving page embedding: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-        return FileResponse(zip_path, media_type="application/zip", filename=zip_path.name)
+def _session_page_vector(session_id: str, page: int):
+    """
+    Усредненный вектор страницы сессии для запроса /search.
+    """
+    session = sessions.get(session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found.")
+    embeddings_dir = session.get("embeddings_dir")
+    query = _load_page_embedding(embeddings_dir, page, pooled=True) if embeddings_dir else None
+    if query is None:
+        raise HTTPException(status_code=404, detail="Page embedding not found.")
+    return query
+
+@app.post("/search")
+async def search(
+    request: Request,
+    file: UploadFile = File(default=None, description="Query image"),
+    session_id: str = Query(default=None, description="Session of the query page"),
+    page: int = Query(default=None, description="Query page number within session_id"),
+    k: int = Query(default=10, ge=1, le=1000),
+    mode: str = Query(default=None, description="exact, ivf or auto; defaults to the index mode")
+):
+    """
+    Ищет страницы, похожие на изображение или на страницу из другой сессии,
+    по всем обработанным сессиям. Документы в результатах обозначены search_id;
+    session_id возвращается только для сессии из куки вызывающего.
+    """
+    if mode is not None and mode not in INDEX_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(INDEX_MODES)}.")
+
+    try:
+        embed_seconds = None
+        if file is not None:
+            start_time = time.perf_counter()
+            try:
+                query = await run_in_threadpool(get_pooled_image_embedding, file.file)
+            except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+                raise HTTPException(status_code=400, detail=f"Query image cannot be decoded: {e}")
+            embed_seconds = time.perf_counter() - start_time
+        elif session_id is not None and page is not None:
+            query = await run_in_threadpool(_session_page_vector, session_id, page)
+        else:
+            raise HTTPException(status_code=400, detail="Provide a query image or session_id and page.")
+
+        await run_in_threadpool(_sync_index)
+        results = await run_in_threadpool(vector_index.search, query, k, mode)
+        own_session = request.cookies.get("session_id")
+        return {
+            "results": [{"search_id": vector_index.label(doc_id),
+                         "session_id": doc_id if doc_id == own_session else None,
+                         "page": page_no, "score": score}
+                        for doc_id, page_no, score in results],
+            "embed_seconds": embed_seconds,
+            "query_seconds": vector_index.last_query_seconds,
+            "index": vector_index.stats()
+        }
+    except HTTPException:
+        raise
     except Exception as e:
-        _log.error(f"Error retrieving embeddings: {e}")
+        _log.error(f"Error searching pages: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/search/stats")
+async def get_search_stats():
+    """
+    Размер индекса, время построения и запросов.
+    """
+    return vector_index.stats()
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Метрики в формате Prometheus: гистограммы этапов конвейера и состояние сервиса.
+    """
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/sessions/stats")
+async def get_session_stats():
+    """
+    Число живых сессий и занятый ими объем диска.
+    """
+    return sessions.stats()
+
+@app.get("/admission/stats")
+async def get_admission_stats():
+    """
+    Обрабатываемые и ожидающие задачи, лимиты допуска и число отказов.
+    """
+    return admission.stats()
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """
+    Счетчики кэша результатов: попадания, промахи, вытеснения и занятый объем.
+    """
+    return result_cache.stats()
+
+@app.get("/cache/pages/stats")
+async def get_page_cache_stats():
+    """
+    Статистика кэша эмбеддингов страниц.
+    """
+    page_cache = get_page_cache()
+    return page_cache.stats() if page_cache is not None else {"enabled": False}
+
+@app.get("/converters/stats")
+async def get_converter_stats():
+    """
+    Время создания и прогрева конвертеров docling.
+    """
+    return converter_registry.stats()
+
+@app.get("/images/stats")
+async def get_image_stats():
+    """
+    Число записанных изображений, время и объем по форматам (utils.image_writer).
+    """
+    return image_writer.stats()
+
+@app.get("/ready")
+async def ready():
+    """
+    Готовность к обработке: модели загружены (или их загрузка отключена).
+    В отличие от /, пока идет загрузка, отвечает 503.
+    """
+    content = dict(startup_state, embedding_model_loaded=model_loaded(),
+                   converters=len(converter_registry.stats()))
+    status_code = 200 if startup_state["status"] == "ready" else 503
+    return JSONResponse(status_code=status_code, content=content)
+
+async def _load_models():
+    """
+    Загружает модель эмбеддингов и прогревает конвертеры, не блокируя запуск сервера.
+    """
+    startup_state["status"] = "loading"
+    start_time = time.time()
+    try:
+        if PRELOAD_MODELS:
+            _log.info("Loading embedding model...")
+            await run_in_threadpool(load_model)
+        if WARMUP_CONVERTERS:
+            _log.info("Warming up document converters...")
+            await run_in_threadpool(warmup_converters)
+        startup_state["status"] = "ready"
+    except Exception as e:
+        _log.error(f"Error loading models: {e}")
+        startup_state["status"] = "failed"
+        startup_state["error"] = str(e)
+    startup_state["seconds"] = round(time.time() - start_time, 2)
+
+@app.on_event("startup")
+async def warmup():
+    app.state.warmup_task = asyncio.create_task(_load_models())
+
+@app.on_event("startup")
+async def start_reaper():
+    app.state.reaper_task = asyncio.create_task(_reaper_loop())
+
+@app.on_event("shutdown")
+async def shutdown_jobs():
+    for task_name in ("reaper_task", "warmup_task"):
+        task = getattr(app.state, task_name, None)
+        if task:
+            task.cancel()
+    job_manager.shutdown()
+    shutdown_renderer()
+
 @app.get("/")
 async def root():
     return {"message": "Service is running!"}
\ No newline at end of file
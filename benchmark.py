@@ -0,0 +1,449 @@
+"""
+Офлайн-бенчмарк конвейера на синтетических документах.
+
+    python benchmark.py run --formats docx,pptx,xlsx,pdf --pages 20 --repeat 3 --output run.json
+    python benchmark.py compare baseline.json run.json --threshold 0.1
+    python benchmark.py import-budget --module app --budget 3
+    python benchmark.py accuracy --backends int8,onnx --pages 20 --min-cosine 0.99
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from utils.metrics import stage_span, peak_rss_bytes
+
+_log = logging.getLogger(__name__)
+
+FORMATS = ("docx", "pptx", "xlsx", "pdf")
+PERCENTILES = (50, 90, 99)
+
+# Модули, которые не должны загружаться при импорте приложения
+HEAVY_MODULES = ("torch", "torchvision", "transformers", "docling", "docling_core", "onnxruntime")
+
+LOREM = (
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt "
+    "ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco "
+    "laboris nisi ut aliquip ex ea commodo consequat."
+)
+
+
+def make_docx(path, pages):
+    from docx import Document
+
+    document = Document()
+    for page in range(1, pages + 1):
+        document.add_heading(f"Section {page}", level=1)
+        for _ in range(4):
+            document.add_paragraph(LOREM)
+        table = document.add_table(rows=4, cols=4)
+        for row_index, row in enumerate(table.rows):
+            for col_index, cell in enumerate(row.cells):
+                cell.text = f"{page}.{row_index}.{col_index}"
+        if page < pages:
+            document.add_page_break()
+    document.save(path)
+
+
+def make_pptx(path, pages):
+    from pptx import Presentation
+    from pptx.util import Inches
+
+    presentation = Presentation()
+    layout = presentation.slide_layouts[1]
+    for page in range(1, pages + 1):
+        slide = presentation.slides.add_slide(layout)
+        slide.shapes.title.text = f"Slide {page}"
+        body = slide.placeholders[1].text_frame
+        body.text = LOREM[:80]
+        for line in range(3):
+            body.add_paragraph().text = f"Point {page}.{line}: {LOREM[:60]}"
+        slide.shapes.add_shape(1, Inches(6), Inches(5), Inches(2), Inches(1))
+    presentation.save(path)
+
+
+def make_xlsx(path, pages):
+    from openpyxl import Workbook
+
+    workbook = Workbook()
+    workbook.remove(workbook.active)
+    for page in range(1, pages + 1):
+        sheet = workbook.create_sheet(f"Sheet{page}")
+        sheet.append(["id", "name", "value", "ratio"])
+        for row in range(1, 41):
+            sheet.append([row, f"item-{page}-{row}", row * page, round(row / (page + 1), 4)])
+    workbook.save(path)
+
+
+def make_pdf(path, pages):
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    pdf = canvas.Canvas(str(path), pagesize=A4)
+    width, height = A4
+    for page in range(1, pages + 1):
+        pdf.setFont("Helvetica-Bold", 20)
+        pdf.drawString(72, height - 72, f"Page {page}")
+        pdf.setFont("Helvetica", 11)
+        y = height - 110
+        for line in range(30):
+            pdf.drawString(72, y, f"{line:02d} {LOREM[:90]}")
+            y -= 18
+        pdf.rect(72, 72, width - 144, 80)
+        pdf.showPage()
+    pdf.save()
+
+
+GENERATORS = {
+    "docx": make_docx,
+    "pptx": make_pptx,
+    "xlsx": make_xlsx,
+    "pdf": make_pdf,
+}
+
+
+def percentile(values, pct):
+    """
+    Перцентиль с линейной интерполяцией.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(values):
+    summary = {f"p{pct}": percentile(values, pct) for pct in PERCENTILES}
+    summary["mean"] = sum(values) / len(values) if values else None
+    summary["n"] = len(values)
+    return summary
+
+
+def _count_pages(images_dir):
+    return len(list(Path(images_dir).glob("*.png")))
+
+
+def run_end_to_end(input_path, work_dir, render_mode, html_mode=None):
+    """
+    Прогон main.main. Возвращает время, число страниц и замеры этапов.
+    """
+    from main import main as run_pipeline, HTML_MODE
+
+    start_time = time.perf_counter()
+    result = run_pipeline(input_path, work_dir, render_mode=render_mode, html_mode=html_mode or HTML_MODE)
+    seconds = time.perf_counter() - start_time
+    return {"seconds": seconds, "pages": _count_pages(work_dir / "images"), "spans": result["timings"]}
+
+
+def run_stages(input_path, work_dir):
+    """
+    Прогон каждой функции этапа по отдельности на полном пути MD -> HTML -> PDF -> PNG.
+    """
+    from document_to_md import convert_document_to_md
+    from md_to_html import convert_markdown_to_html
+    from html_to_pdf import generate_pdf
+    from pdf_to_png import render_pdf_to_png
+    from png_to_embeddings import process_images_for_embeddings
+    from main import IMAGE_RESOLUTION_SCALE, WKHTMLTOPDF_PATH
+
+    doc_type = input_path.suffix.lstrip(".")
+    spans = []
+    images_dir = work_dir / "images"
+    embeddings_dir = work_dir / "embeddings"
+    images_dir.mkdir(parents=True, exist_ok=True)
+
+    with stage_span("convert_document_to_md", doc_type, spans=spans):
+        md_file = convert_document_to_md(input_path, work_dir, IMAGE_RESOLUTION_SCALE)
+    html_file = work_dir / "bench.html"
+    with stage_span("convert_markdown_to_html", doc_type, spans=spans):
+        if not convert_markdown_to_html(md_file, html_file):
+            raise RuntimeError("convert_markdown_to_html failed")
+    pdf_file = work_dir / "bench.pdf"
+    with stage_span("generate_pdf", doc_type, spans=spans):
+        if not generate_pdf(html_file, pdf_file, WKHTMLTOPDF_PATH):
+            raise RuntimeError("generate_pdf failed")
+    with stage_span("render_pdf_to_png", doc_type, spans=spans) as span:
+        if not render_pdf_to_png(pdf_file, images_dir):
+            raise RuntimeError("render_pdf_to_png failed")
+        span.pages = _count_pages(images_dir)
+    with stage_span("process_images_for_embeddings", doc_type, spans=spans) as span:
+        process_images_for_embeddings(images_dir, embeddings_dir)
+        span.pages = _count_pages(images_dir)
+    return spans
+
+
+def configure_page_cache(enabled):
+    """
+    Кэш эмбеддингов страниц по умолчанию выключен: синтетические документы детерминированы,
+    и повторы брали бы эмбеддинги из кэша вместо их расчета. --page-cache включает его обратно.
+    Кэш результатов main.main не использует (он есть только в app.py).
+    """
+    import png_to_embeddings
+
+    png_to_embeddings.PAGE_CACHE_ENABLED = enabled
+
+
+def command_run(args):
+    formats = [fmt.strip() for fmt in args.formats.split(",") if fmt.strip()]
+    unknown = [fmt for fmt in formats if fmt not in GENERATORS]
+    if unknown:
+        raise SystemExit(f"Unknown formats: {', '.join(unknown)}")
+
+    configure_page_cache(args.page_cache)
+    work_root = Path(args.workdir)
+    work_root.mkdir(parents=True, exist_ok=True)
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"pages": args.pages, "repeat": args.repeat, "render_mode": args.render_mode,
+                   "html_mode": args.html_mode,
+                   "formats": formats, "stages": args.stages, "page_cache": args.page_cache},
+        "environment": {"python": sys.version.split()[0], "platform": platform.platform(),
+                        "cpu_count": os.cpu_count()},
+        "formats": {},
+    }
+
+    for fmt in formats:
+        input_path = work_root / f"synthetic-{args.pages}p.{fmt}"
+        GENERATORS[fmt](input_path, args.pages)
+        e2e_seconds, pages_per_sec, stage_seconds, peak_rss = [], [], {}, []
+        failures = []
+
+        for attempt in range(args.repeat):
+            run_dir = work_root / f"{fmt}-{attempt}"
+            shutil.rmtree(run_dir, ignore_errors=True)
+            try:
+                if args.stages:
+                    spans = run_stages(input_path, run_dir / "stages")
+                else:
+                    spans = []
+                outcome = run_end_to_end(input_path, run_dir / "e2e", args.render_mode, args.html_mode)
+            except Exception as e:
+                _log.error(f"{fmt} run {attempt} failed: {e}")
+                failures.append(str(e))
+                continue
+
+            e2e_seconds.append(outcome["seconds"])
+            if outcome["seconds"] > 0:
+                pages_per_sec.append(outcome["pages"] / outcome["seconds"])
+            for span in outcome["spans"] + spans:
+                stage_seconds.setdefault(span["stage"], []).append(span["duration_seconds"])
+                if span["peak_rss_bytes"] is not None:
+                    peak_rss.append(span["peak_rss_bytes"])
+            if not args.keep:
+                shutil.rmtree(run_dir, ignore_errors=True)
+
+        report["formats"][fmt] = {
+            "input_bytes": input_path.stat().st_size,
+            "end_to_end_seconds": summarize(e2e_seconds),
+            "pages_per_sec": summarize(pages_per_sec),
+            "stages": {stage: summarize(values) for stage, values in stage_seconds.items()},
+            "peak_rss_bytes": max(peak_rss) if peak_rss else None,
+            "failures": failures,
+        }
+        _log.info(f"{fmt}: {report['formats'][fmt]['end_to_end_seconds']}")
+
+    report["process_peak_rss_bytes"] = peak_rss_bytes()
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text, encoding="utf-8")
+    print(text)
+    return 0
+
+
+def _relative_change(old, new):
+    if old in (None, 0) or new is None:
+        return None
+    return (new - old) / old
+
+
+def compare_reports(baseline, candidate, threshold):
+    """
+    Сравнивает два отчета. Возвращает строки сравнения и число регрессий.
+    Регрессия - рост латентности или падение pages/sec больше threshold.
+    """
+    rows = []
+    regressions = 0
+    for fmt, new in candidate["formats"].items():
+        old = baseline["formats"].get(fmt)
+        if old is None:
+            continue
+        metrics = [("end_to_end p50", old["end_to_end_seconds"]["p50"], new["end_to_end_seconds"]["p50"], False),
+                   ("pages/sec p50", old["pages_per_sec"]["p50"], new["pages_per_sec"]["p50"], True)]
+        for stage, summary in new["stages"].items():
+            if stage in old["stages"]:
+                metrics.append((f"{stage} p50", old["stages"][stage]["p50"], summary["p50"], False))
+        metrics.append(("peak RSS", old["peak_rss_bytes"], new["peak_rss_bytes"], False))
+
+        for name, old_value, new_value, higher_is_better in metrics:
+            change = _relative_change(old_value, new_value)
+            regressed = change is not None and (-change if higher_is_better else change) > threshold
+            regressions += regressed
+            rows.append({"format": fmt, "metric": name, "baseline": old_value, "candidate": new_value,
+                         "change": change, "regression": regressed})
+    return rows, regressions
+
+
+def command_compare(args):
+    baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+    candidate = json.loads(Path(args.candidate).read_text(encoding="utf-8"))
+    rows, regressions = compare_reports(baseline, candidate, args.threshold)
+
+    def fmt_value(value):
+        return "-" if value is None else f"{value:.4g}"
+
+    print(f"{'format':<6} {'metric':<40} {'baseline':>12} {'candidate':>12} {'change':>9}")
+    for row in rows:
+        change = "-" if row["change"] is None else f"{row['change']:+.1%}"
+        marker = "  REGRESSION" if row["regression"] else ""
+        print(f"{row['format']:<6} {row['metric']:<40} {fmt_value(row['baseline']):>12} "
+              f"{fmt_value(row['candidate']):>12} {change:>9}{marker}")
+    print(f"{regressions} regression(s) above {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+heavy = sorted(name for name in {heavy!r} if name in sys.modules)
+print(json.dumps({{"seconds": seconds, "heavy_modules": heavy}}))
+"""
+
+
+def measure_import(module):
+    """
+    Время импорта module в чистом интерпретаторе и загруженные им тяжелые модули.
+    """
+    probe = IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)
+    completed = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True,
+                               cwd=Path(__file__).resolve().parent)
+    if completed.returncode != 0:
+        raise RuntimeError(f"import {module} failed: {completed.stderr.strip()}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def command_import_budget(args):
+    """
+    Проверяет, что импорт приложения укладывается в бюджет времени
+    и не загружает torch, transformers и docling. Код возврата 1 при нарушении.
+    """
+    timings = []
+    for _ in range(args.repeat):
+        outcome = measure_import(args.module)
+        timings.append(outcome["seconds"])
+    best = min(timings)
+    heavy = outcome["heavy_modules"]
+    print(f"import {args.module}: {best:.3f} s (best of {args.repeat}), budget {args.budget:.3f} s")
+    failed = False
+    if heavy:
+        print(f"Heavy modules imported: {', '.join(heavy)}")
+        failed = True
+    if best > args.budget:
+        print("Import time is over budget")
+        failed = True
+    return 1 if failed else 0
+
+
+def command_accuracy(args):
+    """
+    Сравнивает бэкенды инференса с эталонной моделью fp32 на страницах синтетического PDF
+    или на PNG из --images. Код возврата 1, если сходство ниже --min-cosine.
+    """
+    from png_to_embeddings import check_accuracy, set_torch_threads
+    from utils.embedding_store import page_sort_key
+    from utils.pdf_raster import rasterize_pdf
+
+    if args.images:
+        image_paths = sorted(Path(args.images).glob("*.png"), key=page_sort_key)
+    else:
+        work_root = Path(args.workdir)
+        work_root.mkdir(parents=True, exist_ok=True)
+        pdf_path = work_root / f"synthetic-{args.pages}p.pdf"
+        make_pdf(pdf_path, args.pages)
+        image_paths = sorted((Path(path) for path in rasterize_pdf(pdf_path, work_root / "accuracy_images")),
+                             key=page_sort_key)
+    if not image_paths:
+        raise SystemExit("No page images to compare")
+
+    set_torch_threads(args.torch_threads)
+    reports = []
+    failed = False
+    for backend in [name.strip() for name in args.backends.split(",") if name.strip()]:
+        try:
+            report = check_accuracy(image_paths, backend, batch_size=args.batch_size)
+        except Exception as e:
+            _log.error(f"Backend {backend} failed: {e}")
+            reports.append({"backend": backend, "error": str(e)})
+            failed = True
+            continue
+        report["passed"] = report["pooled_cosine_min"] >= args.min_cosine
+        failed = failed or not report["passed"]
+        reports.append(report)
+
+    text = json.dumps(reports, indent=2)
+    if args.output:
+        Path(args.output).write_text(text, encoding="utf-8")
+    print(text)
+    return 1 if failed else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Pipeline benchmark on synthetic documents.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="Generate synthetic documents and benchmark the pipeline.")
+    run.add_argument("--formats", default=",".join(FORMATS), help="Comma-separated: docx,pptx,xlsx,pdf")
+    run.add_argument("--pages", type=int, default=10, help="Pages (slides, sheets) per document")
+    run.add_argument("--repeat", type=int, default=3)
+    run.add_argument("--render-mode", default="auto", choices=("auto", "normalized"))
+    run.add_argument("--html-mode", default="docling", choices=("docling", "pandoc"),
+                     help="How the full path builds HTML: straight from docling or via pandoc")
+    run.add_argument("--stages", action="store_true", help="Also time each stage function separately")
+    run.add_argument("--page-cache", action="store_true",
+                     help="Use the page embedding cache (off by default so repeats compute embeddings)")
+    run.add_argument("--workdir", default="bench_tmp")
+    run.add_argument("--output", help="Write the JSON report to this file")
+    run.add_argument("--keep", action="store_true", help="Keep generated artifacts")
+    run.set_defaults(func=command_run)
+
+    compare = subparsers.add_parser("compare", help="Compare two JSON reports.")
+    compare.add_argument("baseline")
+    compare.add_argument("candidate")
+    compare.add_argument("--threshold", type=float, default=0.1, help="Relative change treated as a regression")
+    compare.set_defaults(func=command_compare)
+
+    budget = subparsers.add_parser("import-budget", help="Check import time and heavy imports of the app.")
+    budget.add_argument("--module", default="app")
+    budget.add_argument("--budget", type=float, default=3.0, help="Seconds allowed for the import")
+    budget.add_argument("--repeat", type=int, default=3)
+    budget.set_defaults(func=command_import_budget)
+
+    accuracy = subparsers.add_parser("accuracy", help="Compare embedding backends against the fp32 model.")
+    accuracy.add_argument("--backends", default="int8,torchscript,onnx,bf16",
+                          help="Comma-separated: int8,torchscript,onnx,bf16")
+    accuracy.add_argument("--images", help="Directory with page PNGs; a synthetic PDF is used by default")
+    accuracy.add_argument("--pages", type=int, default=16)
+    accuracy.add_argument("--batch-size", type=int, default=16)
+    accuracy.add_argument("--torch-threads", type=int)
+    accuracy.add_argument("--min-cosine", type=float, default=0.99,
+                          help="Minimum cosine similarity of pooled page vectors")
+    accuracy.add_argument("--workdir", default="bench_tmp")
+    accuracy.add_argument("--output", help="Write the JSON report to this file")
+    accuracy.set_defaults(func=command_accuracy)
+    return parser
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    arguments = build_parser().parse_args()
+    sys.exit(arguments.func(arguments))
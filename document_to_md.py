@@ -2,35 +2,43 @@ import os
 import logging
 import time
 from pathlib import Path
-from docling.backend.mspowerpoint_backend import MsPowerpointDocumentBackend
-from docling.backend.pypdfium2_backend import PyPdfiumDocumentBackend
-from docling.pipeline.simple_pipeline import SimplePipeline
-from docling_core.types.doc import ImageRefMode, PictureItem, TableItem
-from docling.datamodel.base_models import InputFormat
-from docling.datamodel.pipeline_options import PdfPipelineOptions
-from docling.document_converter import DocumentConverter, PdfFormatOption, WordFormatOption, \
-    ExcelFormatOption, PowerpointFormatOption, HTMLFormatOption, ImageFormatOption
+from md_to_html import save_styled_html
+from pdf_to_png import save_page_images
+from utils.converter_registry import registry
+from utils.image_writer import get_image_writer
 
 _log = logging.getLogger(__name__)
 
-def convert_document_to_md(input_doc_path, output_dir, image_resolution_scale=2.0, include_images=True):
+# Поддерживаемые форматы - значения docling InputFormat.
+# Сам docling импортируется при первом создании конвертера, а не при импорте модуля.
+ALLOWED_FORMATS = [
+    "pdf",
+    "docx",
+    "html",
+    "pptx",
+    "xlsx",
+    "image",
+]
+
+def build_document_converter(image_resolution_scale=2.0):
     """
-    Конвертирует документ в Markdown.
+    Создает DocumentConverter со всеми поддерживаемыми форматами.
     """
+    from docling.backend.mspowerpoint_backend import MsPowerpointDocumentBackend
+    from docling.backend.pypdfium2_backend import PyPdfiumDocumentBackend
+    from docling.pipeline.simple_pipeline import SimplePipeline
+    from docling.datamodel.base_models import InputFormat
+    from docling.datamodel.pipeline_options import PdfPipelineOptions
+    from docling.document_converter import DocumentConverter, PdfFormatOption, WordFormatOption, \
+        ExcelFormatOption, PowerpointFormatOption, HTMLFormatOption, ImageFormatOption
+
     pipeline_options = PdfPipelineOptions()
     pipeline_options.images_scale = image_resolution_scale
     pipeline_options.generate_page_images = True
     pipeline_options.generate_picture_images = True
 
-    doc_converter = DocumentConverter(
-        allowed_formats=[
-            InputFormat.PDF,
-            InputFormat.DOCX,
-            InputFormat.HTML,
-            InputFormat.PPTX,
-            InputFormat.XLSX,
-            InputFormat.IMAGE,
-        ],
+    return DocumentConverter(
+        allowed_formats=[InputFormat(input_format) for input_format in ALLOWED_FORMATS],
         format_options={
             InputFormat.PDF: PdfFormatOption(
                 pipeline_options=pipeline_options,
@@ -56,50 +64,155 @@ def convert_document_to_md(input_doc_path, output_dir, image_resolution_scale=2.
         },
     )
 
+def get_document_converter(image_resolution_scale=2.0, warm=False):
+    """
+    Возвращает общий для процесса конвертер из реестра.
+    При warm=True заранее инициализирует пайплайны всех форматов.
+    """
+    warm_formats = ()
+    if warm:
+        from docling.datamodel.base_models import InputFormat
+
+        warm_formats = [InputFormat(input_format) for input_format in ALLOWED_FORMATS]
+    return registry.get(
+        "document",
+        (image_resolution_scale,),
+        lambda: build_document_converter(image_resolution_scale),
+        warm_formats=warm_formats,
+    )
+
+# Режимы изображений в Markdown
+IMAGE_MODES = ("embedded", "referenced")
+
+# Форматы, для которых docling сам отрисовывает страницы
+PAGE_IMAGE_FORMATS = ("pdf", "image")
+
+def _reference_image(element, image, filename, mimetype="image/png"):
+    """
+    Направляет ссылку изображения элемента на сохраненный рядом с Markdown файл.
+    """
+    from docling_core.types.doc import ImageRef, Size
+
+    if element.image is not None:
+        element.image.uri = Path(filename)
+        element.image.mimetype = mimetype
+    else:
+        element.image = ImageRef(
+            mimetype=mimetype,
+            dpi=72,
+            size=Size(width=image.width, height=image.height),
+            uri=Path(filename),
+        )
+
+def export_document_html(document, html_file, include_images=True, image_mode="embedded"):
+    """
+    Сохраняет HTML напрямую из DoclingDocument, без Markdown и pandoc.
+    Изображения встраиваются или ссылаются так же, как в Markdown.
+    Возвращает True при успехе.
+    """
+    from docling_core.types.doc import ImageRefMode
+
+    if not include_images:
+        html_image_mode = ImageRefMode.PLACEHOLDER
+    elif image_mode == "referenced":
+        html_image_mode = ImageRefMode.REFERENCED
+    else:
+        html_image_mode = ImageRefMode.EMBEDDED
+    try:
+        save_styled_html(document.export_to_html(image_mode=html_image_mode), html_file)
+        _log.info(f"HTML exported from the document to {html_file}")
+        return True
+    except Exception as e:
+        _log.error(f"Error exporting document to HTML {html_file}: {e}")
+        return False
+
+def convert_document_to_md(input_doc_path, output_dir, image_resolution_scale=2.0, include_images=True,
+                           page_images_dir=None, image_mode="embedded", html_file=None, page_images=None):
+    """
+    Конвертирует документ в Markdown.
+    image_mode: embedded - изображения встраиваются в base64;
+    referenced - Markdown ссылается на PNG, сохраненные рядом с ним.
+    Если задан page_images_dir и формат входа из PAGE_IMAGE_FORMATS,
+    изображения страниц из той же конвертации сохраняются туда в PNG.
+    Если вместо этого передан список page_images, страницы добавляются в него
+    как (номер страницы, имя PNG, PIL.Image) без записи на диск.
+    Если задан html_file, тот же документ сохраняется и в HTML (см. export_document_html).
+    """
+    if image_mode not in IMAGE_MODES:
+        raise ValueError(f"image_mode must be one of {IMAGE_MODES}, got {image_mode}")
+    from docling_core.types.doc import ImageRefMode, PictureItem, TableItem
+
+    doc_converter = get_document_converter(image_resolution_scale)
+
     start_time = time.time()
     conv_res = doc_converter.convert(input_doc_path)
     output_dir.mkdir(parents=True, exist_ok=True)
     doc_filename = conv_res.input.file.stem
 
+    if page_images is not None and conv_res.input.format in PAGE_IMAGE_FORMATS:
+        for page_no, page in conv_res.document.pages.items():
+            if page.image is not None and page.image.pil_image:
+                page_images.append((page_no, f"{doc_filename}-{page_no}.png", page.image.pil_image))
+            else:
+                _log.warning(f"No image found for page {page_no}")
+        _log.info(f"{len(page_images)} page images kept in memory")
+    elif page_images_dir is not None and conv_res.input.format in PAGE_IMAGE_FORMATS:
+        page_images_dir.mkdir(parents=True, exist_ok=True)
+        pages_saved = save_page_images(conv_res.document, page_images_dir, doc_filename)
+        _log.info(f"{pages_saved} page images exported to {page_images_dir}")
+
     table_counter = 0
     picture_counter = 0
+    # Картинки и таблицы кодируются в пуле потоков, пока идет обход документа
+    writer = get_image_writer()
+    mimetype = f"image/{writer.suffix.lstrip('.')}"
+    writes = []
 
     for element, _level in conv_res.document.iterate_items():
         _log.debug(f"Element type: {type(element)}")
         if isinstance(element, TableItem):
             table_counter += 1
-            element_image_filename = output_dir / f"{doc_filename}-table-{table_counter}.png"
+            element_image_filename = writer.path_for(output_dir / f"{doc_filename}-table-{table_counter}")
             image = element.get_image(conv_res.document)
             if image:
-                try:
-                    with element_image_filename.open("wb") as fp:
-                        image.save(fp, "PNG")
-                except Exception as e:
-                    print(f"Error saving image for table {table_counter}: {e}")
+                writes.append((f"table {table_counter}", writer.submit(image, element_image_filename)))
             else:
                 print(f"Warning: No image found for table {table_counter}")
 
         if isinstance(element, PictureItem):
             picture_counter += 1
-            element_image_filename = output_dir / f"{doc_filename}-picture-{picture_counter}.png"
+            element_image_filename = writer.path_for(output_dir / f"{doc_filename}-picture-{picture_counter}")
             image = element.get_image(conv_res.document)
             if image:
-                try:
-                    with element_image_filename.open("wb") as fp:
-                        image.save(fp, "PNG")
-                except Exception as e:
-                    print(f"Error saving image for picture {picture_counter}: {e}")
+                writes.append((f"picture {picture_counter}", writer.submit(image, element_image_filename)))
+                if include_images and image_mode == "referenced":
+                    _reference_image(element, image, element_image_filename.name, mimetype)
             else:
                 print(f"Warning: No image found for picture {picture_counter}")
 
+    for label, future in writes:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Error saving image for {label}: {e}")
+
     # Сохраняем Markdown с изображениями или без них
-    if include_images:
+    if include_images and image_mode == "referenced":
+        # Ссылки на уже сохраненные PNG вместо base64 внутри Markdown
+        md_filename = output_dir / f"{doc_filename}-with-image-refs.md"
+        md_filename.write_text(
+            conv_res.document.export_to_markdown(image_mode=ImageRefMode.REFERENCED), encoding="utf-8"
+        )
+    elif include_images:
         md_filename = output_dir / f"{doc_filename}-with-images.md"
         conv_res.document.save_as_markdown(md_filename, image_mode=ImageRefMode.EMBEDDED)
     else:
         md_filename = output_dir / f"{doc_filename}-without-images.md"
         conv_res.document.save_as_markdown(md_filename)
 
+    if html_file is not None:
+        export_document_html(conv_res.document, html_file, include_images, image_mode)
+
     end_time = time.time() - start_time
     _log.info(f"Document converted and figures exported in {end_time:.2f} seconds.")
     return md_filename
\ No newline at end of file
@@ -1,28 +1,237 @@
+import os
+import queue
+import shutil
 import subprocess
 import logging
+import multiprocessing
+import threading
+import time
 from pathlib import Path
+from urllib.parse import unquote
 
 _log = logging.getLogger(__name__)
 
-def generate_pdf(html_file, pdf_file, wkhtmltopdf_path, disable_javascript=False):
-    """
-    Конвертирует HTML в PDF с помощью wkhtmltopdf.
-    """
-    try:
-        command = [wkhtmltopdf_path, '--enable-local-file-access', html_file, pdf_file]
-        if disable_javascript:
-            command.append("--disable-javascript")
-
-        result = subprocess.run(command, capture_output=True, text=True, check=True, encoding='utf-8')
-        print("stdout:", result.stdout)
-        print("stderr:", result.stderr)
-        print(f"PDF successfully created: {pdf_file}")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error during execution wkhtmltopdf: {e}")
-        print("stdout:", e.stdout)
-        print("stderr:", e.stderr)
-        return False
-    except FileNotFoundError:
-        print(f"error: wkhtmltopdf not found at path {wkhtmltopdf_path}")
-        return False
\ No newline at end of file
+# Движки рендеринга HTML -> PDF:
+# wkhtmltopdf - внешний процесс на каждый документ, число одновременных процессов ограничено;
+# xhtml2pdf - рендеринг внутри долгоживущих рабочих процессов пула.
+PDF_ENGINES = ("wkhtmltopdf", "xhtml2pdf")
+PDF_ENGINE = os.environ.get("PDF_ENGINE", "wkhtmltopdf")
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", "2"))
+PDF_TIMEOUT_SECONDS = float(os.environ.get("PDF_TIMEOUT_SECONDS", "300"))
+WINDOWS_WKHTMLTOPDF_PATH = "D:\\wkhtmltox-0.12.6-1.mxe-cross-win64\\wkhtmltox\\bin\\wkhtmltopdf.exe"
+
+
+def find_wkhtmltopdf():
+    """
+    Путь к wkhtmltopdf: переменная WKHTMLTOPDF_PATH, затем PATH, затем прежний путь для Windows.
+    """
+    return os.environ.get("WKHTMLTOPDF_PATH") or shutil.which("wkhtmltopdf") or WINDOWS_WKHTMLTOPDF_PATH
+
+
+def _xhtml2pdf_worker(conn):
+    """
+    Цикл рабочего процесса: xhtml2pdf импортируется один раз и обслуживает задачи из conn.
+    """
+    from xhtml2pdf import pisa
+
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        html_file, pdf_file = job
+        base_dir = Path(html_file).parent
+
+        def link_callback(uri, _rel):
+            if uri.startswith(("http://", "https://", "data:")):
+                return uri
+            path = Path(unquote(uri[len("file://"):] if uri.startswith("file://") else uri))
+            return str(path if path.is_absolute() else base_dir / path)
+
+        try:
+            with open(html_file, "r", encoding="utf-8") as src, open(pdf_file, "wb") as dst:
+                status = pisa.CreatePDF(src.read(), dest=dst, link_callback=link_callback, encoding="utf-8")
+            conn.send((not status.err, f"{status.err} rendering errors" if status.err else None))
+        except Exception as e:
+            conn.send((False, str(e)))
+
+
+class _WorkerPool:
+    """
+    Пул долгоживущих процессов. Зависший по таймауту процесс завершается и заменяется новым.
+    """
+
+    def __init__(self, target, size):
+        self._target = target
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = queue.Queue()
+        self._size = size
+        self._started = False
+        self._lock = threading.Lock()
+
+    def _spawn(self):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=self._target, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    def _ensure_started(self):
+        with self._lock:
+            if not self._started:
+                for _ in range(self._size):
+                    self._idle.put(self._spawn())
+                self._started = True
+
+    def run(self, job, timeout):
+        """
+        Выполняет job в свободном процессе. TimeoutError, если ожидание процесса
+        вместе с отрисовкой заняло дольше timeout.
+        """
+        self._ensure_started()
+        deadline = time.monotonic() + timeout
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No free PDF renderer within {timeout} seconds")
+
+        process, conn = worker
+        try:
+            conn.send(job)
+            if not conn.poll(max(deadline - time.monotonic(), 0)):
+                raise TimeoutError(f"PDF rendering exceeded {timeout} seconds")
+            return conn.recv()
+        except BaseException:
+            process.terminate()
+            process.join()
+            # Если замену запустить не удалось, в пул возвращать нечего
+            worker = None
+            worker = self._spawn()
+            raise
+        finally:
+            if worker is not None:
+                self._idle.put(worker)
+
+    def shutdown(self):
+        while True:
+            try:
+                process, conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+
+class PdfRenderer:
+    """
+    Рендерер HTML -> PDF с настраиваемым движком, ограничением параллелизма
+    и таймаутом на документ.
+    """
+
+    def __init__(self, engine=PDF_ENGINE, executable=None, workers=PDF_WORKERS, timeout=PDF_TIMEOUT_SECONDS):
+        if engine not in PDF_ENGINES:
+            raise ValueError(f"engine must be one of {PDF_ENGINES}, got {engine}")
+        self.engine = engine
+        self.executable = executable or (find_wkhtmltopdf() if engine == "wkhtmltopdf" else None)
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers)
+        self._pool = _WorkerPool(_xhtml2pdf_worker, workers) if engine == "xhtml2pdf" else None
+
+    def render(self, html_file, pdf_file, disable_javascript=False, timeout=None, executable=None):
+        """
+        Конвертирует HTML в PDF. Возвращает True при успехе.
+        """
+        timeout = timeout or self.timeout
+        if self.engine == "xhtml2pdf":
+            return self._render_in_pool(html_file, pdf_file, timeout)
+        return self._render_wkhtmltopdf(html_file, pdf_file, disable_javascript, timeout,
+                                        executable or self.executable)
+
+    def _render_wkhtmltopdf(self, html_file, pdf_file, disable_javascript, timeout, executable):
+        # Ожидание слота и сам рендер укладываются в один общий timeout
+        deadline = time.monotonic() + timeout
+        if not self._slots.acquire(timeout=timeout):
+            _log.error(f"No free wkhtmltopdf slot within {timeout} seconds for {html_file}")
+            return False
+        try:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                _log.error(f"wkhtmltopdf timed out after {timeout} seconds waiting for a slot for {html_file}")
+                return False
+            command = [executable, '--enable-local-file-access', str(html_file), str(pdf_file)]
+            if disable_javascript:
+                command.insert(1, "--disable-javascript")
+
+            result = subprocess.run(command, capture_output=True, text=True, check=True, encoding='utf-8',
+                                    timeout=remaining)
+            _log.debug(f"wkhtmltopdf stdout: {result.stdout}")
+            _log.debug(f"wkhtmltopdf stderr: {result.stderr}")
+            _log.info(f"PDF successfully created: {pdf_file}")
+            return True
+        except subprocess.TimeoutExpired:
+            _log.error(f"wkhtmltopdf timed out after {timeout} seconds on {html_file}")
+            return False
+        except subprocess.CalledProcessError as e:
+            _log.error(f"Error during execution wkhtmltopdf: {e}\nstdout: {e.stdout}\nstderr: {e.stderr}")
+            return False
+        except FileNotFoundError:
+            _log.error(f"wkhtmltopdf not found at path {executable}")
+            return False
+        finally:
+            self._slots.release()
+
+    def _render_in_pool(self, html_file, pdf_file, timeout):
+        try:
+            ok, error = self._pool.run((str(html_file), str(pdf_file)), timeout)
+        except TimeoutError as e:
+            _log.error(f"{e}: {html_file}")
+            return False
+        except Exception as e:
+            _log.error(f"Error rendering {html_file} with {self.engine}: {e}")
+            return False
+        if ok:
+            _log.info(f"PDF successfully created: {pdf_file}")
+        else:
+            _log.error(f"Error rendering {html_file} with {self.engine}: {error}")
+        return ok
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown()
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_renderer():
+    """
+    Общий для процесса рендерер, настроенный через PDF_ENGINE, PDF_WORKERS, PDF_TIMEOUT_SECONDS.
+    """
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None:
+            _renderer = PdfRenderer()
+        return _renderer
+
+
+def shutdown_renderer():
+    global _renderer
+    with _renderer_lock:
+        if _renderer is not None:
+            _renderer.shutdown()
+            _renderer = None
+
+
+def generate_pdf(html_file, pdf_file, wkhtmltopdf_path=None, disable_javascript=False, timeout=None):
+    """
+    Конвертирует HTML в PDF общим рендерером (по умолчанию wkhtmltopdf).
+    wkhtmltopdf_path переопределяет путь к исполняемому файлу для движка wkhtmltopdf.
+    """
+    return get_renderer().render(html_file, pdf_file, disable_javascript=disable_javascript, timeout=timeout,
+                                 executable=wkhtmltopdf_path)
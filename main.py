@@ -1,27 +1,249 @@
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from pathlib import Path
-from document_to_md import convert_document_to_md
+from document_to_md import convert_document_to_md, get_document_converter
 from md_to_html import convert_markdown_to_html
 from html_to_pdf import generate_pdf
-from pdf_to_png import render_pdf_to_png
-from png_to_embeddings import process_images_for_embeddings
-from utils.file_processing import process_directory_png
+from pdf_to_png import render_pdf_to_png, get_pdf_render_converter
+from png_to_embeddings import process_images_for_embeddings, process_image_dirs_for_embeddings, \
+    process_pages_for_embeddings, model_id
+from utils.file_processing import process_directory_png, replace_char_in_links_bs4
+from utils.metrics import stage_span
+from utils.page_stream import PageStream
+from utils.image_writer import IMAGE_FORMAT
+from utils.pdf_raster import count_pages, iter_pdf_pages
 
 _log = logging.getLogger(__name__)
 
 # Константы
 IMAGE_RESOLUTION_SCALE = 2.0
-WKHTMLTOPDF_PATH = "D:\\wkhtmltox-0.12.6-1.mxe-cross-win64\\wkhtmltox\\bin\\wkhtmltopdf.exe"
+IMAGE_MODE = "referenced"  # embedded (base64 в Markdown) или referenced (ссылки на PNG)
+WKHTMLTOPDF_PATH = None  # None - из WKHTMLTOPDF_PATH или PATH (см. html_to_pdf.find_wkhtmltopdf)
+RASTER_MODE = "pdfium"  # docling или pdfium (параллельная растеризация)
+RASTER_SCALE = 1.0  # 1.0 = 72 DPI
+RASTER_WORKERS = None  # None - по числу ядер
+EMBEDDING_BATCH_SIZE = 16
+EMBEDDING_WORKERS = 4
+TORCH_THREADS = None  # None - число потоков torch по умолчанию
+# npy, store или both. both - переходный режим: /get-embeddings/ по умолчанию отдает прежние
+# постраничные .npy (float32), а хранилище (EMBEDDING_DTYPE) доступно с layout=store
+EMBEDDING_FORMAT = "both"
+EMBEDDING_DTYPE = "float16"
 
-def main(input_doc_path: Path, temp_dir: Path):
+# Передача страниц эмбеддеру:
+# disk - PNG пишутся на диск и читаются эмбеддером обратно;
+# memory - отрисованные страницы идут в эмбеддер в памяти через ограниченную очередь
+#          (utils.page_stream), PNG пишутся асинхронно, только если SAVE_PAGE_IMAGES.
+# Для RASTER_MODE = "docling" полный путь всегда идет через диск.
+PAGE_HANDOFFS = ("disk", "memory")
+PAGE_HANDOFF = "memory"
+SAVE_PAGE_IMAGES = True
+PAGE_QUEUE_SIZE = 32
+
+# Режимы получения изображений страниц:
+# auto - для PDF и изображений берем страницы из первой конвертации docling,
+#        остальные форматы проходят полный путь MD -> HTML -> PDF -> PNG;
+# normalized - всегда полный путь с нормализованной перерисовкой.
+RENDER_MODES = ("auto", "normalized")
+RENDER_MODE = "auto"
+FAST_PATH_SUFFIXES = {".pdf", ".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".webp"}
+
+# Способы получения HTML (артефакт /get-html/ и вход HTML -> PDF на полном пути):
+# docling - HTML сохраняется из документа docling при конвертации в Markdown,
+#           pandoc используется, только если экспорт не удался;
+# pandoc - Markdown конвертируется в HTML внешним процессом pandoc.
+HTML_MODES = ("docling", "pandoc")
+HTML_MODE = "docling"
+
+# Этапы конвейера в порядке выполнения
+PIPELINE_STAGES = [
+    "convert_to_md",
+    "md_to_html",
+    "fix_html_links",
+    "html_to_pdf",
+    "pdf_to_png",
+    "embeddings",
+    "move_npy",
+]
+
+# Пакетная обработка: документы конвертируются параллельно,
+# страницы всех документов считаются общими батчами эмбеддингов
+BATCH_STAGES = [
+    "convert_documents",
+    "embeddings",
+    "move_npy",
+]
+BATCH_CONVERT_WORKERS = int(os.environ.get("BATCH_CONVERT_WORKERS", "2"))
+
+def uses_fast_path(input_doc_path: Path, render_mode: str = RENDER_MODE):
+    """
+    True, если страницы можно взять из первой конвертации docling.
+    """
+    if render_mode not in RENDER_MODES:
+        raise ValueError(f"Unknown render mode: {render_mode}")
+    return render_mode == "auto" and input_doc_path.suffix.lower() in FAST_PATH_SUFFIXES
+
+def pipeline_options(include_images: bool = True, render_mode: str = RENDER_MODE, image_mode: str = IMAGE_MODE,
+                     html_mode: str = HTML_MODE):
+    """
+    Параметры, влияющие на результат конвейера. Используются в ключе кэша результатов.
+    """
+    return {
+        "include_images": include_images,
+        "image_mode": image_mode,
+        "render_mode": render_mode,
+        "html_mode": html_mode,
+        "image_resolution_scale": IMAGE_RESOLUTION_SCALE,
+        "raster_mode": RASTER_MODE,
+        "raster_scale": RASTER_SCALE,
+        "model_name": model_id(),
+        "embedding_format": EMBEDDING_FORMAT,
+        "embedding_dtype": EMBEDDING_DTYPE,
+        "page_images": PAGE_HANDOFF == "disk" or SAVE_PAGE_IMAGES,
+        "image_format": IMAGE_FORMAT,
+    }
+
+def warmup_converters():
+    """
+    Заранее создает и прогревает конвертеры docling, используемые конвейером.
+    """
+    get_document_converter(IMAGE_RESOLUTION_SCALE, warm=True)
+    if RASTER_MODE == "docling":
+        get_pdf_render_converter(RASTER_SCALE, warm=True)
+
+def _notify(progress_callback, stage, status):
+    if progress_callback:
+        progress_callback(stage, status)
+
+def _file_size(path):
+    return path.stat().st_size if path is not None and path.exists() else None
+
+def _dir_size(path, pattern="*"):
+    return sum(f.stat().st_size for f in path.glob(pattern) if f.is_file())
+
+def html_path(input_doc_path: Path, temp_dir: Path):
+    return temp_dir / f"{input_doc_path.stem}-with-image-refs.html"
+
+@contextmanager
+def _stage(stage, doc_type, progress_callback=None, spans=None, bytes_in=None):
+    """
+    Этап конвейера: сообщает о статусе через progress_callback и замеряет его (utils.metrics).
+    """
+    _notify(progress_callback, stage, "running")
+    try:
+        with stage_span(stage, doc_type, bytes_in=bytes_in, spans=spans) as span:
+            yield span
+    except Exception:
+        _notify(progress_callback, stage, "failed")
+        raise
+    _notify(progress_callback, stage, "success")
+
+def _build_html(input_doc_path: Path, temp_dir: Path, md_file: Path, result: dict, progress_callback=None,
+                spans=None):
+    """
+    HTML-артефакт документа: сохраненный из документа docling или полученный из Markdown через pandoc,
+    с исправленными ссылками. Возвращает путь HTML.
+    """
+    doc_type = input_doc_path.suffix.lower().lstrip(".")
+
+    # 2. Конвертация Markdown в HTML, если HTML не сохранен из документа docling
+    html_file = html_path(input_doc_path, temp_dir)
+    if html_file.exists():
+        _notify(progress_callback, "md_to_html", "skipped")
+        result["steps"].append({"step": "Convert to HTML", "status": "skipped", "message": f"HTML exported from the document to {html_file}"})
+    else:
+        with _stage("md_to_html", doc_type, progress_callback, spans, _file_size(md_file)) as span:
+            if not convert_markdown_to_html(md_file, html_file):
+                raise Exception("Failed to convert Markdown to HTML.")
+            span.bytes_out = _file_size(html_file)
+        result["steps"].append({"step": "Convert to HTML", "status": "success", "message": f"HTML saved to {html_file}"})
+
+    # 3. Замена символов в ссылках HTML
+    with _stage("fix_html_links", doc_type, progress_callback, spans, _file_size(html_file)) as span:
+        html_file_new = temp_dir / f"{input_doc_path.stem}-with-image-refs_new.html"
+        if not replace_char_in_links_bs4(html_file, "%5C", "/", html_file_new):
+            raise Exception("Failed to replace characters in HTML links.")
+        span.bytes_out = _file_size(html_file_new)
+    result["steps"].append({"step": "Fix HTML links", "status": "success", "message": f"Fixed links in {html_file_new}"})
+    return html_file_new
+
+def _render_via_html(input_doc_path: Path, temp_dir: Path, md_file: Path, output_images_dir: Path,
+                     result: dict, progress_callback=None, spans=None, render_pages: bool = True):
+    """
+    Полный путь MD -> HTML -> PDF -> PNG с нормализованной перерисовкой страниц.
+    При render_pages=False PDF не растеризуется: страницы отрисуются потоком на этапе эмбеддингов.
+    Возвращает пути HTML и PDF.
+    """
+    doc_type = input_doc_path.suffix.lower().lstrip(".")
+    html_file_new = _build_html(input_doc_path, temp_dir, md_file, result, progress_callback, spans)
+
+    # 4. Конвертация HTML в PDF
+    with _stage("html_to_pdf", doc_type, progress_callback, spans, _file_size(html_file_new)) as span:
+        pdf_file = temp_dir / "output.pdf"
+        if not generate_pdf(html_file_new, pdf_file, WKHTMLTOPDF_PATH):
+            raise Exception("Failed to convert HTML to PDF.")
+        span.bytes_out = _file_size(pdf_file)
+    result["steps"].append({"step": "Convert to PDF", "status": "success", "message": f"PDF saved to {pdf_file}"})
+
+    # 5. Рендеринг PDF в PNG
+    if not render_pages:
+        _notify(progress_callback, "pdf_to_png", "skipped")
+        result["steps"].append({"step": "Render PDF to PNG", "status": "skipped", "message": "Pages are rendered in memory while generating embeddings"})
+        return html_file_new, pdf_file
+
+    with _stage("pdf_to_png", doc_type, progress_callback, spans, _file_size(pdf_file)) as span:
+        if not render_pdf_to_png(pdf_file, output_images_dir, RASTER_MODE, RASTER_SCALE, workers=RASTER_WORKERS):
+            raise Exception("Failed to render PDF to PNG.")
+        span.pages = len(list(output_images_dir.glob("*.png")))
+        span.bytes_out = _dir_size(output_images_dir, "*.png")
+    result["steps"].append({"step": "Render PDF to PNG", "status": "success", "message": f"PNG images saved to {output_images_dir}"})
+
+    return html_file_new, pdf_file
+
+def _embed_page_stream(pages, num_pages: int, output_images_dir: Path, output_embeddings_dir: Path,
+                       cache_stats: dict = None):
+    """
+    Эмбеддинги страниц, переданных в памяти через ограниченную очередь.
+    PNG сохраняются в output_images_dir асинхронно, если включен SAVE_PAGE_IMAGES.
+    Возвращает число страниц.
+    """
+    with PageStream(pages, PAGE_QUEUE_SIZE, output_images_dir if SAVE_PAGE_IMAGES else None) as stream:
+        return process_pages_for_embeddings(stream, output_embeddings_dir, num_pages, EMBEDDING_BATCH_SIZE,
+                                            EMBEDDING_WORKERS, TORCH_THREADS, EMBEDDING_FORMAT, EMBEDDING_DTYPE,
+                                            cache_stats=cache_stats)
+
+def main(input_doc_path: Path, temp_dir: Path, include_images: bool = True, progress_callback=None,
+         render_mode: str = RENDER_MODE, image_mode: str = IMAGE_MODE, html_mode: str = HTML_MODE,
+         embed: bool = True):
+    """
+    Выполняет все этапы конвейера. progress_callback(stage, status) вызывается
+    при начале и завершении каждого этапа из PIPELINE_STAGES.
+    Замеры этапов возвращаются в result["timings"], число страниц из кэша страниц -
+    в result["embedding_cache"].
+    При embed=False конвейер останавливается на PNG страниц (эмбеддинги считает main_batch).
+    """
+    if html_mode not in HTML_MODES:
+        raise ValueError(f"Unknown HTML mode: {html_mode}")
+    fast_path = uses_fast_path(input_doc_path, render_mode)
+    # HTML отдается и для документов на быстром пути, поэтому сохраняется из документа docling и там
+    export_html = html_mode == "docling"
+    stream_pages = embed and PAGE_HANDOFF == "memory" and (fast_path or RASTER_MODE == "pdfium")
+    page_images = [] if stream_pages and fast_path else None
+    doc_type = input_doc_path.suffix.lower().lstrip(".")
     try:
         # Результаты обработки
         result = {
             "status": "success",
             "message": "Document processing started.",
             "steps": [],
-            "download_link": None
+            "download_link": None,
+            "artifacts": {},
+            "timings": [],
+            "embedding_cache": {"reused": 0, "computed": 0}
         }
+        spans = result["timings"]
 
         # Создаем поддиректории для изображений и эмбеддингов
         output_images_dir = temp_dir / "images"
@@ -30,44 +252,153 @@ def main(input_doc_path: Path, temp_dir: Path):
         output_embeddings_dir.mkdir(parents=True, exist_ok=True)
 
         # 1. Конвертация документа в Markdown
-        md_file = convert_document_to_md(input_doc_path, temp_dir, IMAGE_RESOLUTION_SCALE)
-        if not md_file:
-            raise Exception("Failed to convert document to Markdown.")
+        with _stage("convert_to_md", doc_type, progress_callback, spans, _file_size(input_doc_path)) as span:
+            md_file = convert_document_to_md(input_doc_path, temp_dir, IMAGE_RESOLUTION_SCALE, include_images=include_images,
+                                             page_images_dir=output_images_dir if fast_path else None,
+                                             image_mode=image_mode,
+                                             html_file=html_path(input_doc_path, temp_dir) if export_html else None,
+                                             page_images=page_images)
+            if not md_file:
+                raise Exception("Failed to convert document to Markdown.")
+            span.bytes_out = _file_size(md_file)
+            if page_images is not None:
+                span.pages = len(page_images)
+            elif fast_path:
+                span.pages = len(list(output_images_dir.glob("*.png")))
         result["steps"].append({"step": "Convert to Markdown", "status": "success", "message": f"Markdown saved to {md_file}"})
 
-        # 2. Конвертация Markdown в HTML
-        html_file = temp_dir / f"{input_doc_path.stem}-with-image-refs.html"
-        if not convert_markdown_to_html(md_file, html_file):
-            raise Exception("Failed to convert Markdown to HTML.")
-        result["steps"].append({"step": "Convert to HTML", "status": "success", "message": f"HTML saved to {html_file}"})
-
-        # 3. Замена символов в ссылках HTML
-        html_file_new = temp_dir / f"{input_doc_path.stem}-with-image-refs_new.html"
-        if not replace_char_in_links_bs4(html_file, "%5C", "/", html_file_new):
-            raise Exception("Failed to replace characters in HTML links.")
-        result["steps"].append({"step": "Fix HTML links", "status": "success", "message": f"Fixed links in {html_file_new}"})
-
-        # 4. Конвертация HTML в PDF
-        pdf_file = temp_dir / "output.pdf"
-        if not generate_pdf(html_file_new, pdf_file, WKHTMLTOPDF_PATH):
-            raise Exception("Failed to convert HTML to PDF.")
-        result["steps"].append({"step": "Convert to PDF", "status": "success", "message": f"PDF saved to {pdf_file}"})
+        if fast_path:
+            # Страницы уже сохранены из первой конвертации, PDF не строим; HTML нужен как артефакт
+            html_file_new = _build_html(input_doc_path, temp_dir, md_file, result, progress_callback, spans)
+            pdf_file = input_doc_path if input_doc_path.suffix.lower() == ".pdf" else None
+            for skipped in ("html_to_pdf", "pdf_to_png"):
+                _notify(progress_callback, skipped, "skipped")
+            result["steps"].append({"step": "Render PDF to PNG", "status": "skipped", "message": f"Page images exported from the document conversion to {output_images_dir}"})
+        else:
+            html_file_new, pdf_file = _render_via_html(input_doc_path, temp_dir, md_file, output_images_dir,
+                                                       result, progress_callback, spans,
+                                                       render_pages=not stream_pages)
 
-        # 5. Рендеринг PDF в PNG
-        if not render_pdf_to_png(pdf_file, output_images_dir):
-            raise Exception("Failed to render PDF to PNG.")
-        result["steps"].append({"step": "Render PDF to PNG", "status": "success", "message": f"PNG images saved to {output_images_dir}"})
+        if not embed:
+            result["message"] = "Document rendered."
+            result["artifacts"] = {
+                "md_file": md_file,
+                "html_file": html_file_new,
+                "pdf_file": pdf_file,
+                "images_dir": output_images_dir,
+                "embeddings_dir": output_embeddings_dir,
+            }
+            return result
 
-        # 6. Получение эмбеддингов из PNG
-        process_images_for_embeddings(output_images_dir, output_embeddings_dir)
-        result["steps"].append({"step": "Generate embeddings", "status": "success", "message": f"Embeddings saved to {output_embeddings_dir}"})
+        # 6. Получение эмбеддингов: из страниц в памяти или из PNG на диске.
+        # Неизмененные страницы берутся из кэша страниц, их число попадает в result["embedding_cache"]
+        cache_stats = result["embedding_cache"]
+        if stream_pages and page_images is not None:
+            with _stage("embeddings", doc_type, progress_callback, spans) as span:
+                span.pages = _embed_page_stream(page_images, len(page_images), output_images_dir,
+                                                output_embeddings_dir, cache_stats)
+                span.bytes_out = _dir_size(output_embeddings_dir)
+            page_images = None
+        elif stream_pages:
+            with _stage("embeddings", doc_type, progress_callback, spans, _file_size(pdf_file)) as span:
+                pages = ((page_no, f"{pdf_file.stem}-{page_no}.png", image)
+                         for page_no, image in iter_pdf_pages(pdf_file, RASTER_SCALE, workers=RASTER_WORKERS))
+                span.pages = _embed_page_stream(pages, count_pages(pdf_file), output_images_dir,
+                                                output_embeddings_dir, cache_stats)
+                span.bytes_out = _dir_size(output_embeddings_dir)
+        else:
+            with _stage("embeddings", doc_type, progress_callback, spans, _dir_size(output_images_dir, "*.png")) as span:
+                process_images_for_embeddings(output_images_dir, output_embeddings_dir, EMBEDDING_BATCH_SIZE,
+                                              EMBEDDING_WORKERS, TORCH_THREADS, EMBEDDING_FORMAT, EMBEDDING_DTYPE,
+                                              cache_stats=cache_stats)
+                span.pages = len(list(output_images_dir.glob("*.png")))
+                span.bytes_out = _dir_size(output_embeddings_dir)
+        result["steps"].append({"step": "Generate embeddings", "status": "success", "message": f"Embeddings saved to {output_embeddings_dir}, {cache_stats.get('reused', 0)} pages reused from the page cache"})
 
         # 7. Перемещение .npy файлов
-        process_directory_png(output_images_dir, output_embeddings_dir)
+        with _stage("move_npy", doc_type, progress_callback, spans):
+            process_directory_png(output_images_dir, output_embeddings_dir)
         result["steps"].append({"step": "Move .npy files", "status": "success", "message": f".npy files moved to {output_embeddings_dir}"})
 
+        result["message"] = "Document processed."
+        result["artifacts"] = {
+            "md_file": md_file,
+            "html_file": html_file_new,
+            "pdf_file": pdf_file,
+            "images_dir": output_images_dir,
+            "embeddings_dir": output_embeddings_dir,
+        }
         return result
 
     except Exception as e:
         _log.error(f"Error processing document: {e}")
-        raise
\ No newline at end of file
+        raise
+
+def main_batch(documents, include_images: bool = True, progress_callback=None, render_mode: str = RENDER_MODE,
+               image_mode: str = IMAGE_MODE, html_mode: str = HTML_MODE, convert_workers: int = None):
+    """
+    Пакетная обработка документов. documents - список (doc_id, input_doc_path, temp_dir).
+    Документы конвертируются параллельно до PNG страниц, затем страницы всех документов
+    проходят через модель общими батчами. progress_callback получает этапы из BATCH_STAGES.
+    Возвращает манифест: по документу статус, число страниц, артефакты и замеры.
+    """
+    spans = []
+    entries = {}
+    for doc_id, input_doc_path, temp_dir in documents:
+        entries[doc_id] = {
+            "doc_id": doc_id,
+            "filename": input_doc_path.name,
+            "status": "pending",
+            "error": None,
+            "pages": None,
+            "artifacts": None,
+            "timings": None,
+        }
+
+    # 1. Конвертация документов до PNG страниц
+    bytes_in = sum(_file_size(input_doc_path) or 0 for _, input_doc_path, _ in documents)
+    with _stage("convert_documents", "batch", progress_callback, spans, bytes_in) as span:
+        with ThreadPoolExecutor(max_workers=convert_workers or BATCH_CONVERT_WORKERS,
+                                thread_name_prefix="batch-convert") as executor:
+            futures = {
+                executor.submit(main, input_doc_path, temp_dir, include_images=include_images,
+                                render_mode=render_mode, image_mode=image_mode, html_mode=html_mode,
+                                embed=False): doc_id
+                for doc_id, input_doc_path, temp_dir in documents
+            }
+            for future in as_completed(futures):
+                entry = entries[futures[future]]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    entry.update(status="failed", error=str(e))
+                    continue
+                entry.update(status="rendered", artifacts=result["artifacts"], timings=result["timings"])
+        converted = [entry for entry in entries.values() if entry["status"] == "rendered"]
+        span.pages = sum(len(list(entry["artifacts"]["images_dir"].glob("*.png"))) for entry in converted)
+
+    # 2. Эмбеддинги страниц всех документов общими батчами
+    cache_stats = {"reused": 0, "computed": 0}
+    dir_pairs = [(entry["artifacts"]["images_dir"], entry["artifacts"]["embeddings_dir"]) for entry in converted]
+    bytes_in = sum(_dir_size(images_dir, "*.png") for images_dir, _ in dir_pairs)
+    with _stage("embeddings", "batch", progress_callback, spans, bytes_in) as span:
+        pages = process_image_dirs_for_embeddings(dir_pairs, EMBEDDING_BATCH_SIZE, EMBEDDING_WORKERS, TORCH_THREADS,
+                                                  EMBEDDING_FORMAT, EMBEDDING_DTYPE, cache_stats=cache_stats)
+        span.pages = sum(pages.values())
+        span.bytes_out = sum(_dir_size(embeddings_dir) for _, embeddings_dir in dir_pairs)
+
+    # 3. Перемещение .npy файлов
+    with _stage("move_npy", "batch", progress_callback, spans):
+        for entry in converted:
+            process_directory_png(entry["artifacts"]["images_dir"], entry["artifacts"]["embeddings_dir"])
+            entry["status"] = "success"
+            entry["pages"] = pages.get(entry["artifacts"]["embeddings_dir"], 0)
+
+    failed = sum(1 for entry in entries.values() if entry["status"] == "failed")
+    return {
+        "status": "success" if not failed else ("failed" if failed == len(entries) else "partial"),
+        "message": f"{len(entries) - failed} of {len(entries)} documents processed.",
+        "documents": [entries[doc_id] for doc_id, _, _ in documents],
+        "timings": spans,
+        "embedding_cache": cache_stats,
+    }
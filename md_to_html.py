@@ -1,21 +1,15 @@
-import pypandoc
 import logging
 from pathlib import Path
 
-_log = logging.getLogger(__name__)
-
+try:
+    import pypandoc
+except ImportError:
+    pypandoc = None
 
-def convert_markdown_to_html(markdown_file, html_file):
-    """
-    Конвертирует Markdown в HTML с помощью pypandoc.
-    Встроенные CSS-стили добавляются для разрывов страниц.
-    """
-    if not markdown_file.exists():
-        _log.error(f"Markdown file not found: {markdown_file}")
-        return False
+_log = logging.getLogger(__name__)
 
-    # Встроенные CSS-стили
-    css_styles = """
+# Встроенные CSS-стили, общие для HTML из pandoc и из docling
+CSS_STYLES = """
     <style>
         body {
             font-family: Arial, sans-serif;
@@ -38,6 +32,36 @@ def convert_markdown_to_html(markdown_file, html_file):
     </style>
     """
 
+
+def add_css_styles(html_content):
+    """
+    Добавляет CSS_STYLES в конец <head>, чтобы они перекрывали стили генератора HTML.
+    """
+    if '</head>' in html_content:
+        return html_content.replace('</head>', f'{CSS_STYLES}</head>', 1)
+    return f'<head>{CSS_STYLES}</head>\n{html_content}'
+
+
+def save_styled_html(html_content, html_file):
+    """
+    Сохраняет HTML со встроенными CSS-стилями для разрывов страниц.
+    """
+    with open(html_file, 'w', encoding='utf-8') as f:
+        f.write(add_css_styles(html_content))
+
+
+def convert_markdown_to_html(markdown_file, html_file):
+    """
+    Конвертирует Markdown в HTML с помощью pypandoc.
+    Встроенные CSS-стили добавляются для разрывов страниц.
+    """
+    if not markdown_file.exists():
+        _log.error(f"Markdown file not found: {markdown_file}")
+        return False
+    if pypandoc is None:
+        _log.error("pypandoc is not installed, cannot convert Markdown to HTML")
+        return False
+
     try:
         _log.info(f"Converting {markdown_file} to {html_file}")
 
@@ -49,15 +73,11 @@ def convert_markdown_to_html(markdown_file, html_file):
             extra_args=['-s']  # standalone HTML
         )
 
-        # Добавляем встроенные CSS-стили
-        html_content = html_content.replace('</head>', f'{css_styles}</head>')
-
-        # Сохраняем HTML-файл
-        with open(html_file, 'w', encoding='utf-8') as f:
-            f.write(html_content)
+        # Добавляем встроенные CSS-стили и сохраняем HTML-файл
+        save_styled_html(html_content, html_file)
 
         _log.info(f"Successfully converted {markdown_file} to {html_file}")
         return True
     except Exception as e:
         _log.error(f"Error converting {markdown_file} to {html_file}: {e}")
-        return False
\ No newline at end of file
+        return False
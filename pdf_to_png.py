@@ -1,40 +1,91 @@
 import logging
 from pathlib import Path
-from docling.backend.pypdfium2_backend import PyPdfiumDocumentBackend
-from docling.datamodel.base_models import InputFormat
-from docling.document_converter import DocumentConverter, PdfFormatOption
-from docling.datamodel.pipeline_options import PdfPipelineOptions
+from utils.converter_registry import registry
+from utils.image_writer import get_page_writer
+from utils.pdf_raster import rasterize_pdf, PDF_POINTS_PER_INCH
 
 _log = logging.getLogger(__name__)
 
-def render_pdf_to_png(pdf_path, output_images_dir):
+# Режимы растеризации PDF
+RASTER_MODES = ("docling", "pdfium")
+
+def build_pdf_render_converter(scale=1.0):
+    """
+    Создает DocumentConverter для отрисовки страниц PDF.
+    """
+    from docling.backend.pypdfium2_backend import PyPdfiumDocumentBackend
+    from docling.datamodel.base_models import InputFormat
+    from docling.document_converter import DocumentConverter, PdfFormatOption
+    from docling.datamodel.pipeline_options import PdfPipelineOptions
+
+    pipeline_options = PdfPipelineOptions()
+    pipeline_options.images_scale = scale
+    pipeline_options.generate_page_images = True
+
+    return DocumentConverter(
+        allowed_formats=[InputFormat.PDF],
+        format_options={
+            InputFormat.PDF: PdfFormatOption(
+                pipeline_options=pipeline_options,
+                backend=PyPdfiumDocumentBackend
+            ),
+        },
+    )
+
+def get_pdf_render_converter(scale=1.0, warm=False):
+    """
+    Возвращает общий для процесса конвертер отрисовки из реестра.
+    """
+    # Значение docling InputFormat.PDF, docling импортируется при создании конвертера
+    return registry.get("pdf_render", (scale,), lambda: build_pdf_render_converter(scale),
+                        warm_formats=["pdf"] if warm else ())
+
+def save_page_images(document, output_images_dir, doc_filename, page_range=None):
+    """
+    Сохраняет уже отрисованные docling изображения страниц в PNG.
+    Возвращает количество сохраненных страниц.
+    """
+    writer = get_page_writer()
+    writes = []
+    for page_no, page in document.pages.items():
+        if page_range is not None and not (page_range[0] <= page_no <= (page_range[1] or page_no)):
+            continue
+        page_image_filename = output_images_dir / f"{doc_filename}-{page_no}.png"
+        if page.image is not None and page.image.pil_image:
+            writes.append(writer.submit(page.image.pil_image, page_image_filename))
+        else:
+            _log.warning(f"No image found for page {page_no}")
+    saved = writer.wait(writes)
+    _log.info(f"{len(saved)} page images saved to {output_images_dir}")
+    return len(saved)
+
+def render_pdf_to_png(pdf_path, output_images_dir, mode="docling", scale=None, dpi=None, page_range=None,
+                      workers=None):
+    """
+    Рендерит страницы PDF в PNG.
+    mode: docling - через конвейер docling; pdfium - только растеризация через pypdfium2,
+    диапазоны страниц распределяются по пулу процессов (utils.pdf_raster).
+    page_range - (первая, последняя) с нумерацией от 1, включительно.
+    """
+    if mode not in RASTER_MODES:
+        raise ValueError(f"mode must be one of {RASTER_MODES}, got {mode}")
     try:
-        pipeline_options = PdfPipelineOptions()
-        pipeline_options.generate_page_images = True
-
-        doc_converter = DocumentConverter(
-            allowed_formats=[InputFormat.PDF],
-            format_options={
-                InputFormat.PDF: PdfFormatOption(
-                    pipeline_options=pipeline_options,
-                    backend=PyPdfiumDocumentBackend
-                ),
-            },
-        )
+        if mode == "pdfium":
+            writer = get_page_writer()
+            saved = rasterize_pdf(pdf_path, output_images_dir, scale=scale or 1.0, dpi=dpi,
+                                  page_range=page_range, workers=workers,
+                                  image_format=writer.image_format, level=writer.level)
+            _log.info(f"{len(saved)} page images saved to {output_images_dir}")
+            return True
 
+        if dpi is not None:
+            scale = dpi / PDF_POINTS_PER_INCH
+        doc_converter = get_pdf_render_converter(scale or 1.0)
         conv_res = doc_converter.convert(pdf_path)
         doc_filename = conv_res.input.file.stem
 
-        for page_no, page in conv_res.document.pages.items():
-            page_image_filename = output_images_dir / f"{doc_filename}-{page_no}.png"
-            if page.image.pil_image:
-                with page_image_filename.open("wb") as fp:
-                    page.image.pil_image.save(fp, format="PNG")
-                _log.info(f"Image saved: {page_image_filename}")
-            else:
-                _log.warning(f"No image found for page {page_no}")
-
+        save_page_images(conv_res.document, output_images_dir, doc_filename, page_range)
         return True
     except Exception as e:
         _log.error(f"Error rendering PDF to PNG: {e}")
-        return False
\ No newline at end of file
+        return False
@@ -1,41 +1,478 @@
-import torch
-import torchvision.transforms as transforms
-from transformers import SwinModel
 from PIL import Image
 import numpy as np
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
+from utils.embedding_store import EmbeddingStoreWriter, page_number_from_name, page_sort_key
+from utils.page_cache import PageEmbeddingCache, page_key
 
 _log = logging.getLogger(__name__)
 
-try:
-    swin_model = SwinModel.from_pretrained("microsoft/swin-base-patch4-window7-224")
-    swin_model.eval()
-    transform = transforms.Compose([
+# Модель для эмбеддингов страниц
+MODEL_NAME = "microsoft/swin-base-patch4-window7-224"
+
+# Параметры батчевого инференса по умолчанию
+DEFAULT_BATCH_SIZE = 16
+DEFAULT_NUM_WORKERS = 4
+
+# Форматы сохранения эмбеддингов
+OUTPUT_FORMATS = ("npy", "store", "both")
+
+# Бэкенды инференса на CPU:
+# eager - исходная модель fp32;
+# int8 - динамическая квантизация Linear-слоев в int8;
+# torchscript - трассированная и замороженная модель TorchScript;
+# onnx - экспорт в ONNX и выполнение в ONNX Runtime;
+# bf16 - autocast в bfloat16 и channels-last, если процессор поддерживает bf16, иначе fp32.
+EMBEDDING_BACKENDS = ("eager", "int8", "torchscript", "onnx", "bf16")
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "eager")
+ONNX_CACHE_DIR = Path(os.environ.get("ONNX_CACHE_DIR", "cache/onnx"))
+
+# Кэш эмбеддингов отдельных страниц по хэшу пикселей и идентификатору модели
+PAGE_CACHE_ENABLED = os.environ.get("PAGE_CACHE_ENABLED", "1") == "1"
+PAGE_CACHE_DIR = os.environ.get("PAGE_CACHE_DIR", "cache/pages")
+PAGE_CACHE_MAX_BYTES = int(os.environ.get("PAGE_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+# Модели и transform загружаются при первом использовании (load_model),
+# чтобы импорт модуля не тянул torch и transformers
+_models = {}
+_transform = None
+_model_lock = threading.Lock()
+
+def model_id(backend=None):
+    """
+    Идентификатор модели с учетом бэкенда. Используется в ключах кэшей и манифесте хранилища,
+    так как векторы разных бэкендов немного отличаются.
+    """
+    backend = backend or EMBEDDING_BACKEND
+    return MODEL_NAME if backend == "eager" else f"{MODEL_NAME}+{backend}"
+
+def _build_transform():
+    import torchvision.transforms as transforms
+
+    return transforms.Compose([
         transforms.Resize(256),
         transforms.CenterCrop(224),
         transforms.ToTensor(),
         transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
     ])
-except Exception as e:
-    logging.error("Error loading the Swin model: " + str(e))
+
+def _load_swin(**kwargs):
+    from transformers import SwinModel
+
+    model = SwinModel.from_pretrained(MODEL_NAME, **kwargs)
+    model.eval()
+    return model
+
+def _eager_embedder(model):
+    import torch
+
+    def embed(batch):
+        with torch.no_grad():
+            return model(batch).last_hidden_state.float().cpu().numpy()
+    return embed
+
+def _int8_embedder():
+    import torch
+
+    model = torch.quantization.quantize_dynamic(_load_swin(), {torch.nn.Linear}, dtype=torch.qint8)
+    return _eager_embedder(model)
+
+def _torchscript_embedder():
+    import torch
+
+    example = torch.zeros(2, 3, 224, 224)
+    with torch.no_grad():
+        traced = torch.jit.trace(_load_swin(torchscript=True), example, strict=False)
+        traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+    def embed(batch):
+        with torch.no_grad():
+            return traced(batch)[0].cpu().numpy()
+    return embed
+
+def _onnx_embedder():
+    import onnxruntime
+    import torch
+
+    onnx_path = ONNX_CACHE_DIR / f"{MODEL_NAME.replace('/', '--')}.onnx"
+    if not onnx_path.exists():
+        ONNX_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        model = _load_swin()
+
+        class LastHiddenState(torch.nn.Module):
+            def __init__(self, swin):
+                super().__init__()
+                self.swin = swin
+
+            def forward(self, pixel_values):
+                return self.swin(pixel_values).last_hidden_state
+
+        tmp_path = onnx_path.with_suffix(".tmp")
+        torch.onnx.export(LastHiddenState(model), torch.zeros(1, 3, 224, 224), str(tmp_path),
+                          input_names=["pixel_values"], output_names=["last_hidden_state"],
+                          dynamic_axes={"pixel_values": {0: "batch"}, "last_hidden_state": {0: "batch"}},
+                          opset_version=17)
+        os.replace(tmp_path, onnx_path)
+        _log.info(f"Model exported to ONNX: {onnx_path}")
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = onnxruntime.InferenceSession(str(onnx_path), options, providers=["CPUExecutionProvider"])
+
+    def embed(batch):
+        return session.run(["last_hidden_state"], {"pixel_values": batch.cpu().numpy()})[0]
+    return embed
+
+def _bf16_supported():
+    import torch
+
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+def _bf16_embedder():
+    import torch
+
+    if not _bf16_supported():
+        # Без аппаратной поддержки bf16 (AVX512-BF16/AMX) autocast эмулируется и медленнее fp32
+        _log.warning("CPU has no native bfloat16 support, bf16 backend falls back to fp32.")
+        return _eager_embedder(_load_swin())
+
+    model = _load_swin().to(memory_format=torch.channels_last)
+
+    def embed(batch):
+        with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16):
+            hidden = model(batch.contiguous(memory_format=torch.channels_last)).last_hidden_state
+        return hidden.float().cpu().numpy()
+    return embed
+
+def _build_embedder(backend):
+    if backend == "eager":
+        return _eager_embedder(_load_swin())
+    if backend == "int8":
+        return _int8_embedder()
+    if backend == "torchscript":
+        return _torchscript_embedder()
+    if backend == "onnx":
+        return _onnx_embedder()
+    return _bf16_embedder()
+
+def load_model(backend=None):
+    """
+    Возвращает (embed, transform), загружая модель бэкенда при первом вызове.
+    embed(batch) принимает тензор (N, 3, 224, 224) и возвращает last_hidden_state
+    в виде float32-массива numpy (N, tokens, hidden).
+    Ошибка загрузки пробрасывается вызывающему, следующий вызов повторит попытку.
+    """
+    global _transform
+    backend = backend or EMBEDDING_BACKEND
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"backend must be one of {EMBEDDING_BACKENDS}, got {backend}")
+    with _model_lock:
+        if backend not in _models:
+            start_time = time.time()
+            if _transform is None:
+                _transform = _build_transform()
+            _models[backend] = _build_embedder(backend)
+            _log.info(f"Model {model_id(backend)} loaded in {time.time() - start_time:.2f} seconds.")
+        return _models[backend], _transform
+
+def model_loaded(backend=None):
+    return (backend or EMBEDDING_BACKEND) in _models
+
+_page_cache = None
+_page_cache_lock = threading.Lock()
+
+def get_page_cache():
+    """
+    Общий для процесса кэш эмбеддингов страниц или None, если он отключен.
+    """
+    global _page_cache
+    if not PAGE_CACHE_ENABLED:
+        return None
+    with _page_cache_lock:
+        if _page_cache is None:
+            _page_cache = PageEmbeddingCache(PAGE_CACHE_DIR, PAGE_CACHE_MAX_BYTES)
+        return _page_cache
+
+def set_torch_threads(num_threads):
+    """
+    Задает число intra-op потоков torch. None оставляет значение по умолчанию.
+    """
+    if num_threads is None:
+        return
+    if num_threads < 1:
+        raise ValueError(f"num_threads must be positive, got {num_threads}")
+    import torch
+
+    torch.set_num_threads(num_threads)
+    _log.info(f"Torch intra-op threads set to {num_threads}")
 
 def get_image_embedding(page_image_filename):
     try:
+        embed, transform = load_model()
         img = Image.open(page_image_filename).convert('RGB')
-        img_tensor = transform(img).unsqueeze(0)
-        with torch.no_grad():
-            embedding = swin_model(img_tensor).last_hidden_state
-        return embedding.cpu().numpy()
+        return embed(transform(img).unsqueeze(0))
     except Exception as e:
         logging.error(f"Error when receiving embedding: {e}")
         return None
 
-def process_images_for_embeddings(output_images_dir, output_embeddings_dir):
-    output_embeddings_dir.mkdir(parents=True, exist_ok=True)
-    for filename in output_images_dir.glob("*.png"):
-        embedding = get_image_embedding(filename)
-        if embedding is not None:
+def get_pooled_image_embedding(image_file):
+    """
+    Усредненный по токенам эмбеддинг изображения (путь или файловый объект).
+    Совпадает с векторами store_pooled.npy хранилища эмбеддингов.
+    """
+    embed, transform = load_model()
+    with Image.open(image_file) as img:
+        img_tensor = transform(img.convert('RGB')).unsqueeze(0)
+    return embed(img_tensor)[0].mean(axis=0)
+
+def _open_image(page_image_filename):
+    """
+    Декодирует изображение с диска в RGB.
+    """
+    with Image.open(page_image_filename) as img:
+        return img.convert('RGB')
+
+def _as_rgb(image):
+    return image.convert('RGB')
+
+def _prepare(source, load, transform, cache, cache_model_id):
+    """
+    Готовит страницу в пуле потоков: декодирует, ищет ее эмбеддинг в кэше страниц
+    и только при промахе применяет transform.
+    Возвращает (тензор или None, ключ кэша, эмбеддинг из кэша или None).
+    """
+    try:
+        image = load(source)
+        key = page_key(image, cache_model_id) if cache is not None else None
+        if key is not None:
+            embedding = cache.get(key)
+            if embedding is not None:
+                return None, key, embedding
+        return transform(image), key, None
+    except Exception as e:
+        logging.error(f"Error loading image {source}: {e}")
+        return None, None, None
+
+def _iter_batched_embeddings(items, load, batch_size, num_workers, backend, use_cache=True, cache_stats=None):
+    """
+    Общий цикл батчевого инференса. items - итерируемое (ключ, источник), читается лениво;
+    load(источник) возвращает RGB-изображение, подготовка идет в пуле потоков.
+    Подготовка следующего батча идет, пока модель считает текущий.
+    Страницы, найденные в кэше страниц (get_page_cache), через модель не проходят;
+    cache_stats, если задан, получает счетчики reused и computed.
+    """
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be positive, got {batch_size}")
+
+    items = iter(items)
+    batch = list(islice(items, batch_size))
+    if not batch:
+        return
+
+    import torch
+
+    embed, transform = load_model(backend)
+    cache = get_page_cache() if use_cache else None
+    cache_model_id = model_id(backend)
+    if cache_stats is not None:
+        cache_stats.setdefault("reused", 0)
+        cache_stats.setdefault("computed", 0)
+
+    def submit(items_batch):
+        return [executor.submit(_prepare, source, load, transform, cache, cache_model_id)
+                for _, source in items_batch]
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        pending = submit(batch)
+        index = 0
+        while batch:
+            prepared = [future.result() for future in pending]
+            # Ставим в очередь подготовку следующего батча до прямого прохода
+            next_batch = list(islice(items, batch_size))
+            pending = submit(next_batch)
+
+            results = {}
+            to_embed = [(row, tensor) for row, (tensor, _, _) in enumerate(prepared) if tensor is not None]
+            if to_embed:
+                try:
+                    hidden = embed(torch.stack([tensor for _, tensor in to_embed]))
+                except Exception as e:
+                    logging.error(f"Error when receiving embeddings for batch {index}: {e}")
+                else:
+                    for position, (row, _) in enumerate(to_embed):
+                        results[row] = hidden[position:position + 1]
+                        page_cache_key = prepared[row][1]
+                        if page_cache_key is not None:
+                            cache.put(page_cache_key, results[row])
+            for row, (_, _, cached) in enumerate(prepared):
+                if cached is not None:
+                    results[row] = cached
+            if cache_stats is not None:
+                reused = sum(1 for _, _, cached in prepared if cached is not None)
+                cache_stats["reused"] += reused
+                cache_stats["computed"] += len(results) - reused
+
+            for row, (key, _) in enumerate(batch):
+                if row in results:
+                    yield key, results[row]
+            batch = next_batch
+            index += 1
+
+def iter_image_embeddings(image_paths, batch_size=DEFAULT_BATCH_SIZE, num_workers=DEFAULT_NUM_WORKERS, backend=None,
+                          use_cache=True, cache_stats=None):
+    """
+    Считает эмбеддинги батчами и возвращает пары (путь, эмбеддинг).
+    backend - бэкенд инференса из EMBEDDING_BACKENDS, по умолчанию EMBEDDING_BACKEND.
+    Декодирование следующего батча идет в пуле потоков, пока модель считает текущий.
+    Эмбеддинг каждой страницы имеет форму (1, tokens, hidden), как у get_image_embedding.
+    """
+    return _iter_batched_embeddings(((path, path) for path in image_paths), _open_image,
+                                    batch_size, num_workers, backend, use_cache, cache_stats)
+
+def iter_pil_embeddings(images, batch_size=DEFAULT_BATCH_SIZE, num_workers=DEFAULT_NUM_WORKERS, backend=None,
+                        use_cache=True, cache_stats=None):
+    """
+    То же для изображений в памяти: images - итерируемое (ключ, PIL.Image), например поток
+    страниц от отрисовки (utils.page_stream). Возвращает пары (ключ, эмбеддинг).
+    """
+    return _iter_batched_embeddings(images, _as_rgb, batch_size, num_workers, backend, use_cache, cache_stats)
+
+def process_images_for_embeddings(output_images_dir, output_embeddings_dir, batch_size=DEFAULT_BATCH_SIZE,
+                                  num_workers=DEFAULT_NUM_WORKERS, torch_threads=None, output_format="npy",
+                                  store_dtype="float32", store_pooled=True, cache_stats=None):
+    """
+    Считает эмбеддинги всех PNG в output_images_dir.
+    output_format: npy - отдельный .npy на страницу, store - общее хранилище
+    (utils.embedding_store), both - оба варианта.
+    cache_stats получает число страниц, взятых из кэша страниц (reused) и посчитанных (computed).
+    """
+    return process_image_dirs_for_embeddings([(output_images_dir, output_embeddings_dir)], batch_size,
+                                             num_workers, torch_threads, output_format, store_dtype, store_pooled,
+                                             cache_stats)
+
+def process_image_dirs_for_embeddings(dir_pairs, batch_size=DEFAULT_BATCH_SIZE, num_workers=DEFAULT_NUM_WORKERS,
+                                      torch_threads=None, output_format="npy", store_dtype="float32",
+                                      store_pooled=True, cache_stats=None):
+    """
+    Считает эмбеддинги PNG из нескольких пар (директория изображений, директория эмбеддингов).
+    Страницы всех документов идут в общие батчи, результаты раскладываются по их директориям.
+    Возвращает число страниц по директориям эмбеддингов.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"output_format must be one of {OUTPUT_FORMATS}, got {output_format}")
+    set_torch_threads(torch_threads)
+
+    image_paths = []
+    owners = {}
+    stores = {}
+    pages = {}
+    for output_images_dir, output_embeddings_dir in dir_pairs:
+        output_embeddings_dir.mkdir(parents=True, exist_ok=True)
+        paths = sorted(output_images_dir.glob("*.png"), key=page_sort_key)
+        if output_format in ("store", "both"):
+            stores[output_embeddings_dir] = EmbeddingStoreWriter(output_embeddings_dir, len(paths),
+                                                                 dtype=store_dtype, pooled=store_pooled,
+                                                                 model_name=model_id())
+        pages[output_embeddings_dir] = 0
+        for path in paths:
+            owners[path] = output_embeddings_dir
+        image_paths.extend(paths)
+
+    for filename, embedding in iter_image_embeddings(image_paths, batch_size, num_workers, cache_stats=cache_stats):
+        output_embeddings_dir = owners[filename]
+        pages[output_embeddings_dir] += 1
+        store = stores.get(output_embeddings_dir)
+        if store is not None:
+            store.add(page_number_from_name(filename), filename.name, embedding)
+        if output_format in ("npy", "both"):
             embedding_path = output_embeddings_dir / f"{filename.stem}.npy"
             np.save(embedding_path, embedding)
-            _log.info(f"Embedding saved: {embedding_path}")
\ No newline at end of file
+            _log.info(f"Embedding saved: {embedding_path}")
+
+    for store in stores.values():
+        store.close()
+    return pages
+
+def process_pages_for_embeddings(pages, output_embeddings_dir, num_pages, batch_size=DEFAULT_BATCH_SIZE,
+                                 num_workers=DEFAULT_NUM_WORKERS, torch_threads=None, output_format="npy",
+                                 store_dtype="float32", store_pooled=True, cache_stats=None):
+    """
+    Считает эмбеддинги страниц, переданных в памяти: pages - итерируемое
+    (номер страницы, имя PNG, PIL.Image), num_pages - их число для хранилища.
+    Результат сохраняется так же, как у process_images_for_embeddings. Возвращает число страниц.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"output_format must be one of {OUTPUT_FORMATS}, got {output_format}")
+    output_embeddings_dir.mkdir(parents=True, exist_ok=True)
+    set_torch_threads(torch_threads)
+
+    store = None
+    if output_format in ("store", "both"):
+        store = EmbeddingStoreWriter(output_embeddings_dir, num_pages, dtype=store_dtype,
+                                     pooled=store_pooled, model_name=model_id())
+
+    count = 0
+    images = (((page_no, name), image) for page_no, name, image in pages)
+    for (page_no, name), embedding in iter_pil_embeddings(images, batch_size, num_workers, cache_stats=cache_stats):
+        count += 1
+        if store is not None:
+            store.add(page_no, name, embedding)
+        if output_format in ("npy", "both"):
+            embedding_path = output_embeddings_dir / f"{Path(name).stem}.npy"
+            np.save(embedding_path, embedding)
+            _log.info(f"Embedding saved: {embedding_path}")
+
+    if store is not None:
+        store.close()
+    return count
+
+def _cosine_rows(a, b):
+    a = a.reshape(len(a), -1).astype(np.float64)
+    b = b.reshape(len(b), -1).astype(np.float64)
+    norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    return (a * b).sum(axis=1) / np.maximum(norms, 1e-12)
+
+def check_accuracy(image_paths, backend, batch_size=DEFAULT_BATCH_SIZE, num_workers=DEFAULT_NUM_WORKERS):
+    """
+    Сравнивает эмбеддинги бэкенда с эталонной моделью fp32 (eager) на тех же страницах.
+    Возвращает косинусное сходство усредненных векторов и полных last_hidden_state,
+    а также время и пропускную способность обоих вариантов.
+    """
+    image_paths = list(image_paths)
+    results = {}
+    for name in ("eager", backend):
+        load_model(name)
+        start_time = time.perf_counter()
+        embeddings = dict(iter_image_embeddings(image_paths, batch_size, num_workers, backend=name, use_cache=False))
+        results[name] = (embeddings, time.perf_counter() - start_time)
+
+    reference, reference_seconds = results["eager"]
+    candidate, candidate_seconds = results[backend]
+    paths = [path for path in image_paths if path in reference and path in candidate]
+    if not paths:
+        raise ValueError("No pages were embedded by both backends")
+    full_reference = np.concatenate([reference[path] for path in paths])
+    full_candidate = np.concatenate([candidate[path] for path in paths])
+    pooled_cosine = _cosine_rows(full_reference.mean(axis=1), full_candidate.mean(axis=1))
+    token_cosine = _cosine_rows(full_reference.reshape(-1, full_reference.shape[-1]),
+                                full_candidate.reshape(-1, full_candidate.shape[-1]))
+    return {
+        "backend": backend,
+        "model_id": model_id(backend),
+        "pages": len(paths),
+        "pooled_cosine_min": float(pooled_cosine.min()),
+        "pooled_cosine_mean": float(pooled_cosine.mean()),
+        "token_cosine_min": float(token_cosine.min()),
+        "token_cosine_mean": float(token_cosine.mean()),
+        "reference_seconds": round(reference_seconds, 4),
+        "backend_seconds": round(candidate_seconds, 4),
+        "speedup": round(reference_seconds / candidate_seconds, 3) if candidate_seconds > 0 else None,
+    }
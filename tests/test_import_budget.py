@@ -0,0 +1,19 @@
+import os
+
+import pytest
+
+from benchmark import measure_import
+
+# Бюджет импорта приложения в секундах, как у python benchmark.py import-budget
+IMPORT_BUDGET_SECONDS = float(os.environ.get("IMPORT_BUDGET_SECONDS", "3.0"))
+
+
+def test_app_import_is_light():
+    """
+    Импорт app в чистом интерпретаторе укладывается в бюджет и не загружает torch, transformers и docling.
+    """
+    pytest.importorskip("fastapi")
+    outcome = min((measure_import("app") for _ in range(3)), key=lambda item: item["seconds"])
+    assert outcome["heavy_modules"] == [], f"Heavy modules imported by app: {outcome['heavy_modules']}"
+    assert outcome["seconds"] <= IMPORT_BUDGET_SECONDS, \
+        f"import app took {outcome['seconds']:.3f} s, budget {IMPORT_BUDGET_SECONDS:.3f} s"
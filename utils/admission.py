@@ -0,0 +1,194 @@
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from utils.metrics import registry as metrics_registry, current_rss_bytes, SECONDS_BUCKETS
+
+_log = logging.getLogger(__name__)
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Причины отказа в допуске
+REJECT_QUEUE_FULL = "queue_full"
+REJECT_MEMORY = "memory"
+
+# Retry-After по умолчанию, пока нет статистики времени обработки, и его верхняя граница
+RETRY_AFTER_SECONDS = int(os.environ.get("ADMISSION_RETRY_AFTER_SECONDS", "5"))
+MAX_RETRY_AFTER_SECONDS = int(os.environ.get("ADMISSION_MAX_RETRY_AFTER_SECONDS", "300"))
+
+# Вес нового замера в скользящем среднем времени обработки
+_EWMA_ALPHA = 0.2
+
+ADMISSION_QUEUE_SECONDS = metrics_registry.histogram(
+    "admission_queue_seconds", "Time an admitted job waited for a processing slot.", SECONDS_BUCKETS, ("kind",))
+ADMISSION_PROCESSING_SECONDS = metrics_registry.histogram(
+    "admission_processing_seconds", "Time an admitted job held a processing slot.", SECONDS_BUCKETS, ("kind",))
+
+
+def physical_memory_bytes():
+    """
+    Объем физической памяти в байтах или None.
+    """
+    if psutil is not None:
+        return psutil.virtual_memory().total
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def used_memory_bytes():
+    """
+    RSS процесса вместе с дочерними процессами (пулы отрисовки PDF, xhtml2pdf), если доступен psutil.
+    """
+    if psutil is None:
+        return current_rss_bytes()
+    process = psutil.Process()
+    total = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            total += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return total
+
+
+class Overloaded(Exception):
+    """
+    Задача не допущена: очередь заполнена или превышен бюджет памяти.
+    """
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Service is overloaded ({reason}), retry after {retry_after} seconds.")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """
+    Допуск одной задачи. running() занимает слот обработки (ожидая его при необходимости)
+    и отдельно замеряет ожидание в очереди и время обработки.
+    """
+
+    def __init__(self, controller, kind):
+        self._controller = controller
+        self.kind = kind
+        self.admitted_at = time.monotonic()
+        self.queue_seconds = None
+        self.processing_seconds = None
+        self._state = "queued"
+
+    @contextmanager
+    def running(self):
+        self._controller._acquire(self)
+        self.queue_seconds = time.monotonic() - self.admitted_at
+        ADMISSION_QUEUE_SECONDS.observe(self.queue_seconds, kind=self.kind)
+        start_time = time.monotonic()
+        try:
+            yield self
+        finally:
+            self.processing_seconds = time.monotonic() - start_time
+            ADMISSION_PROCESSING_SECONDS.observe(self.processing_seconds, kind=self.kind)
+            self._controller._release(self)
+
+    def cancel(self):
+        """
+        Освобождает место в очереди без обработки (например, результат взят из кэша).
+        """
+        self._controller._cancel(self)
+
+
+class AdmissionController:
+    """
+    Допуск задач перед постановкой в очередь обработки.
+    max_in_flight - сколько задач обрабатывается одновременно, max_queue - сколько
+    допущенных задач может ждать слота, max_memory_bytes - бюджет RSS (None - без ограничения).
+    Сверх лимитов admit() сразу выбрасывает Overloaded с оценкой Retry-After.
+    """
+
+    def __init__(self, max_in_flight, max_queue, max_memory_bytes=None, memory=used_memory_bytes):
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight must be at least 1, got {max_in_flight}")
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_memory_bytes = max_memory_bytes
+        self._memory = memory
+        self._queued = 0
+        self._running = 0
+        self._avg_processing_seconds = None
+        self.admitted = 0
+        self.rejected = {REJECT_QUEUE_FULL: 0, REJECT_MEMORY: 0}
+        self._condition = threading.Condition()
+
+    def admit(self, kind="document"):
+        """
+        Допускает задачу или выбрасывает Overloaded. Возвращает Ticket.
+        """
+        with self._condition:
+            if self._queued + self._running >= self.max_in_flight + self.max_queue:
+                reason = REJECT_QUEUE_FULL
+            elif self.max_memory_bytes and (self._memory() or 0) > self.max_memory_bytes:
+                reason = REJECT_MEMORY
+            else:
+                self._queued += 1
+                self.admitted += 1
+                return Ticket(self, kind)
+            self.rejected[reason] += 1
+            retry_after = self._retry_after_locked()
+        _log.warning(f"Admission rejected ({reason}), retry after {retry_after} seconds.")
+        raise Overloaded(reason, retry_after)
+
+    def _retry_after_locked(self):
+        # Оценка: сколько займет обработка очереди, стоящей впереди
+        if self._avg_processing_seconds is None:
+            return RETRY_AFTER_SECONDS
+        waves = (self._queued + self._running) / self.max_in_flight
+        seconds = math.ceil(self._avg_processing_seconds * max(waves, 1.0))
+        return min(max(seconds, 1), MAX_RETRY_AFTER_SECONDS)
+
+    def _acquire(self, ticket):
+        with self._condition:
+            if ticket._state != "queued":
+                raise RuntimeError(f"Ticket is {ticket._state}")
+            while self._running >= self.max_in_flight:
+                self._condition.wait()
+            self._queued -= 1
+            self._running += 1
+            ticket._state = "running"
+
+    def _release(self, ticket):
+        with self._condition:
+            self._running -= 1
+            ticket._state = "done"
+            seconds = ticket.processing_seconds
+            self._avg_processing_seconds = seconds if self._avg_processing_seconds is None \
+                else (1 - _EWMA_ALPHA) * self._avg_processing_seconds + _EWMA_ALPHA * seconds
+            self._condition.notify()
+
+    def _cancel(self, ticket):
+        with self._condition:
+            if ticket._state == "queued":
+                self._queued -= 1
+                ticket._state = "cancelled"
+
+    def stats(self):
+        with self._condition:
+            return {
+                "running": self._running,
+                "queued": self._queued,
+                "max_in_flight": self.max_in_flight,
+                "max_queue": self.max_queue,
+                "memory_bytes": self._memory(),
+                "max_memory_bytes": self.max_memory_bytes,
+                "avg_processing_seconds": round(self._avg_processing_seconds, 3)
+                if self._avg_processing_seconds is not None else None,
+                "admitted": self.admitted,
+                "rejected_queue_full": self.rejected[REJECT_QUEUE_FULL],
+                "rejected_memory": self.rejected[REJECT_MEMORY],
+            }
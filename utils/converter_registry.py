@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+
+_log = logging.getLogger(__name__)
+
+
+class ConverterRegistry:
+    """
+    Реестр долгоживущих DocumentConverter на процесс.
+    Конвертер создается один раз на набор параметров и переиспользуется между запросами.
+    Время создания и прогрева хранится отдельно, чтобы видеть стоимость холодного старта.
+    """
+
+    def __init__(self):
+        self._converters = {}
+        self._stats = {}
+        # Общая блокировка защищает только словари; создание и прогрев идут под блокировкой
+        # своего ключа, чтобы холодный старт одного конвертера не задерживал остальные
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _pending_formats(self, key, warm_formats):
+        stats = self._stats[key]
+        return [input_format for input_format in warm_formats
+                if getattr(input_format, "value", str(input_format)) not in stats["warmup_seconds"]]
+
+    def get(self, name, options, factory, warm_formats=()):
+        """
+        Возвращает конвертер для (name, options), создавая его через factory() при первом обращении.
+        warm_formats - форматы, пайплайны которых нужно инициализировать заранее.
+        """
+        key = (name, options)
+        with self._lock:
+            converter = self._converters.get(key)
+            if converter is not None and not self._pending_formats(key, warm_formats):
+                self._stats[key]["uses"] += 1
+                return converter
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                converter = self._converters.get(key)
+            if converter is None:
+                start_time = time.time()
+                converter = factory()
+                build_seconds = time.time() - start_time
+                with self._lock:
+                    self._converters[key] = converter
+                    self._stats[key] = {
+                        "name": name,
+                        "options": list(options),
+                        "build_seconds": round(build_seconds, 4),
+                        "warmup_seconds": {},
+                        "uses": 0,
+                    }
+                _log.info(f"Converter '{name}' {options} built in {build_seconds:.2f} seconds.")
+
+            with self._lock:
+                pending = self._pending_formats(key, warm_formats)
+            for input_format in pending:
+                format_name = getattr(input_format, "value", str(input_format))
+                start_time = time.time()
+                try:
+                    converter.initialize_pipeline(input_format)
+                except Exception as e:
+                    _log.error(f"Error warming up converter '{name}' for {format_name}: {e}")
+                    continue
+                warmup_seconds = round(time.time() - start_time, 4)
+                with self._lock:
+                    self._stats[key]["warmup_seconds"][format_name] = warmup_seconds
+                _log.info(f"Converter '{name}' pipeline for {format_name} initialized "
+                          f"in {warmup_seconds:.2f} seconds.")
+            with self._lock:
+                self._stats[key]["uses"] += 1
+            return converter
+
+    def stats(self):
+        """
+        Время создания и прогрева каждого конвертера.
+        """
+        with self._lock:
+            result = []
+            for stats in self._stats.values():
+                item = dict(stats, warmup_seconds=dict(stats["warmup_seconds"]))
+                item["init_seconds"] = round(stats["build_seconds"] + sum(stats["warmup_seconds"].values()), 4)
+                result.append(item)
+            return result
+
+    def clear(self):
+        with self._lock:
+            self._converters.clear()
+            self._stats.clear()
+
+
+registry = ConverterRegistry()
@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+
+_log = logging.getLogger(__name__)
+
+# Файлы хранилища эмбеддингов документа
+STORE_EMBEDDINGS = "store_embeddings.npy"
+STORE_POOLED = "store_pooled.npy"
+STORE_MANIFEST = "store_manifest.json"
+STORE_DTYPES = ("float32", "float16")
+
+_PAGE_NUMBER_RE = re.compile(r"-(\d+)$")
+
+
+def page_number_from_name(path):
+    """
+    Номер страницы из имени файла вида <документ>-<номер>.png, иначе None.
+    """
+    match = _PAGE_NUMBER_RE.search(Path(path).stem)
+    return int(match.group(1)) if match else None
+
+
+def page_sort_key(path):
+    """
+    Ключ сортировки страниц по номеру, а не по строке имени.
+    """
+    page_no = page_number_from_name(path)
+    return (page_no is None, page_no if page_no is not None else 0, Path(path).name)
+
+
+class EmbeddingStoreWriter:
+    """
+    Пишет эмбеддинги страниц документа в один непрерывный массив (N, tokens, hidden)
+    через memmap, опционально - усредненный вектор страницы (N, hidden),
+    и manifest с соответствием строк номерам страниц.
+    """
+
+    def __init__(self, store_dir, num_pages, dtype="float32", pooled=True, model_name=None):
+        if dtype not in STORE_DTYPES:
+            raise ValueError(f"dtype must be one of {STORE_DTYPES}, got {dtype}")
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.num_pages = num_pages
+        self.dtype = dtype
+        self.pooled = pooled
+        self.model_name = model_name
+        self.rows = []
+        self._embeddings = None
+        self._pooled = None
+
+    def _allocate(self, token_shape):
+        self._embeddings = np.lib.format.open_memmap(
+            self.store_dir / STORE_EMBEDDINGS, mode="w+", dtype=self.dtype,
+            shape=(self.num_pages,) + tuple(token_shape)
+        )
+        if self.pooled:
+            self._pooled = np.lib.format.open_memmap(
+                self.store_dir / STORE_POOLED, mode="w+", dtype=self.dtype,
+                shape=(self.num_pages, token_shape[-1])
+            )
+
+    def add(self, page_no, source, embedding):
+        """
+        Добавляет эмбеддинг страницы формы (1, tokens, hidden) или (tokens, hidden).
+        """
+        embedding = np.asarray(embedding)
+        if embedding.ndim == 3:
+            embedding = embedding[0]
+        if self._embeddings is None:
+            self._allocate(embedding.shape)
+        row = len(self.rows)
+        if row >= self.num_pages:
+            raise IndexError(f"Store allocated for {self.num_pages} pages is full.")
+        self._embeddings[row] = embedding
+        if self._pooled is not None:
+            self._pooled[row] = embedding.mean(axis=0)
+        self.rows.append({"row": row, "page_no": page_no, "source": str(source)})
+
+    def close(self):
+        """
+        Сбрасывает массивы на диск и записывает manifest. Возвращает путь к manifest.
+        """
+        shape = None
+        if self._embeddings is not None:
+            self._embeddings.flush()
+            shape = list(self._embeddings.shape)
+            if self._pooled is not None:
+                self._pooled.flush()
+            self._embeddings = None
+            self._pooled = None
+            if len(self.rows) < self.num_pages:
+                # Часть страниц не обработана - обрезаем массивы до фактического числа строк
+                shape = self._truncate(len(self.rows))
+
+        manifest = {
+            "model_name": self.model_name,
+            "dtype": self.dtype,
+            "shape": shape,
+            "pooled": self.pooled and shape is not None,
+            "rows": self.rows,
+        }
+        manifest_path = self.store_dir / STORE_MANIFEST
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        _log.info(f"Embedding store saved: {self.store_dir} ({len(self.rows)} pages, {self.dtype})")
+        return manifest_path
+
+    def _truncate(self, rows):
+        shape = None
+        for name in (STORE_EMBEDDINGS, STORE_POOLED):
+            path = self.store_dir / name
+            if not path.exists():
+                continue
+            data = np.load(path, mmap_mode="r")[:rows]
+            tmp_path = path.with_suffix(".tmp.npy")
+            np.save(tmp_path, data)
+            del data
+            os.replace(tmp_path, path)
+            if name == STORE_EMBEDDINGS:
+                shape = [rows] + list(np.load(path, mmap_mode="r").shape[1:])
+        return shape
+
+
+class EmbeddingStore:
+    """
+    Чтение хранилища эмбеддингов документа. Массивы открываются через memmap.
+    """
+
+    def __init__(self, store_dir, mmap=True):
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir / STORE_MANIFEST, "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        mmap_mode = "r" if mmap else None
+        self.embeddings = None
+        self.pooled = None
+        if self.manifest["shape"] is not None:
+            self.embeddings = np.load(self.store_dir / STORE_EMBEDDINGS, mmap_mode=mmap_mode)
+            if self.manifest["pooled"]:
+                self.pooled = np.load(self.store_dir / STORE_POOLED, mmap_mode=mmap_mode)
+        self._rows_by_page = {row["page_no"]: row["row"] for row in self.manifest["rows"]}
+
+    @staticmethod
+    def exists(store_dir):
+        return (Path(store_dir) / STORE_MANIFEST).exists()
+
+    @property
+    def pages(self):
+        return [row["page_no"] for row in self.manifest["rows"]]
+
+    def __len__(self):
+        return len(self.manifest["rows"])
+
+    def row_for_page(self, page_no):
+        return self._rows_by_page.get(page_no)
+
+    def get(self, page_no, pooled=False):
+        """
+        Эмбеддинг страницы page_no (или ее усредненный вектор) либо None.
+        """
+        row = self.row_for_page(page_no)
+        if row is None:
+            return None
+        source = self.pooled if pooled else self.embeddings
+        if source is None:
+            return None
+        return source[row]
@@ -1,6 +1,7 @@
 import os
 import shutil
 import logging
+from bs4 import BeautifulSoup
 
 _log = logging.getLogger(__name__)
 
@@ -19,4 +20,24 @@ def process_directory_png(output_images_dir, output_embeddings_dir):
                 except Exception as e:
                     print(f"Movement error '{filename}': {e}")
             else:
-                print(f"The file '{filename}' is not .npy, skipped")
\ No newline at end of file
+                print(f"The file '{filename}' is not .npy, skipped")
+
+def replace_char_in_links_bs4(html_file, old_char, new_char, output_file):
+    """
+    Заменяет подстроку old_char на new_char в атрибутах href и src HTML-файла.
+    """
+    try:
+        with open(html_file, "r", encoding="utf-8") as f:
+            soup = BeautifulSoup(f.read(), "html.parser")
+
+        for tag in soup.find_all(href=True):
+            tag["href"] = tag["href"].replace(old_char, new_char)
+        for tag in soup.find_all(src=True):
+            tag["src"] = tag["src"].replace(old_char, new_char)
+
+        with open(output_file, "w", encoding="utf-8") as f:
+            f.write(str(soup))
+        return True
+    except Exception as e:
+        _log.error(f"Error replacing '{old_char}' in links of {html_file}: {e}")
+        return False
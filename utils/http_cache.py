@@ -0,0 +1,174 @@
+import hashlib
+import logging
+import os
+import re
+from pathlib import Path
+from urllib.parse import quote
+
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+_log = logging.getLogger(__name__)
+
+# Артефакты привязаны к сессии из куки: кэшировать можно только у клиента и с проверкой ETag
+CACHE_CONTROL = "private, no-cache"
+
+# Размер блока при отдаче диапазона файла
+CHUNK_SIZE = 256 * 1024
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def file_etag(path):
+    """
+    Сильный ETag файла по имени, размеру и времени изменения.
+    Артефакты сессии после записи не меняются, поэтому совпадение stat означает совпадение байтов.
+    """
+    stat = os.stat(path)
+    payload = f"{Path(path).name}:{stat.st_size}:{stat.st_mtime_ns}"
+    return '"' + hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def bytes_etag(data):
+    """
+    Сильный ETag по содержимому.
+    """
+    return '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+
+
+def _opaque(etag):
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def not_modified(request, etag):
+    """
+    True, если If-None-Match совпадает с etag (слабое сравнение, как требует RFC 9110).
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(_opaque(tag.strip()) == _opaque(etag) for tag in header.split(","))
+
+
+def parse_range(header, size):
+    """
+    Разбирает заголовок Range для одного диапазона байтов.
+    Возвращает (start, end) включительно или None, если Range нужно игнорировать
+    (нет заголовка, другая единица, несколько диапазонов, конец раньше начала).
+    Недостижимый диапазон - RangeNotSatisfiable.
+    """
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # bytes=-N - последние N байтов
+        length = int(last)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        # Синтаксически неверный диапазон по RFC 9110 игнорируется, как отсутствующий Range
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    end = min(int(last), size - 1) if last else size - 1
+    return start, end
+
+
+def _range_for(request, etag, size):
+    header = request.headers.get("range")
+    if not header:
+        return None
+    # If-Range с другим ETag (или датой) - отдаем файл целиком
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range.strip() != etag:
+        return None
+    return parse_range(header, size)
+
+
+def _headers(etag, extra=None):
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": CACHE_CONTROL}
+    headers.update(extra or {})
+    return headers
+
+
+def content_disposition(filename):
+    # Имена не в ASCII передаются через filename* (RFC 6266), как в starlette FileResponse
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def _iter_file(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def file_response(request, path, media_type, filename=None, headers=None):
+    """
+    Отдает файл с сильным ETag: 304 при совпадении If-None-Match,
+    206 с Content-Range для одного диапазона Range, 416 для недостижимого диапазона.
+    """
+    path = Path(path)
+    etag = file_etag(path)
+    size = path.stat().st_size
+    extra = dict(headers or {})
+
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=_headers(etag))
+    try:
+        byte_range = _range_for(request, etag, size)
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers=_headers(etag, {"Content-Range": f"bytes */{size}"}))
+
+    if byte_range is None:
+        # Файл целиком отдает FileResponse (sendfile); ETag из headers он не перезаписывает
+        return FileResponse(path, media_type=media_type, filename=filename, headers=_headers(etag, extra))
+    start, end = byte_range
+    if filename:
+        extra["Content-Disposition"] = content_disposition(filename)
+    extra["Content-Length"] = str(end - start + 1)
+    extra["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return StreamingResponse(_iter_file(path, start, end), status_code=206, media_type=media_type,
+                             headers=_headers(etag, extra))
+
+
+def bytes_response(request, data, media_type, headers=None):
+    """
+    То же для содержимого в памяти (например, эмбеддинга страницы).
+    """
+    etag = bytes_etag(data)
+    size = len(data)
+    extra = dict(headers or {})
+
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=_headers(etag))
+    try:
+        byte_range = _range_for(request, etag, size)
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers=_headers(etag, {"Content-Range": f"bytes */{size}"}))
+
+    if byte_range is None:
+        return Response(data, media_type=media_type, headers=_headers(etag, extra))
+    start, end = byte_range
+    extra["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return Response(data[start:end + 1], status_code=206, media_type=media_type, headers=_headers(etag, extra))
@@ -0,0 +1,142 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from utils.metrics import registry as metrics_registry, SECONDS_BUCKETS
+
+_log = logging.getLogger(__name__)
+
+# Форматы записи изображений:
+# png - PNG с настраиваемым уровнем сжатия (0-9);
+# webp - WebP без потерь, уровень - method (0 быстрее, 6 компактнее);
+# raw - PNG без сжатия (compress_level=0): самый быстрый, читается везде как PNG.
+IMAGE_FORMATS = ("png", "webp", "raw")
+# Страницы читаются дальше по маске *.png, поэтому для них допустимы только форматы PNG
+PAGE_IMAGE_FORMATS = ("png", "raw")
+
+DEFAULT_LEVELS = {"png": 1, "webp": 0, "raw": 0}
+
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "png")
+IMAGE_LEVEL = os.environ.get("IMAGE_LEVEL")
+PAGE_IMAGE_FORMAT = os.environ.get("PAGE_IMAGE_FORMAT", "png")
+PAGE_IMAGE_LEVEL = os.environ.get("PAGE_IMAGE_LEVEL")
+IMAGE_WRITER_WORKERS = int(os.environ.get("IMAGE_WRITER_WORKERS", str(min(8, os.cpu_count() or 1))))
+
+IMAGE_ENCODE_SECONDS = metrics_registry.histogram(
+    "image_encode_seconds", "Time to encode and write one image.", SECONDS_BUCKETS, ("format",))
+
+_executor = None
+_executor_lock = threading.Lock()
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _get_executor():
+    """
+    Общий пул потоков записи, создается при первом обращении.
+    PIL освобождает GIL при кодировании, поэтому потоков достаточно.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=IMAGE_WRITER_WORKERS, thread_name_prefix="image-writer")
+        return _executor
+
+
+def _record(image_format, seconds, size):
+    IMAGE_ENCODE_SECONDS.observe(seconds, format=image_format)
+    with _stats_lock:
+        stats = _stats.setdefault(image_format, {"images": 0, "seconds": 0.0, "bytes": 0})
+        stats["images"] += 1
+        stats["seconds"] += seconds
+        stats["bytes"] += size
+
+
+def stats():
+    """
+    Число изображений, суммарное время и объем записи по форматам.
+    """
+    with _stats_lock:
+        result = {}
+        for image_format, values in _stats.items():
+            result[image_format] = dict(values, seconds=round(values["seconds"], 4))
+            result[image_format]["seconds_per_image"] = round(values["seconds"] / values["images"], 4) \
+                if values["images"] else None
+        return result
+
+
+class ImageWriter:
+    """
+    Запись изображений PIL в выбранном формате в общем пуле потоков.
+    submit() возвращает Future, wait() дожидается записи и пробрасывает первую ошибку.
+    """
+
+    def __init__(self, image_format="png", level=None, allowed_formats=IMAGE_FORMATS):
+        if image_format not in allowed_formats:
+            raise ValueError(f"image_format must be one of {allowed_formats}, got {image_format}")
+        self.image_format = image_format
+        self.level = int(level) if level is not None else DEFAULT_LEVELS[image_format]
+
+    @property
+    def suffix(self):
+        return ".webp" if self.image_format == "webp" else ".png"
+
+    def path_for(self, path):
+        """
+        Путь с добавленным расширением формата записи. Расширение дописывается, а не заменяет
+        часть после последней точки, так как имена документов могут содержать точки.
+        """
+        path = Path(path)
+        return path.with_name(path.name + self.suffix)
+
+    def _save_options(self):
+        if self.image_format == "webp":
+            return {"format": "WEBP", "lossless": True, "method": self.level}
+        if self.image_format == "raw":
+            return {"format": "PNG", "compress_level": 0}
+        return {"format": "PNG", "compress_level": self.level}
+
+    def save(self, image, path):
+        """
+        Записывает изображение в текущем потоке. Возвращает путь.
+        """
+        start_time = time.perf_counter()
+        image.save(path, **self._save_options())
+        _record(self.image_format, time.perf_counter() - start_time, os.path.getsize(path))
+        return path
+
+    def submit(self, image, path):
+        return _get_executor().submit(self.save, image, path)
+
+    @staticmethod
+    def wait(futures):
+        """
+        Дожидается всех записей. Возвращает пути, первая ошибка пробрасывается.
+        """
+        paths = []
+        error = None
+        for future in futures:
+            try:
+                paths.append(future.result())
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return paths
+
+
+def get_image_writer():
+    """
+    Запись извлеченных картинок и таблиц: IMAGE_FORMAT, IMAGE_LEVEL.
+    """
+    return ImageWriter(IMAGE_FORMAT, IMAGE_LEVEL)
+
+
+def get_page_writer():
+    """
+    Запись изображений страниц: PAGE_IMAGE_FORMAT, PAGE_IMAGE_LEVEL (только PNG).
+    """
+    return ImageWriter(PAGE_IMAGE_FORMAT, PAGE_IMAGE_LEVEL, allowed_formats=PAGE_IMAGE_FORMATS)
@@ -0,0 +1,240 @@
+import copy
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, nullcontext
+
+from utils import state_db
+
+_log = logging.getLogger(__name__)
+
+# Статусы задачи и этапов
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_SUCCESS = "success"
+STATUS_FAILED = "failed"
+STATUS_PENDING = "pending"
+STATUS_SKIPPED = "skipped"
+
+
+class SqliteJobStore:
+    """
+    Состояние задач в файле SQLite, общее для процессов (см. utils.state_db).
+    Позволяет узнать статус задачи на любом воркере, а не только на том, где она выполняется.
+    """
+
+    def __init__(self, path, root=None):
+        self.path = path
+        self.root = root
+        with state_db.transaction(self.path) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, data TEXT NOT NULL, finished_at REAL)")
+
+    def save(self, job):
+        with state_db.transaction(self.path) as conn:
+            conn.execute("INSERT OR REPLACE INTO jobs (job_id, data, finished_at) VALUES (?, ?, ?)",
+                         (job["job_id"], state_db.dumps(job, self.root), job["finished_at"]))
+
+    def load(self, job_id):
+        with closing(state_db.connect(self.path)) as conn:
+            row = conn.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return state_db.loads(row[0], self.root) if row else None
+
+    def delete(self, job_id):
+        with state_db.transaction(self.path) as conn:
+            conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+    def prune(self, max_age_seconds):
+        cutoff = time.time() - max_age_seconds
+        with state_db.transaction(self.path) as conn:
+            rows = conn.execute("SELECT job_id FROM jobs WHERE finished_at < ?", (cutoff,)).fetchall()
+            conn.execute("DELETE FROM jobs WHERE finished_at < ?", (cutoff,))
+        return [row[0] for row in rows]
+
+
+class JobManager:
+    """
+    Очередь фоновых задач с ограниченным пулом потоков.
+    Хранит статус каждой задачи и ее этапов, чтобы API мог отдавать прогресс.
+    Если задан store (SqliteJobStore), каждое изменение статуса записывается и в него,
+    а get() находит там задачи других процессов.
+    """
+
+    def __init__(self, max_workers=2, store=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._store = store
+        self.max_workers = max_workers
+
+    def submit(self, func, *args, job_id=None, stages=(), on_success=None, ticket=None, **kwargs):
+        """
+        Ставит func в очередь. func получает аргумент progress_callback(stage, status).
+        on_success(job_id, result) вызывается в рабочем потоке после успешного выполнения.
+        ticket - допуск utils.admission.Ticket: задача начнется, когда он получит слот обработки.
+        """
+        job_id = self.track(job_id or str(uuid.uuid4()), stages)
+        self._executor.submit(self._run, job_id, func, args, kwargs, on_success, ticket)
+        _log.info(f"Job {job_id} queued.")
+        return job_id
+
+    def track(self, job_id, stages=()):
+        """
+        Регистрирует задачу в очереди без запуска. Используется для документов пакета:
+        их выполняет задача пакета, а итог записывается через complete() или fail().
+        """
+        with self._lock:
+            self._jobs[job_id] = {
+                "job_id": job_id,
+                "status": STATUS_QUEUED,
+                "stage": None,
+                "stages": {stage: STATUS_PENDING for stage in stages},
+                "progress": 0.0,
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "queue_seconds": None,
+                "processing_seconds": None,
+                "error": None,
+                "result": None,
+            }
+        self._persist(job_id)
+        return job_id
+
+    def complete(self, job_id, result, stages=(), stage_status=STATUS_SUCCESS):
+        """
+        Регистрирует уже выполненную задачу (например, результат из кэша).
+        """
+        now = time.time()
+        with self._lock:
+            self._jobs[job_id] = {
+                "job_id": job_id,
+                "status": STATUS_SUCCESS,
+                "stage": None,
+                "stages": {stage: stage_status for stage in stages},
+                "progress": 1.0,
+                "created_at": now,
+                "started_at": now,
+                "finished_at": now,
+                "queue_seconds": 0.0,
+                "processing_seconds": 0.0,
+                "error": None,
+                "result": result,
+            }
+        self._persist(job_id)
+        return job_id
+
+    def fail(self, job_id, error):
+        """
+        Отмечает задачу, зарегистрированную через track(), как завершенную с ошибкой.
+        """
+        self._update(job_id, status=STATUS_FAILED, error=str(error), finished_at=time.time())
+
+    def get(self, job_id):
+        """
+        Возвращает копию состояния задачи или None.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                return copy.deepcopy(job)
+        if self._store is not None:
+            try:
+                return self._store.load(job_id)
+            except Exception as e:
+                _log.error(f"Error loading job {job_id}: {e}")
+        return None
+
+    def remove(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+        if self._store is not None:
+            self._store.delete(job_id)
+
+    def prune(self, max_age_seconds):
+        """
+        Удаляет завершенные задачи старше max_age_seconds. Возвращает их идентификаторы.
+        """
+        now = time.time()
+        removed = []
+        with self._lock:
+            for job_id, job in list(self._jobs.items()):
+                finished_at = job["finished_at"]
+                if finished_at is not None and now - finished_at > max_age_seconds:
+                    del self._jobs[job_id]
+                    removed.append(job_id)
+        if self._store is not None:
+            removed.extend(job_id for job_id in self._store.prune(max_age_seconds) if job_id not in removed)
+        return removed
+
+    def counts(self):
+        """
+        Количество задач по статусам.
+        """
+        counts = {STATUS_QUEUED: 0, STATUS_RUNNING: 0, STATUS_SUCCESS: 0, STATUS_FAILED: 0}
+        with self._lock:
+            for job in self._jobs.values():
+                counts[job["status"]] += 1
+        return counts
+
+    def shutdown(self, wait=False):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _persist(self, job_id):
+        """
+        Записывает текущее состояние задачи в общее хранилище.
+        """
+        if self._store is None:
+            return
+        with self._lock:
+            job = copy.deepcopy(self._jobs.get(job_id))
+        if job is None:
+            return
+        try:
+            self._store.save(job)
+        except Exception as e:
+            _log.error(f"Error saving job {job_id}: {e}")
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                job.update(fields)
+        self._persist(job_id)
+
+    def _progress_callback(self, job_id):
+        def callback(stage, status):
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if not job:
+                    return
+                job["stages"][stage] = status
+                if status == STATUS_RUNNING:
+                    job["stage"] = stage
+                done = sum(1 for value in job["stages"].values() if value in (STATUS_SUCCESS, STATUS_SKIPPED))
+                job["progress"] = round(done / len(job["stages"]), 3) if job["stages"] else 0.0
+            self._persist(job_id)
+        return callback
+
+    def _run(self, job_id, func, args, kwargs, on_success, ticket=None):
+        # Ожидание в очереди (в том числе слота допуска) и обработка считаются отдельно
+        with ticket.running() if ticket is not None else nullcontext():
+            started_at = time.time()
+            with self._lock:
+                created_at = self._jobs[job_id]["created_at"] if job_id in self._jobs else started_at
+            self._update(job_id, status=STATUS_RUNNING, started_at=started_at,
+                         queue_seconds=round(started_at - created_at, 3))
+            try:
+                result = func(*args, progress_callback=self._progress_callback(job_id), **kwargs)
+                if on_success:
+                    on_success(job_id, result)
+                finished_at = time.time()
+                self._update(job_id, status=STATUS_SUCCESS, stage=None, progress=1.0, result=result,
+                             finished_at=finished_at, processing_seconds=round(finished_at - started_at, 3))
+                _log.info(f"Job {job_id} finished.")
+            except Exception as e:
+                _log.error(f"Job {job_id} failed: {e}")
+                finished_at = time.time()
+                self._update(job_id, status=STATUS_FAILED, error=str(e), finished_at=finished_at,
+                             processing_seconds=round(finished_at - started_at, 3))
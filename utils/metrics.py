@@ -0,0 +1,284 @@
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+_log = logging.getLogger(__name__)
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Границы корзин гистограмм
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+PAGES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+BYTES_BUCKETS = tuple(1024 ** 2 * size for size in (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1024, 4096))
+
+# Известные типы входных документов (расширения форматов docling). Метка doc_type берется
+# из имени загруженного файла, поэтому остальные расширения сводятся к "other",
+# иначе число рядов метрик не ограничено
+DOC_TYPES = frozenset((
+    "pdf", "docx", "pptx", "xlsx", "html", "htm", "xhtml", "md", "csv", "asciidoc", "adoc",
+    "png", "jpg", "jpeg", "tif", "tiff", "bmp", "webp",
+))
+
+# Интервал опроса RSS во время этапа
+RSS_SAMPLE_INTERVAL = 0.05
+
+
+def current_rss_bytes():
+    """
+    Текущий RSS процесса в байтах или None, если его нельзя получить.
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_bytes():
+    """
+    Пиковый RSS процесса за все время работы в байтах или None.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # В Linux значение в килобайтах, в macOS - в байтах
+        return peak if sys.platform == "darwin" else peak * 1024
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss)
+    return None
+
+
+def doc_type_label(doc_type):
+    """
+    Значение метки doc_type: известный тип документа, "other" или "" (не задан).
+    """
+    doc_type = (doc_type or "").lower().lstrip(".")
+    if not doc_type:
+        return ""
+    return doc_type if doc_type in DOC_TYPES else "other"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{escaped}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    Гистограмма в формате Prometheus с метками.
+    """
+
+    def __init__(self, name, help_text, buckets, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple((name, labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                self._series[key] = series
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series["counts"]):
+                    labels = _format_labels(key + (("le", _format_value(float(bound))),))
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(key + (("le", "+Inf"),))
+                lines.append(f"{self.name}_bucket{labels} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+
+class Gauge:
+    """
+    Gauge, значения которого вычисляются при выдаче метрик.
+    collect() возвращает список пар (словарь меток, значение).
+    """
+
+    def __init__(self, name, help_text, collect):
+        self.name = name
+        self.help_text = help_text
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        try:
+            samples = self.collect()
+        except Exception as e:
+            _log.error(f"Error collecting metric {self.name}: {e}")
+            return lines
+        for labels, value in samples:
+            if value is None:
+                continue
+            lines.append(f"{self.name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help_text, buckets, labelnames=()):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Histogram(name, help_text, buckets, labelnames)
+            return self._metrics[name]
+
+    def gauge(self, name, help_text, collect):
+        with self._lock:
+            self._metrics[name] = Gauge(name, help_text, collect)
+            return self._metrics[name]
+
+    def render(self):
+        """
+        Все метрики в текстовом формате Prometheus.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.histogram(
+    "pipeline_stage_duration_seconds", "Duration of a pipeline stage.", SECONDS_BUCKETS, ("stage", "doc_type"))
+STAGE_PAGES = registry.histogram(
+    "pipeline_stage_pages", "Pages produced or consumed by a pipeline stage.", PAGES_BUCKETS, ("stage", "doc_type"))
+STAGE_BYTES_IN = registry.histogram(
+    "pipeline_stage_bytes_in", "Input bytes of a pipeline stage.", BYTES_BUCKETS, ("stage", "doc_type"))
+STAGE_BYTES_OUT = registry.histogram(
+    "pipeline_stage_bytes_out", "Output bytes of a pipeline stage.", BYTES_BUCKETS, ("stage", "doc_type"))
+STAGE_PEAK_RSS = registry.histogram(
+    "pipeline_stage_peak_rss_bytes", "Peak process RSS observed during a pipeline stage.", BYTES_BUCKETS,
+    ("stage", "doc_type"))
+
+
+class _RssSampler(threading.Thread):
+    """
+    Фоновый опрос RSS для оценки пика памяти за время этапа.
+    """
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = current_rss_bytes()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            rss = current_rss_bytes()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        rss = current_rss_bytes()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+        return self.peak
+
+
+class Span:
+    """
+    Результат одного этапа. pages и bytes_out заполняются внутри блока stage_span.
+    """
+
+    def __init__(self, stage, doc_type, bytes_in=None):
+        self.stage = stage
+        self.doc_type = doc_type
+        self.bytes_in = bytes_in
+        self.bytes_out = None
+        self.pages = None
+        self.duration_seconds = None
+        self.peak_rss_bytes = None
+        self.status = "running"
+
+    def as_dict(self):
+        return {
+            "stage": self.stage,
+            "doc_type": self.doc_type,
+            "status": self.status,
+            "duration_seconds": round(self.duration_seconds, 4) if self.duration_seconds is not None else None,
+            "pages": self.pages,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "peak_rss_bytes": self.peak_rss_bytes,
+        }
+
+
+@contextmanager
+def stage_span(stage, doc_type="", bytes_in=None, spans=None):
+    """
+    Замеряет этап: длительность, страницы, байты на входе и выходе, пиковый RSS.
+    Результат добавляется в spans (список словарей) и в гистограммы реестра.
+    """
+    doc_type = doc_type_label(doc_type)
+    span = Span(stage, doc_type, bytes_in)
+    sampler = _RssSampler()
+    sampler.start()
+    start_time = time.perf_counter()
+    try:
+        yield span
+        span.status = "success"
+    except BaseException:
+        span.status = "failed"
+        raise
+    finally:
+        span.duration_seconds = time.perf_counter() - start_time
+        span.peak_rss_bytes = sampler.stop()
+        if spans is not None:
+            spans.append(span.as_dict())
+        labels = {"stage": stage, "doc_type": doc_type}
+        STAGE_SECONDS.observe(span.duration_seconds, **labels)
+        if span.pages is not None:
+            STAGE_PAGES.observe(span.pages, **labels)
+        if span.bytes_in is not None:
+            STAGE_BYTES_IN.observe(span.bytes_in, **labels)
+        if span.bytes_out is not None:
+            STAGE_BYTES_OUT.observe(span.bytes_out, **labels)
+        if span.peak_rss_bytes is not None:
+            STAGE_PEAK_RSS.observe(span.peak_rss_bytes, **labels)
+        _log.info(f"Stage {stage} ({doc_type}) {span.status} in {span.duration_seconds:.2f} seconds.")
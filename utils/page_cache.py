@@ -0,0 +1,137 @@
+import hashlib
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+_log = logging.getLogger(__name__)
+
+
+def page_key(image, model_id):
+    """
+    Ключ страницы: SHA-256 пикселей отрисованной страницы (RGB), ее размера и идентификатора модели.
+    """
+    digest = hashlib.sha256()
+    digest.update(model_id.encode("utf-8"))
+    digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}".encode("ascii"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class PageEmbeddingCache:
+    """
+    Дисковый кэш эмбеддингов отдельных страниц с вытеснением LRU по суммарному размеру.
+    Позволяет при повторной загрузке исправленного документа считать заново
+    только новые и измененные страницы. Каждая запись - .npy в подкаталоге по первым
+    символам ключа.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        # Суммарный размер записей ведется при добавлении и вытеснении, а не пересчитывается
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key):
+        return self.root / key[:2] / f"{key}.npy"
+
+    def _load_index(self):
+        entries = []
+        for path in self.root.glob("*/*"):
+            if path.suffix != ".npy" or path.name.startswith(".tmp-"):
+                # Незавершенная запись после аварийной остановки
+                path.unlink(missing_ok=True)
+                continue
+            stat = path.stat()
+            entries.append((stat.st_mtime, path.stem, stat.st_size))
+        for _mtime, key, size in sorted(entries):
+            self._entries[key] = size
+            self._total_bytes += size
+        _log.info(f"Page embedding cache loaded: {len(self._entries)} entries, {self.total_bytes} bytes.")
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def get(self, key):
+        """
+        Эмбеддинг страницы или None.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        path = self._path(key)
+        try:
+            embedding = np.load(path)
+            os.utime(path)
+            return embedding
+        except Exception as e:
+            _log.error(f"Error reading page embedding {key}: {e}")
+            with self._lock:
+                self._total_bytes -= self._entries.pop(key, 0)
+                self.hits -= 1
+                self.misses += 1
+            return None
+
+    def put(self, key, embedding):
+        """
+        Сохраняет эмбеддинг страницы. Возвращает True, если запись есть в кэше.
+        """
+        path = self._path(key)
+        with self._lock:
+            if key in self._entries:
+                return True
+        tmp_path = path.with_name(f".tmp-{uuid.uuid4().hex}.npy")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            np.save(tmp_path, embedding)
+            size = tmp_path.stat().st_size
+            if size > self.max_bytes:
+                tmp_path.unlink(missing_ok=True)
+                return False
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._total_bytes += size - self._entries.get(key, 0)
+                self._entries[key] = size
+                evicted = self._evict_locked()
+            for old_key in evicted:
+                self._path(old_key).unlink(missing_ok=True)
+            return True
+        except Exception as e:
+            _log.error(f"Error caching page embedding {key}: {e}")
+            tmp_path.unlink(missing_ok=True)
+            return False
+
+    def _evict_locked(self):
+        evicted = []
+        while self._entries and self._total_bytes > self.max_bytes:
+            old_key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            evicted.append(old_key)
+            self.evictions += 1
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
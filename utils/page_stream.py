@@ -0,0 +1,96 @@
+import logging
+import queue
+import threading
+from concurrent.futures import wait
+from pathlib import Path
+
+from utils.image_writer import ImageWriter, get_page_writer
+
+_log = logging.getLogger(__name__)
+
+# Размер очереди страниц между отрисовкой и эмбеддером по умолчанию
+PAGE_QUEUE_SIZE = 32
+
+# Интервал проверки остановки, пока производитель ждет места в очереди
+_PUT_TIMEOUT = 0.1
+
+_DONE = object()
+
+
+class PageStream:
+    """
+    Передача отрисованных страниц эмбеддеру в памяти через ограниченную очередь.
+    pages - итерируемое (номер страницы, имя файла, PIL.Image); оно выполняется
+    в отдельном потоке, поэтому отрисовка идет параллельно с инференсом,
+    а заполненная очередь притормаживает отрисовку.
+    Если задан images_dir, страницы дополнительно сохраняются в PNG в общем пуле записи
+    utils.image_writer (IMAGE_WRITER_WORKERS), не задерживая эмбеддинги. Ошибки отрисовки и записи пробрасываются потребителю.
+    """
+
+    def __init__(self, pages, maxsize=PAGE_QUEUE_SIZE, images_dir=None):
+        self._pages = pages
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._images_dir = Path(images_dir) if images_dir is not None else None
+        self._page_writer = get_page_writer() if images_dir is not None else None
+        self._writes = []
+        self._stop_event = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._produce, name="page-stream", daemon=True)
+        self.produced = 0
+
+    def __enter__(self):
+        if self._images_dir is not None:
+            self._images_dir.mkdir(parents=True, exist_ok=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(wait_writes=exc_type is None)
+
+    def _put(self, item):
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        try:
+            for page_no, name, image in self._pages:
+                if self._page_writer is not None:
+                    self._writes.append(self._page_writer.submit(image, self._images_dir / name))
+                if not self._put((page_no, name, image)):
+                    return
+                self.produced += 1
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._put(_DONE)
+
+    def __iter__(self):
+        """
+        Отдает страницы в порядке отрисовки.
+        """
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                break
+            yield item
+        if self._error is not None:
+            raise self._error
+
+    def close(self, wait_writes=True):
+        """
+        Останавливает производителя и дожидается записи PNG.
+        Записи в общем пуле не отменяются, их ждут в любом случае;
+        первая ошибка записи пробрасывается, если wait_writes=True.
+        """
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        if wait_writes:
+            ImageWriter.wait(self._writes)
+        else:
+            wait(self._writes)
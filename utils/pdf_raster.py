@@ -0,0 +1,188 @@
+import logging
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pypdfium2 as pdfium
+
+from utils.image_writer import ImageWriter, PAGE_IMAGE_FORMATS
+
+_log = logging.getLogger(__name__)
+
+# PDF-единица - 1/72 дюйма, scale=1.0 соответствует 72 DPI
+PDF_POINTS_PER_INCH = 72
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers):
+    """
+    Долгоживущий пул процессов для отрисовки, создается при первом вызове.
+    Используется spawn, так как пул создается из рабочих потоков процесса
+    с уже загруженными torch и docling.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def count_pages(pdf_path):
+    pdf = pdfium.PdfDocument(str(pdf_path))
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+def resolve_page_range(page_count, page_range=None):
+    """
+    Переводит диапазон страниц (первая, последняя) с нумерацией от 1 и включительно
+    в полуинтервал индексов [first, last).
+    """
+    if page_range is None:
+        return 0, page_count
+    first, last = page_range
+    first = max(1, first)
+    last = min(page_count, last if last is not None else page_count)
+    if first > last:
+        raise ValueError(f"Empty page range {page_range} for a document with {page_count} pages")
+    return first - 1, last
+
+
+def render_pages(pdf_path, output_images_dir, doc_filename, first, last, scale, image_format="png", level=None):
+    """
+    Отрисовывает и кодирует в PNG страницы [first, last). Выполняется в процессе пула.
+    image_format и level - параметры utils.image_writer (png или raw).
+    Возвращает пути сохраненных файлов.
+    """
+    writer = ImageWriter(image_format, level, allowed_formats=PAGE_IMAGE_FORMATS)
+    saved = []
+    pdf = pdfium.PdfDocument(str(pdf_path))
+    try:
+        for index in range(first, last):
+            page = pdf[index]
+            try:
+                image = page.render(scale=scale).to_pil()
+                page_image_filename = Path(output_images_dir) / f"{doc_filename}-{index + 1}.png"
+                writer.save(image, page_image_filename)
+                saved.append(str(page_image_filename))
+            finally:
+                page.close()
+    finally:
+        pdf.close()
+    return saved
+
+
+def render_pages_raw(pdf_path, first, last, scale):
+    """
+    Отрисовывает страницы [first, last) без кодирования в PNG. Выполняется в процессе пула.
+    Возвращает список (индекс, режим, размер, сырые байты пикселей).
+    """
+    rendered = []
+    pdf = pdfium.PdfDocument(str(pdf_path))
+    try:
+        for index in range(first, last):
+            page = pdf[index]
+            try:
+                image = page.render(scale=scale).to_pil()
+                rendered.append((index, image.mode, image.size, image.tobytes()))
+            finally:
+                page.close()
+    finally:
+        pdf.close()
+    return rendered
+
+def split_range(first, last, parts):
+    """
+    Делит [first, last) на не более чем parts непрерывных частей.
+    """
+    total = last - first
+    parts = max(1, min(parts, total))
+    step, extra = divmod(total, parts)
+    ranges = []
+    start = first
+    for part in range(parts):
+        end = start + step + (1 if part < extra else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def rasterize_pdf(pdf_path, output_images_dir, scale=1.0, dpi=None, page_range=None, workers=None,
+                  image_format="png", level=None):
+    """
+    Параллельная отрисовка страниц PDF через pypdfium2: диапазон страниц делится
+    между процессами, каждый сам отрисовывает и кодирует свои страницы.
+    dpi, если задан, имеет приоритет над scale. Возвращает список путей PNG.
+    """
+    if dpi is not None:
+        scale = dpi / PDF_POINTS_PER_INCH
+    output_images_dir = Path(output_images_dir)
+    output_images_dir.mkdir(parents=True, exist_ok=True)
+    doc_filename = Path(pdf_path).stem
+
+    first, last = resolve_page_range(count_pages(pdf_path), page_range)
+    workers = workers or os.cpu_count() or 1
+    ranges = split_range(first, last, workers)
+    if len(ranges) == 1:
+        return render_pages(pdf_path, output_images_dir, doc_filename, first, last, scale, image_format, level)
+
+    pool = _get_pool(workers)
+    futures = [pool.submit(render_pages, str(pdf_path), str(output_images_dir), doc_filename, start, end, scale,
+                           image_format, level)
+               for start, end in ranges]
+    saved = []
+    for future in futures:
+        saved.extend(future.result())
+    _log.info(f"Rendered {len(saved)} pages of {pdf_path} with {len(ranges)} processes at scale {scale:.2f}.")
+    return saved
+
+
+def iter_pdf_pages(pdf_path, scale=1.0, dpi=None, page_range=None, workers=None, chunk_pages=4):
+    """
+    Отрисовывает страницы PDF и отдает пары (номер страницы от 1, PIL.Image) по порядку,
+    ничего не записывая на диск. Страницы рисуются частями по chunk_pages в пуле процессов;
+    вперед заказывается не больше workers частей, чтобы память оставалась ограниченной.
+    """
+    from PIL import Image
+
+    if dpi is not None:
+        scale = dpi / PDF_POINTS_PER_INCH
+    first, last = resolve_page_range(count_pages(pdf_path), page_range)
+    workers = workers or os.cpu_count() or 1
+    chunks = [(start, min(start + chunk_pages, last)) for start in range(first, last, chunk_pages)]
+
+    if workers == 1 or len(chunks) <= 1:
+        pdf = pdfium.PdfDocument(str(pdf_path))
+        try:
+            for index in range(first, last):
+                page = pdf[index]
+                try:
+                    image = page.render(scale=scale).to_pil()
+                finally:
+                    page.close()
+                yield index + 1, image
+        finally:
+            pdf.close()
+        return
+
+    pool = _get_pool(workers)
+    remaining = iter(chunks)
+    pending = deque()
+    for start, end in remaining:
+        pending.append(pool.submit(render_pages_raw, str(pdf_path), start, end, scale))
+        if len(pending) >= workers:
+            break
+    while pending:
+        future = pending.popleft()
+        next_chunk = next(remaining, None)
+        if next_chunk is not None:
+            pending.append(pool.submit(render_pages_raw, str(pdf_path), next_chunk[0], next_chunk[1], scale))
+        for index, mode, size, data in future.result():
+            yield index + 1, Image.frombytes(mode, size, data)
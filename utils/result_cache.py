@@ -0,0 +1,195 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+_log = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    SHA-256 содержимого файла.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_cache_key(content_hash, options):
+    """
+    Ключ кэша: хэш входных байтов плюс параметры, влияющие на результат.
+    """
+    payload = json.dumps({"content": content_hash, "options": options}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _tree_size(path):
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _link_tree(src, dst):
+    """
+    Воспроизводит дерево src в dst жесткими ссылками, при невозможности копирует.
+    """
+    for root, _dirs, files in os.walk(src):
+        target_root = Path(dst) / Path(root).relative_to(src)
+        target_root.mkdir(parents=True, exist_ok=True)
+        for name in files:
+            if root == str(src) and name == MANIFEST_NAME:
+                continue
+            source_file = Path(root) / name
+            target_file = target_root / name
+            try:
+                os.link(source_file, target_file)
+            except OSError:
+                shutil.copy2(source_file, target_file)
+
+
+class ResultCache:
+    """
+    Дисковый кэш результатов конвейера с вытеснением LRU по суммарному размеру.
+    Каждая запись - копия выходной директории сессии и manifest.json
+    с относительными путями артефактов.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        # Суммарный размер записей ведется при добавлении и вытеснении, а не пересчитывается
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        entries = []
+        for entry_dir in self.root.iterdir():
+            manifest = entry_dir / MANIFEST_NAME
+            if entry_dir.is_dir() and manifest.exists():
+                entries.append((manifest.stat().st_mtime, entry_dir.name, _tree_size(entry_dir)))
+            elif entry_dir.is_dir():
+                # Незавершенная запись после аварийной остановки
+                shutil.rmtree(entry_dir, ignore_errors=True)
+        for _mtime, key, size in sorted(entries):
+            self._entries[key] = size
+            self._total_bytes += size
+        _log.info(f"Result cache loaded: {len(self._entries)} entries, {self.total_bytes} bytes.")
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def get(self, key, dest_dir):
+        """
+        Восстанавливает запись в dest_dir и возвращает словарь артефактов или None.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        entry_dir = self.root / key
+        try:
+            with open(entry_dir / MANIFEST_NAME, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            _link_tree(entry_dir, dest_dir)
+            os.utime(entry_dir / MANIFEST_NAME)
+        except Exception as e:
+            _log.error(f"Error restoring cache entry {key}: {e}")
+            with self._lock:
+                self.hits -= 1
+                self.misses += 1
+            return None
+
+        _log.info(f"Result cache hit: {key}")
+        return {name: (Path(dest_dir) / rel if rel is not None else None)
+                for name, rel in manifest["artifacts"].items()}
+
+    def put(self, key, source_dir, artifacts, exclude=()):
+        """
+        Сохраняет содержимое source_dir (кроме exclude) как запись key.
+        artifacts - словарь путей внутри source_dir.
+        """
+        source_dir = Path(source_dir)
+        # Исключенные файлы, на которые ссылаются артефакты, все равно сохраняем
+        referenced = {Path(p).resolve() for p in artifacts.values() if p is not None}
+        excluded = {Path(p).resolve() for p in exclude} - referenced
+        tmp_dir = self.root / f".tmp-{uuid.uuid4().hex}"
+        try:
+            shutil.copytree(
+                source_dir, tmp_dir,
+                ignore=lambda d, names: [n for n in names if (Path(d) / n).resolve() in excluded]
+            )
+            manifest = {
+                "artifacts": {
+                    name: (Path(path).relative_to(source_dir).as_posix() if path is not None else None)
+                    for name, path in artifacts.items()
+                }
+            }
+            with open(tmp_dir / MANIFEST_NAME, "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+            size = _tree_size(tmp_dir)
+            if size > self.max_bytes:
+                _log.info(f"Result {key} ({size} bytes) exceeds cache size, not cached.")
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return False
+
+            entry_dir = self.root / key
+            with self._lock:
+                if key in self._entries:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    return True
+                os.replace(tmp_dir, entry_dir)
+                self._entries[key] = size
+                self._total_bytes += size
+                evicted = self._evict_locked()
+            for old_key in evicted:
+                shutil.rmtree(self.root / old_key, ignore_errors=True)
+            _log.info(f"Result cached: {key} ({size} bytes)")
+            return True
+        except Exception as e:
+            _log.error(f"Error caching result {key}: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return False
+
+    def _evict_locked(self):
+        evicted = []
+        while self._entries and self._total_bytes > self.max_bytes:
+            old_key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            evicted.append(old_key)
+            self.evictions += 1
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,286 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+
+from utils import state_db
+
+_log = logging.getLogger(__name__)
+
+# SqliteSessionStore продлевает сессию не чаще этого интервала, чтобы частые запросы
+# к одной сессии не занимали блокировку базы на запись
+_TOUCH_INTERVAL_SECONDS = 1.0
+
+
+def directory_size(path):
+    """
+    Суммарный размер файлов в директории (байты).
+    """
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class SessionStore:
+    """
+    Хранилище сессий с временем жизни (TTL) и общим лимитом занятого диска.
+    При превышении лимита вытесняются давно не использованные сессии (LRU).
+    on_evict(session_id, data) вызывается для каждой удаленной сессии,
+    например для удаления ее временной директории.
+    """
+
+    def __init__(self, ttl_seconds, max_bytes, on_evict=None):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.expired = 0
+        self.evicted = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, session_id, data, temp_dir=None):
+        """
+        Регистрирует сессию. Размер считается по temp_dir, если он задан.
+        """
+        size = directory_size(temp_dir) if temp_dir else 0
+        now = time.time()
+        with self._lock:
+            self._sessions[session_id] = {
+                "data": data,
+                "bytes": size,
+                "created_at": now,
+                "last_access": now,
+            }
+            self._sessions.move_to_end(session_id)
+        if self.total_bytes > self.max_bytes:
+            self.reap()
+
+    def get(self, session_id, default=None, touch=True):
+        """
+        Возвращает данные сессии и продлевает ее (если touch). Истекшие сессии не возвращаются.
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None or self._is_expired(entry, time.time()):
+                return default
+            if touch:
+                entry["last_access"] = time.time()
+                self._sessions.move_to_end(session_id)
+            return entry["data"]
+
+    def __contains__(self, session_id):
+        # Проверка без продления сессии
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            return entry is not None and not self._is_expired(entry, time.time())
+
+    def remove(self, session_id):
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+        if entry is not None:
+            self._evict(session_id, entry)
+
+    def session_ids(self):
+        """
+        Идентификаторы живых сессий.
+        """
+        now = time.time()
+        with self._lock:
+            return [session_id for session_id, entry in self._sessions.items() if not self._is_expired(entry, now)]
+
+    @property
+    def total_bytes(self):
+        with self._lock:
+            return sum(entry["bytes"] for entry in self._sessions.values())
+
+    def _is_expired(self, entry, now):
+        return self.ttl_seconds is not None and now - entry["last_access"] > self.ttl_seconds
+
+    def reap(self):
+        """
+        Удаляет истекшие сессии, затем самые старые по доступу, пока не уложимся в лимит.
+        Возвращает список удаленных session_id.
+        """
+        now = time.time()
+        removed = []
+        with self._lock:
+            for session_id, entry in list(self._sessions.items()):
+                if self._is_expired(entry, now):
+                    removed.append((session_id, self._sessions.pop(session_id)))
+                    self.expired += 1
+            total = sum(entry["bytes"] for entry in self._sessions.values())
+            while self._sessions and total > self.max_bytes:
+                session_id, entry = self._sessions.popitem(last=False)
+                total -= entry["bytes"]
+                removed.append((session_id, entry))
+                self.evicted += 1
+
+        for session_id, entry in removed:
+            self._evict(session_id, entry)
+        if removed:
+            _log.info(f"Sessions reaped: {len(removed)}")
+        return [session_id for session_id, _ in removed]
+
+    def _evict(self, session_id, entry):
+        if self.on_evict:
+            try:
+                self.on_evict(session_id, entry["data"])
+            except Exception as e:
+                _log.error(f"Error evicting session {session_id}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "memory",
+                "live_sessions": len(self._sessions),
+                "bytes_held": sum(entry["bytes"] for entry in self._sessions.values()),
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+
+class SqliteSessionStore:
+    """
+    Хранилище сессий в файле SQLite с тем же интерфейсом, что у SessionStore.
+    Файл общий для всех процессов (uvicorn --workers N, реплики с общим каталогом артефактов),
+    поэтому сессия доступна на любом из них. Пути в данных сессии хранятся относительно root.
+    Счетчики expired и evicted считаются в каждом процессе отдельно.
+    """
+
+    def __init__(self, path, ttl_seconds, max_bytes, on_evict=None, root=None):
+        self.path = path
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.expired = 0
+        self.evicted = 0
+        with state_db.transaction(self.path) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, data TEXT NOT NULL, bytes INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access)")
+
+    def _cutoff(self, now):
+        # Сессии с last_access раньше этого момента истекли
+        return now - self.ttl_seconds if self.ttl_seconds is not None else float("-inf")
+
+    def put(self, session_id, data, temp_dir=None):
+        """
+        Регистрирует сессию. Размер считается по temp_dir, если он задан.
+        """
+        size = directory_size(temp_dir) if temp_dir else 0
+        now = time.time()
+        with state_db.transaction(self.path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, data, bytes, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (session_id, state_db.dumps(data, self.root), size, now, now)
+            )
+        if self.total_bytes > self.max_bytes:
+            self.reap()
+
+    def get(self, session_id, default=None, touch=True):
+        """
+        Возвращает данные сессии и продлевает ее (если touch). Истекшие сессии не возвращаются.
+        """
+        now = time.time()
+        # Чтение без блокировки на запись; она берется только на короткое обновление last_access
+        with closing(state_db.connect(self.path)) as conn:
+            row = conn.execute("SELECT data, last_access FROM sessions WHERE session_id = ? AND last_access >= ?",
+                               (session_id, self._cutoff(now))).fetchone()
+            if row is None:
+                return default
+            if touch and now - row[1] >= _TOUCH_INTERVAL_SECONDS:
+                conn.execute("UPDATE sessions SET last_access = ? WHERE session_id = ? AND last_access < ?",
+                             (now, session_id, now))
+        return state_db.loads(row[0], self.root)
+
+    def __contains__(self, session_id):
+        # Проверка без продления сессии
+        return self.get(session_id, touch=False) is not None
+
+    def remove(self, session_id):
+        with state_db.transaction(self.path) as conn:
+            row = conn.execute("SELECT data FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        if row is not None:
+            self._evict(session_id, row[0])
+
+    def session_ids(self):
+        """
+        Идентификаторы живых сессий.
+        """
+        with closing(state_db.connect(self.path)) as conn:
+            rows = conn.execute("SELECT session_id FROM sessions WHERE last_access >= ?",
+                                (self._cutoff(time.time()),)).fetchall()
+        return [row[0] for row in rows]
+
+    @property
+    def total_bytes(self):
+        with closing(state_db.connect(self.path)) as conn:
+            return conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM sessions").fetchone()[0]
+
+    def reap(self):
+        """
+        Удаляет истекшие сессии, затем самые старые по доступу, пока не уложимся в лимит.
+        Выбор и удаление идут в одной транзакции, поэтому при нескольких процессах
+        каждая сессия вытесняется ровно одним из них. Возвращает список удаленных session_id.
+        """
+        cutoff = self._cutoff(time.time())
+        removed = []
+        with state_db.transaction(self.path) as conn:
+            expired = conn.execute("SELECT session_id, data FROM sessions WHERE last_access < ?",
+                                   (cutoff,)).fetchall()
+            conn.execute("DELETE FROM sessions WHERE last_access < ?", (cutoff,))
+            removed.extend(expired)
+            self.expired += len(expired)
+
+            total = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM sessions").fetchone()[0]
+            if total > self.max_bytes:
+                for session_id, data, size in conn.execute(
+                        "SELECT session_id, data, bytes FROM sessions ORDER BY last_access").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                    total -= size
+                    removed.append((session_id, data))
+                    self.evicted += 1
+
+        for session_id, data in removed:
+            self._evict(session_id, data)
+        if removed:
+            _log.info(f"Sessions reaped: {len(removed)}")
+        return [session_id for session_id, _ in removed]
+
+    def _evict(self, session_id, data):
+        if self.on_evict:
+            try:
+                self.on_evict(session_id, state_db.loads(data, self.root))
+            except Exception as e:
+                _log.error(f"Error evicting session {session_id}: {e}")
+
+    def stats(self):
+        with closing(state_db.connect(self.path)) as conn:
+            live_sessions, bytes_held = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM sessions").fetchone()
+        return {
+            "backend": "sqlite",
+            "live_sessions": live_sessions,
+            "bytes_held": bytes_held,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
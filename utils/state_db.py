@@ -0,0 +1,68 @@
+import json
+import sqlite3
+from contextlib import closing, contextmanager
+from pathlib import Path
+
+# Общее состояние нескольких процессов (uvicorn --workers N, несколько реплик) в файле SQLite.
+# Для нескольких узлов файл должен лежать на общем хранилище с поддержкой блокировок.
+
+_PATH_KEY = "$path"
+
+
+def connect(path):
+    """
+    Соединение с базой состояния. WAL позволяет читать, пока другой процесс пишет.
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+@contextmanager
+def transaction(path):
+    """
+    Транзакция с блокировкой на запись с самого начала (BEGIN IMMEDIATE),
+    чтобы чтение и изменение в ней не пересекались с другими процессами.
+    """
+    with closing(connect(path)) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+def dumps(data, root=None):
+    """
+    JSON с сохранением путей. Пути внутри root хранятся относительно него,
+    чтобы общий каталог артефактов мог быть смонтирован на узлах в разные места.
+    """
+    root = Path(root).resolve() if root is not None else None
+
+    def default(value):
+        if isinstance(value, Path):
+            path = value.resolve()
+            if root is not None and path.is_relative_to(root):
+                return {_PATH_KEY: path.relative_to(root).as_posix(), "relative": True}
+            return {_PATH_KEY: str(value), "relative": False}
+        return str(value)
+
+    return json.dumps(data, default=default)
+
+
+def loads(text, root=None):
+    """
+    Обратное преобразование dumps: пути восстанавливаются как Path.
+    """
+    def object_hook(value):
+        if _PATH_KEY in value:
+            if value.get("relative") and root is not None:
+                return Path(root) / value[_PATH_KEY]
+            return Path(value[_PATH_KEY])
+        return value
+
+    return json.loads(text, object_hook=object_hook)
@@ -0,0 +1,269 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+_log = logging.getLogger(__name__)
+
+# Режимы поиска: exact - полный перебор, ivf - кластерный приближенный поиск,
+# auto - ivf при числе векторов от IVF_THRESHOLD
+INDEX_MODES = ("auto", "exact", "ivf")
+IVF_THRESHOLD = 20000
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _top_k(scores, k):
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def _spherical_kmeans(vectors, nlist, iterations=10, seed=0):
+    """
+    k-means по косинусной близости для нормированных векторов.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(vectors.shape[0], size=nlist, replace=False)].copy()
+    assignments = np.zeros(vectors.shape[0], dtype=np.int64)
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for cluster in range(nlist):
+            members = vectors[assignments == cluster]
+            if len(members):
+                centroids[cluster] = members.sum(axis=0)
+        centroids = _normalize(centroids)
+    return centroids, assignments
+
+
+def _split(assignments, blocks):
+    """
+    Делит номера кластеров общего массива обратно по документам.
+    """
+    offsets = np.cumsum([len(vectors) for vectors in blocks])[:-1]
+    return np.split(assignments, offsets)
+
+
+def _inverted_lists(assignments, nlist):
+    """
+    Списки строк по кластерам за O(N log N) вместо прохода по массиву для каждого кластера.
+    """
+    order = np.argsort(assignments, kind="stable")
+    bounds = np.searchsorted(assignments[order], np.arange(nlist + 1))
+    return [order[bounds[cluster]:bounds[cluster + 1]] for cluster in range(nlist)]
+
+
+class VectorIndex:
+    """
+    Индекс усредненных векторов страниц для косинусного поиска.
+    Векторы группируются по документу (session_id), чтобы их можно было удалить целиком.
+    label - публичный идентификатор документа для выдачи в результатах вместо doc_id.
+    После добавления или удаления документов при следующем поиске пересобирается только
+    плоский массив векторов. Новые векторы относятся к уже обученным центроидам IVF,
+    а k-means переобучается в фоне, когда число векторов изменилось в retrain_factor раз.
+    """
+
+    def __init__(self, mode="auto", ivf_threshold=IVF_THRESHOLD, nlist=None, nprobe=8, retrain_factor=2.0):
+        if mode not in INDEX_MODES:
+            raise ValueError(f"mode must be one of {INDEX_MODES}, got {mode}")
+        self.mode = mode
+        self.ivf_threshold = ivf_threshold
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.retrain_factor = retrain_factor
+        # doc_id -> (номера страниц, нормированные векторы, номера кластеров или None)
+        self._docs = {}
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._dirty = True
+        self._vectors = np.empty((0, 0), dtype=np.float32)
+        self._refs = []
+        self._centroids = None
+        self._lists = None
+        self._trained_vectors = 0
+        self._training = False
+        self.build_seconds = None
+        self.train_seconds = None
+        self.queries = 0
+        self.total_query_seconds = 0.0
+        self.last_query_seconds = None
+
+    def _assign_locked(self, vectors):
+        if self._centroids is None:
+            return None
+        return np.argmax(vectors @ self._centroids.T, axis=1)
+
+    def add(self, doc_id, pages, vectors, label=None):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or len(pages) != vectors.shape[0]:
+            raise ValueError("vectors must be a 2D array with one row per page")
+        vectors = _normalize(vectors)
+        with self._lock:
+            self._docs[doc_id] = (list(pages), vectors, self._assign_locked(vectors))
+            self._labels[doc_id] = label
+            self._dirty = True
+
+    def remove(self, doc_id):
+        with self._lock:
+            self._labels.pop(doc_id, None)
+            if self._docs.pop(doc_id, None) is not None:
+                self._dirty = True
+
+    def label(self, doc_id):
+        with self._lock:
+            return self._labels.get(doc_id)
+
+    def __contains__(self, doc_id):
+        with self._lock:
+            return doc_id in self._docs
+
+    def doc_ids(self):
+        with self._lock:
+            return list(self._docs)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(pages) for pages, _, _ in self._docs.values())
+
+    def _resolve_mode(self, mode):
+        mode = mode or self.mode
+        if mode not in INDEX_MODES:
+            raise ValueError(f"mode must be one of {INDEX_MODES}, got {mode}")
+        if mode == "auto":
+            return "ivf" if self._vectors.shape[0] >= self.ivf_threshold else "exact"
+        return mode
+
+    def _build_locked(self):
+        """
+        Собирает плоский массив векторов и списки IVF из уже посчитанных номеров кластеров, без k-means.
+        """
+        start_time = time.perf_counter()
+        refs = []
+        blocks = []
+        assignments = []
+        for doc_id, (pages, vectors, doc_assignments) in self._docs.items():
+            refs.extend((doc_id, page_no) for page_no in pages)
+            blocks.append(vectors)
+            assignments.append(doc_assignments)
+        self._refs = refs
+        self._vectors = np.concatenate(blocks) if blocks else np.empty((0, 0), dtype=np.float32)
+        self._lists = None
+        if self._centroids is not None and blocks:
+            self._lists = _inverted_lists(np.concatenate(assignments), self._centroids.shape[0])
+
+        self._dirty = False
+        self.build_seconds = time.perf_counter() - start_time
+        _log.info(f"Vector index built: {len(refs)} vectors in {self.build_seconds:.3f} seconds.")
+
+    def search(self, query, k=10, mode=None, nprobe=None):
+        """
+        Возвращает до k пар (doc_id, page_no, score) по убыванию косинусной близости.
+        """
+        query = _normalize(np.asarray(query, dtype=np.float32).reshape(-1))
+        with self._lock:
+            if self._dirty:
+                self._build_locked()
+            start_time = time.perf_counter()
+            mode = self._resolve_mode(mode)
+            if self._vectors.shape[0] == 0:
+                results = []
+            elif mode == "ivf":
+                if self._centroids is None:
+                    # Первое обучение IVF: центроидов еще нет, поэтому синхронно
+                    self._train_locked()
+                    start_time = time.perf_counter()
+                elif self._drifted_locked():
+                    self._start_retrain_locked()
+                probes = _top_k(self._centroids @ query, nprobe or self.nprobe)
+                candidates = np.concatenate([self._lists[cluster] for cluster in probes])
+                scores = self._vectors[candidates] @ query
+                order = _top_k(scores, k)
+                results = [(*self._refs[candidates[i]], float(scores[i])) for i in order]
+            else:
+                scores = self._vectors @ query
+                results = [(*self._refs[i], float(scores[i])) for i in _top_k(scores, k)]
+
+            self.last_query_seconds = time.perf_counter() - start_time
+            self.queries += 1
+            self.total_query_seconds += self.last_query_seconds
+            return results
+
+    def _nlist(self, count):
+        return min(self.nlist or max(1, int(np.sqrt(count))), count)
+
+    def _drifted_locked(self):
+        count = self._vectors.shape[0]
+        return not self._training and (count > self._trained_vectors * self.retrain_factor
+                                       or count * self.retrain_factor < self._trained_vectors)
+
+    def _train_locked(self):
+        start_time = time.perf_counter()
+        doc_ids = list(self._docs)
+        centroids, assignments = _spherical_kmeans(self._vectors, self._nlist(self._vectors.shape[0]))
+        self._install_locked(centroids, _split(assignments, [self._docs[doc_id][1] for doc_id in doc_ids]),
+                             doc_ids, self._vectors.shape[0])
+        self.train_seconds = time.perf_counter() - start_time
+        self._build_locked()
+
+    def _start_retrain_locked(self):
+        """
+        Переобучает k-means в фоне на снимке векторов; до окончания поиск идет по старым центроидам.
+        """
+        self._training = True
+        snapshot = {doc_id: vectors for doc_id, (_pages, vectors, _) in self._docs.items()}
+        threading.Thread(target=self._retrain, args=(snapshot, self._vectors),
+                         name="vector-index-train", daemon=True).start()
+
+    def _retrain(self, snapshot, vectors):
+        try:
+            start_time = time.perf_counter()
+            centroids, assignments = _spherical_kmeans(vectors, self._nlist(vectors.shape[0]))
+            by_doc = _split(assignments, list(snapshot.values()))
+            with self._lock:
+                # Документы, измененные во время обучения, относятся к новым центроидам заново
+                doc_ids = [doc_id for doc_id in snapshot
+                           if doc_id in self._docs and self._docs[doc_id][1] is snapshot[doc_id]]
+                kept = dict(zip(snapshot, by_doc))
+                self._install_locked(centroids, [kept[doc_id] for doc_id in doc_ids], doc_ids, vectors.shape[0])
+                self.train_seconds = time.perf_counter() - start_time
+            _log.info(f"Vector index retrained: {vectors.shape[0]} vectors in {self.train_seconds:.3f} seconds.")
+        except Exception as e:
+            _log.error(f"Error retraining vector index: {e}")
+        finally:
+            with self._lock:
+                self._training = False
+
+    def _install_locked(self, centroids, assignments, doc_ids, trained_vectors):
+        self._centroids = centroids
+        self._trained_vectors = trained_vectors
+        known = dict(zip(doc_ids, assignments))
+        for doc_id, (pages, vectors, _) in list(self._docs.items()):
+            doc_assignments = known.get(doc_id)
+            if doc_assignments is None:
+                doc_assignments = self._assign_locked(vectors)
+            self._docs[doc_id] = (pages, vectors, doc_assignments)
+        self._dirty = True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "documents": len(self._docs),
+                "vectors": sum(len(pages) for pages, _, _ in self._docs.values()),
+                "ivf_lists": self._centroids.shape[0] if self._centroids is not None else 0,
+                "trained_vectors": self._trained_vectors,
+                "training": self._training,
+                "build_seconds": self.build_seconds,
+                "train_seconds": self.train_seconds,
+                "queries": self.queries,
+                "last_query_seconds": self.last_query_seconds,
+                "avg_query_seconds": (self.total_query_seconds / self.queries) if self.queries else None,
+            }
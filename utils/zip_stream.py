@@ -0,0 +1,66 @@
+import io
+import zipfile
+from pathlib import Path
+
+# Размер блока чтения файлов при упаковке
+CHUNK_SIZE = 64 * 1024
+
+COMPRESSION_METHODS = {
+    "stored": zipfile.ZIP_STORED,
+    "deflated": zipfile.ZIP_DEFLATED,
+}
+
+
+class _StreamBuffer(io.RawIOBase):
+    """
+    Неперематываемый буфер: zipfile пишет сюда, генератор забирает накопленные байты.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip(files, compression=zipfile.ZIP_STORED, chunk_size=CHUNK_SIZE):
+    """
+    Генерирует ZIP-архив по частям без записи на диск.
+    files - итерируемое из путей к файлам; имя в архиве - имя файла.
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=compression, allowZip64=True) as zipf:
+        for path in files:
+            path = Path(path)
+            zinfo = zipfile.ZipInfo.from_file(path, path.name)
+            zinfo.compress_type = compression
+            with open(path, "rb") as src, zipf.open(zinfo, "w") as dst:
+                for chunk in iter(lambda: src.read(chunk_size), b""):
+                    dst.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            data = buffer.drain()
+            if data:
+                yield data
+    data = buffer.drain()
+    if data:
+        yield data